@@ -0,0 +1,247 @@
+"""
+The dams, lakes, DEM and WorldClim attributes of all of the GRDC basins, in one table.
+
+Calling process_dams_data, process_lakes_data, process_dem_data and process_wclim_data once
+per basin opens (and for the shapefiles, scans) the global layers again for every basin. Here
+every worker process opens the sources once and then runs through its share of the basins:
+the dams and lakes are looked up through their spatial index (see spatial_filter), the
+rasters are read only in the window of the basin, with the basin rasterized as a mask (see
+dem_attributes and wclim_attributes). The result is one row per basin:
+
+    grdc_no, dams_purpose, dams_max_stor, dams_normal_sto, dams_count,
+    lakes_area, lakes_vol_total, lakes_depth_avg, lakes_dis_avg, lakes_res_time, lakes_count,
+    ws_features, dem_min, dem_max, dem_mean, dem_std, <name>_min, ... for every WorldClim raster
+    (<name>_<band>_min, ... for every band of a multi-band stack)
+
+The DEM of a basin is the one of its WMO region, as in step02 (DEM_na.tif for region 4,
+DEM_sa.tif for region 3), unless one DEM for all of the basins is given with --dem. A basin that
+fails is logged and left out of the table, and the script exits non-zero.
+
+    python -m post_processing.basin_attributes [-j workers] [-o out.csv] [--wclim name=path ...]
+"""
+
+from __future__ import print_function
+
+import getopt
+import multiprocessing
+import os
+import sys
+import traceback
+
+import pandas as pd
+from osgeo import gdal, ogr
+
+from post_processing import spatial_filter
+from post_processing.dams_processor import dams_attributes
+from post_processing.dem_processor import dem_attributes
+from post_processing.lakes_processor import lakes_attributes
+from post_processing.world_clim_processor import wclim_attributes
+from supporting_scripts import basin_index
+from supporting_scripts import execution_plan
+from supporting_scripts import pipeline_config
+from supporting_scripts import zonal_stats
+
+share_path = pipeline_config.current().share_path
+ws_base_path = share_path + 'watershed_shp/'
+
+DEFAULT_SOURCES = {
+    'dams': share_path + 'dams/GRanD_dams_v1_1.shp',
+    'lakes': share_path + 'lakes/HydroLAKES_polys_v10.shp',
+    # WMO region -> DEM, the DEMs step02 clips; or one path for all of the basins
+    'dem': {4: share_path + 'dem/DEM_na.tif', 3: share_path + 'dem/DEM_sa.tif'},
+    'wclim': [],
+}
+
+DAMS_COLUMNS = ['dams_purpose', 'dams_max_stor', 'dams_normal_sto', 'dams_count']
+LAKES_COLUMNS = ['lakes_area', 'lakes_vol_total', 'lakes_depth_avg', 'lakes_dis_avg', 'lakes_res_time',
+                 'lakes_count']
+STATS = ['min', 'max', 'mean', 'std']
+
+
+class Sources(object):
+    """The global layers and rasters, opened once (per process) and kept open."""
+
+    def __init__(self, dams=None, lakes=None, dem=None, wclim=()):
+        self._keep = []
+        self.dams_layer = self._layer(dams)
+        self.lakes_layer = self._layer(lakes)
+        if isinstance(dem, dict):
+            self.dem_ds = dict((wmo_reg, self._raster(path)) for wmo_reg, path in dem.items())
+        else:
+            self.dem_ds = self._raster(dem) if dem is not None else None
+        self.wclim = [(name, self._raster(path)) for name, path in wclim]
+
+    def _layer(self, path):
+        if path is None:
+            return None
+        ds = ogr.Open(path, 0)
+        if ds is None:
+            raise ValueError('Unable to open ' + path)
+        self._keep.append(ds)
+        return ds.GetLayer()
+
+    def _raster(self, path):
+        ds = gdal.Open(path)
+        if ds is None:
+            raise ValueError('Unable to open ' + path)
+        self._keep.append(ds)
+        return ds
+
+    def dem_for(self, wmo_reg):
+        """The DEM of a basin in WMO region wmo_reg."""
+        if not isinstance(self.dem_ds, dict):
+            return self.dem_ds
+        if wmo_reg not in self.dem_ds:
+            raise ValueError('No DEM for WMO region ' + str(wmo_reg))
+        return self.dem_ds[wmo_reg]
+
+    def attributes(self, grdc_no, shapefile, country=None, wmo_reg=None):
+        """The row of one basin, as a dict."""
+        row = {'grdc_no': grdc_no}
+        ws_ds = ogr.Open(shapefile, 0)
+        ws_geometries = spatial_filter.layer_geometries(ws_ds.GetLayer())
+        row['ws_features'] = ws_ds.GetLayer().GetFeatureCount()
+        ws_ds = None
+
+        if self.dams_layer is not None:
+            row.update(zip(DAMS_COLUMNS, dams_attributes(self.dams_layer, ws_geometries)))
+        if self.lakes_layer is not None:
+            row.update(zip(LAKES_COLUMNS, lakes_attributes(self.lakes_layer, ws_geometries, country)))
+
+        # the masks are shared by the rasters on the same grid, but not kept for all of the basins
+        zonal_stats.clear_cache()
+        if self.dem_ds is not None:
+            row.update(zip(_stat_columns('dem'), dem_attributes(self.dem_for(wmo_reg), shapefile)))
+        for name, ds in self.wclim:
+            for column, values in zip(_band_names(name, ds.RasterCount), wclim_attributes(ds, shapefile)):
+                row.update(zip(_stat_columns(column), values))
+        return row
+
+
+def _stat_columns(name):
+    return [name + '_' + stat for stat in STATS]
+
+
+def _band_names(name, band_count):
+    # a single band raster keeps its name, the bands of a stack get a number
+    if band_count == 1:
+        return [name]
+    return [name + '_' + str(band_number) for band_number in range(1, band_count + 1)]
+
+
+def table_columns(source_paths):
+    """The columns of the table for the sources in source_paths."""
+    columns = ['grdc_no']
+    if source_paths.get('dams') is not None:
+        columns += DAMS_COLUMNS
+    if source_paths.get('lakes') is not None:
+        columns += LAKES_COLUMNS
+    columns.append('ws_features')
+    if source_paths.get('dem') is not None:
+        columns += _stat_columns('dem')
+    for name, path in source_paths.get('wclim', ()):
+        ds = gdal.Open(path)
+        for column in _band_names(name, ds.RasterCount):
+            columns += _stat_columns(column)
+        ds = None
+    return columns
+
+
+# the Sources of a worker process
+_sources = None
+
+
+def _init_worker(source_paths):
+    global _sources
+    _sources = Sources(**source_paths)
+
+
+# (grdc_no, row), row None if the basin failed
+def _basin_row(basin):
+    grdc_no = basin[0]
+    try:
+        return grdc_no, _sources.attributes(*basin)
+    except Exception:
+        print('###### Failed basin ' + str(grdc_no) + ':\n' + traceback.format_exc(), file=sys.stderr)
+        return grdc_no, None
+
+
+def build_attribute_table(basins, source_paths, workers=None):
+    """
+    One row per basin of basins, a sequence of (grdc_no, shapefile, country, wmo_reg) tuples,
+    with the sources in source_paths (the keyword arguments of Sources). Returns a DataFrame of
+    the basins that worked and the list of the grdc_no of the basins that failed.
+    """
+    # the spatial indexes are made here, once, before the workers start reading them
+    for key in ('dams', 'lakes'):
+        if source_paths.get(key) is not None:
+            spatial_filter.ensure_spatial_index(source_paths[key])
+
+    if workers is None:
+        workers = execution_plan.node_cores()
+    workers = max(1, min(workers, len(basins)))
+
+    if workers == 1:
+        _init_worker(source_paths)
+        results = [_basin_row(basin) for basin in basins]
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(source_paths,))
+        try:
+            results = []
+            for result in pool.imap(_basin_row, basins, chunksize=4):
+                results.append(result)
+                if len(results) % 100 == 0:
+                    print(str(len(results)) + ' of ' + str(len(basins)) + ' basins')
+        finally:
+            pool.close()
+            pool.join()
+
+    rows = [row for grdc_no, row in results if row is not None]
+    failed = [grdc_no for grdc_no, row in results if row is None]
+    return pd.DataFrame(rows, columns=table_columns(source_paths)), failed
+
+
+def station_basins(stations_csv):
+    """(grdc_no, shapefile, country, wmo_reg) of every station with a basin shapefile."""
+    df = pd.read_csv(stations_csv).sort_values('area').query('area >= 10')
+    basins = []
+    for row in df.itertuples(index=True, name='Pandas'):
+        grdc_no = getattr(row, 'grdc_no')
+        shapefile = basin_index.basin_shapefile(ws_base_path, grdc_no)
+        if os.path.exists(shapefile):
+            basins.append((grdc_no, shapefile, getattr(row, 'country', None), getattr(row, 'wmo_reg', None)))
+        else:
+            print('###### Missing shape file ' + shapefile)
+    return basins
+
+
+if __name__ == '__main__':
+    usage = 'basin_attributes.py [-j workers] [-o out.csv] [--dams shp] [--lakes shp] [--dem tif] ' \
+            '[--wclim name=tif ...]'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'j:o:', ['jobs=', 'out=', 'dams=', 'lakes=', 'dem=', 'wclim='])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+
+    workers = None
+    out_file = share_path + 'basin_attributes.csv'
+    source_paths = dict(DEFAULT_SOURCES)
+    source_paths['wclim'] = []
+    for opt, arg in opts:
+        if opt in ('-j', '--jobs'):
+            workers = int(arg)
+        elif opt in ('-o', '--out'):
+            out_file = arg
+        elif opt == '--wclim':
+            name, path = arg.split('=', 1)
+            source_paths['wclim'].append((name, path))
+        else:
+            source_paths[opt[2:]] = arg
+
+    table, failed = build_attribute_table(station_basins(share_path + 'GRDC_Stations.csv'), source_paths, workers)
+    table.to_csv(out_file, index=False)
+    print('Wrote ' + str(len(table)) + ' rows to ' + out_file)
+    if failed:
+        print(str(len(failed)) + ' basins failed: ' + ' '.join(str(grdc_no) for grdc_no in failed))
+        sys.exit(1)
@@ -1,7 +1,11 @@
 import statistics as statistics
 from osgeo import ogr
 
+from post_processing import spatial_filter
 
+
+# the spatial index of the dams is only read here; build it once before the basins are run
+# (python -m post_processing.spatial_filter <dams shp>, basin_attributes does it by itself)
 def process_dams_data(ws_shape, dams_shape):
 
     driver = ogr.GetDriverByName("ESRI Shapefile")
@@ -14,22 +18,24 @@ def process_dams_data(ws_shape, dams_shape):
     ws_ds = driver.Open(ws_shape, 0)
     ws_layer = ws_ds.GetLayer()
 
+    return dams_attributes(dams_layer, spatial_filter.layer_geometries(ws_layer))
+
+
+# the dams attributes of a watershed from an already open dams layer (see basin_attributes)
+def dams_attributes(dams_layer, ws_geometries):
+
     # setup our return variables
     number_of_dams = 0
     purposes = []
     max_stor = []
     normal_sto = []
 
-    for ws_features in ws_layer:
-        ws_geometry = ws_features.GetGeometryRef()
-
-        for dams_features in dams_layer:
-            dams_geometry = dams_features.GetGeometryRef()
-            if dams_geometry.Intersects(ws_geometry):
-                number_of_dams += 1
-                purposes.append(dams_features.GetField("PURPOSES"))
-                max_stor.append(float(dams_features.GetField("MAX_STOR")))
-                normal_sto.append(float(dams_features.GetField("NORMAL_STO")))
+    # only the dams near the watershed are read (spatial index), then tested exactly
+    for dams_features in spatial_filter.intersecting_features(dams_layer, ws_geometries):
+        number_of_dams += 1
+        purposes.append(dams_features.GetField("PURPOSES"))
+        max_stor.append(float(dams_features.GetField("MAX_STOR")))
+        normal_sto.append(float(dams_features.GetField("NORMAL_STO")))
 
     try:
         purp = statistics.mode(purposes)
@@ -37,4 +43,3 @@ def process_dams_data(ws_shape, dams_shape):
         purp = ''
 
     return purp, sum(max_stor), sum(normal_sto), number_of_dams
-
@@ -1,37 +1,27 @@
 from osgeo import gdal
 
+from supporting_scripts import zonal_stats
+
+# the nodata value of a DEM that doesn't set one (as when the DEM was clipped for the statistics)
+DEFAULT_NODATA = -99
 
-def process_dem_data(ws_shape_path, dem_raster_path):
 
-    temp_DEM_path = 'temp_DEM.tif'
-    clip_raster(ws_shape_path, dem_raster_path, temp_DEM_path)
+def process_dem_data(ws_shape_path, dem_raster_path):
 
-    src_ds = gdal.Open(temp_DEM_path)
-    srcband = src_ds.GetRasterBand(1)
-    srcband.ComputeStatistics(False)
-    min_elev, max_elev, mean_elev, stdev_elev = srcband.GetStatistics(True, True)
+    ds = gdal.Open(dem_raster_path)
+    min_elev, max_elev, mean_elev, stdev_elev = dem_attributes(ds, ws_shape_path)
+    ds = None
 
     return min_elev, max_elev, mean_elev, stdev_elev
 
 
-def clip_raster(shapefile, rastToCut, outfile):
-    layer_name = shapefile.split('/')[-1].split('.')[0]
-    ds1 = gdal.Open(rastToCut)
-    ds1_band = ds1.GetRasterBand(1)
-    nodata = ds1_band.GetNoDataValue()
-    print 'Clipping ' + rastToCut
-    if nodata is None:
-        nodata = -99
-    ds1 = None
-
-    ds = gdal.Warp(outfile, rastToCut,
-                   warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                   format='GTiff',
-                   cutlineDSName=shapefile,
-                   cutlineLayer=layer_name,
-                   cropToCutline=True,
-                   multithread=True,
-                   srcNodata=nodata,
-                   dstNodata=nodata)
+# the DEM statistics of a watershed from an already open DEM (see basin_attributes)
+def dem_attributes(dem_ds, ws_shape_path):
 
-    ds = None
+    # only the window of the watershed is read, with the watershed rasterized (all touched
+    # pixels) as the mask; one pass for all of the statistics
+    zone = zonal_stats.dataset_zone_mask(ws_shape_path, dem_ds)
+    nodata = dem_ds.GetRasterBand(1).GetNoDataValue()
+    stats = zonal_stats.zone_band_stats(dem_ds, zone, nodata=DEFAULT_NODATA if nodata is None else nodata)
+
+    return stats.min, stats.max, stats.mean, stats.std
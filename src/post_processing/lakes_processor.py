@@ -2,7 +2,18 @@ import statistics as statistics
 from osgeo import ogr
 import sys
 
+from post_processing import spatial_filter
 
+# country code of the station -> attribute filter on the lakes
+COUNTRY_FILTERS = {
+    'CA': "Country = 'Canada'",
+    'US': "Country = 'United States of America'",
+    'AR': "Country = 'Argentina'",
+}
+
+
+# the spatial index of the lakes is only read here; build it once before the basins are run
+# (python -m post_processing.spatial_filter <lakes shp>, basin_attributes does it by itself)
 def process_lakes_data(ws_shape, lakes_shape, country):
 
     driver = ogr.GetDriverByName("ESRI Shapefile")
@@ -10,16 +21,19 @@ def process_lakes_data(ws_shape, lakes_shape, country):
     # dams_shape = dams_shape
     lakes_ds = driver.Open(lakes_shape, 0)
     lakes_layer = lakes_ds.GetLayer()
-    if (country == 'CA'):
-        lakes_layer.SetAttributeFilter("Country = 'Canada'")
-    elif (country == 'US'):
-        lakes_layer.SetAttributeFilter("Country = 'United States of America'")
-    elif (country == 'AR'):
-        lakes_layer.SetAttributeFilter("Country = 'Argentina'")
 
     # ws_shape = ws_shape
     ws_ds = driver.Open(ws_shape, 0)
     ws_layer = ws_ds.GetLayer()
+    feature_count = ws_layer.GetFeatureCount()
+
+    return lakes_attributes(lakes_layer, spatial_filter.layer_geometries(ws_layer), country) + (feature_count,)
+
+
+# the lakes attributes of a watershed from an already open lakes layer (see basin_attributes)
+def lakes_attributes(lakes_layer, ws_geometries, country):
+
+    lakes_layer.SetAttributeFilter(COUNTRY_FILTERS.get(country))
 
     # setup our return variables
     number_of_lakes = 0
@@ -28,21 +42,15 @@ def process_lakes_data(ws_shape, lakes_shape, country):
     depth_avg = []
     dis_avg = []
     res_time = []
-    feature_count = ws_layer.GetFeatureCount()
-
 
-    for ws_features in ws_layer:
-        ws_geometry = ws_features.GetGeometryRef()
-
-        for lakes_features in lakes_layer:
-            lakes_geometry = lakes_features.GetGeometryRef()
-            if lakes_geometry.Intersects(ws_geometry):
-                number_of_lakes += 1
-                lake_area.append(lakes_features.GetField("Lake_area"))
-                vol_total.append(float(lakes_features.GetField("Vol_total")))
-                depth_avg.append(float(lakes_features.GetField("Depth_avg")))
-                dis_avg.append(float(lakes_features.GetField("Dis_avg")))
-                res_time.append(float(lakes_features.GetField("Res_time")))
+    # only the lakes near the watershed are read (spatial index), then tested exactly
+    for lakes_features in spatial_filter.intersecting_features(lakes_layer, ws_geometries):
+        number_of_lakes += 1
+        lake_area.append(lakes_features.GetField("Lake_area"))
+        vol_total.append(float(lakes_features.GetField("Vol_total")))
+        depth_avg.append(float(lakes_features.GetField("Depth_avg")))
+        dis_avg.append(float(lakes_features.GetField("Dis_avg")))
+        res_time.append(float(lakes_features.GetField("Res_time")))
 
     try:
         mean_depth = statistics.mean(depth_avg)
@@ -55,5 +63,4 @@ def process_lakes_data(ws_shape, lakes_shape, country):
         mean_dis = ''
 
     return sum(lake_area), sum(vol_total), mean_depth, \
-           sum(dis_avg), mean_dis, number_of_lakes, feature_count
-
+           sum(dis_avg), mean_dis, number_of_lakes
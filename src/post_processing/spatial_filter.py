@@ -0,0 +1,97 @@
+"""
+Features of a (global) layer that intersect a watershed.
+
+The layer is first filtered on the bounding box of the watershed, which OGR answers from the
+spatial index of the shapefile (the .qix, made by ensure_spatial_index), so only the dams or
+lakes near the basin are read. Those are then tested exactly against the watershed, as a
+prepared geometry when shapely is installed (much faster for the detailed watershed
+outlines), otherwise with OGR.
+
+The index is made once, up front, by the process that sets the run up (basin_attributes does,
+or run this module on the shapefiles), never by the workers looking up basins: they would race
+to write the same .qix.
+
+    python -m post_processing.spatial_filter <dams shp> <lakes shp> ...
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+from osgeo import ogr
+
+try:
+    from shapely import wkb as shapely_wkb
+    from shapely.prepared import prep
+except ImportError:
+    shapely_wkb = None
+
+
+def ensure_spatial_index(shapefile):
+    """Make the .qix spatial index of shapefile if it doesn't have one (and we may write there)."""
+    if os.path.exists(os.path.splitext(shapefile)[0] + '.qix'):
+        return
+    try:
+        ds = ogr.Open(shapefile, 1)
+    except RuntimeError:
+        ds = None
+    if ds is None:
+        return
+    layer = ds.GetLayer()
+    ds.ExecuteSQL('CREATE SPATIAL INDEX ON "' + layer.GetName() + '"')
+    ds = None
+
+
+def _intersects_test(geometry):
+    # geometry.Intersects, prepared when we can
+    if shapely_wkb is None:
+        return geometry.Intersects
+    prepared = prep(shapely_wkb.loads(bytes(geometry.ExportToWkb())))
+    return lambda other: prepared.intersects(shapely_wkb.loads(bytes(other.ExportToWkb())))
+
+
+def intersecting_features(layer, geometries):
+    """
+    The features of layer that intersect any of geometries, each once, in the order of the
+    layer. The attribute filter of the layer is kept; its spatial filter is cleared after.
+    """
+    features = []
+    seen = set()
+    try:
+        for geometry in geometries:
+            min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+            intersects = _intersects_test(geometry)
+            layer.SetSpatialFilterRect(min_x, min_y, max_x, max_y)
+            layer.ResetReading()
+            for feature in layer:
+                fid = feature.GetFID()
+                if fid in seen:
+                    continue
+                other = feature.GetGeometryRef()
+                if other is not None and intersects(other):
+                    seen.add(fid)
+                    features.append(feature)
+    finally:
+        layer.SetSpatialFilter(None)
+        layer.ResetReading()
+    features.sort(key=lambda feature: feature.GetFID())
+    return features
+
+
+def layer_geometries(layer):
+    """Copies of the geometries of all features of layer."""
+    geometries = []
+    layer.ResetReading()
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            geometries.append(geometry.Clone())
+    layer.ResetReading()
+    return geometries
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        ensure_spatial_index(path)
+        print(path + (': indexed' if os.path.exists(os.path.splitext(path)[0] + '.qix') else ': no index'))
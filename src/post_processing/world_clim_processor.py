@@ -1,37 +1,39 @@
 from osgeo import gdal
 
+from supporting_scripts import zonal_stats
+
+# the nodata value of a band that doesn't set one (as when the raster was clipped for the statistics)
+DEFAULT_NODATA = -99
 
-def process_wclim_data(ws_shape_path, wclim_raster_path):
 
-    temp_raster_path = 'temp_raster.tif'
-    clip_raster(ws_shape_path, wclim_raster_path, temp_raster_path)
+def process_wclim_data(ws_shape_path, wclim_raster_path):
 
-    src_ds = gdal.Open(temp_raster_path)
-    srcband = src_ds.GetRasterBand(1)
-    srcband.ComputeStatistics(False)
-    min_value, max_value, mean_value, stdev_value = srcband.GetStatistics(True, True)
+    min_value, max_value, mean_value, stdev_value = process_wclim_bands(ws_shape_path, wclim_raster_path)[0]
 
     return min_value, max_value, mean_value, stdev_value
 
 
-def clip_raster(shapefile, rastToCut, outfile):
-    layer_name = shapefile.split('/')[-1].split('.')[0]
-    ds1 = gdal.Open(rastToCut)
-    ds1_band = ds1.GetRasterBand(1)
-    nodata = ds1_band.GetNoDataValue()
-    print 'Clipping ' + rastToCut
-    if nodata is None:
-        nodata = -99
-    ds1 = None
-
-    ds = gdal.Warp(outfile, rastToCut,
-                   warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                   format='GTiff',
-                   cutlineDSName=shapefile,
-                   cutlineLayer=layer_name,
-                   cropToCutline=True,
-                   multithread=True,
-                   srcNodata=nodata,
-                   dstNodata=nodata)
+# (min, max, mean, std) of every band of a WorldClim stack (the months or the bioclim variables)
+def process_wclim_bands(ws_shape_path, wclim_raster_path):
 
+    ds = gdal.Open(wclim_raster_path)
+    band_values = wclim_attributes(ds, ws_shape_path)
     ds = None
+
+    return band_values
+
+
+# the WorldClim statistics of a watershed from an already open raster (see basin_attributes)
+def wclim_attributes(wclim_ds, ws_shape_path):
+
+    # the watershed is rasterized once and used as the mask of the window read from each band
+    zone = zonal_stats.dataset_zone_mask(ws_shape_path, wclim_ds)
+
+    band_values = []
+    for band_number in range(1, wclim_ds.RasterCount + 1):
+        nodata = wclim_ds.GetRasterBand(band_number).GetNoDataValue()
+        stats = zonal_stats.zone_band_stats(wclim_ds, zone, band_number,
+                                            nodata=DEFAULT_NODATA if nodata is None else nodata)
+        band_values.append((stats.min, stats.max, stats.mean, stats.std))
+
+    return band_values
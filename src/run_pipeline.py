@@ -0,0 +1,175 @@
+"""
+Runs step01 -> step02 -> step03, redoing only what is stale (see supporting_scripts/pipeline.py).
+
+All of the paths, years and models come from pipeline.cfg (or --config, see
+supporting_scripts/pipeline_config.py); the steps are started with the same config.
+
+    step01  one partition: the snow model needs all of the years at once. Reads the daily
+            netCDF files of the years and the template, writes the monthly precip (snow17 and
+            raw), rain events and days below freezing rasters.
+    step02  one partition per shard of the basins (--shard k/n, made on the basin area so they
+            are the same every time), with all of the years and models of its basins, so the
+            base layers of a basin are clipped once and its routing cache is re-used. Run with
+            --resume, so inside a partition only the runs that are not done (with the same
+            inputs, see run_manifest.py) are run. Reads the step01 rasters, the ET, the base
+            layers, the stations table and the watershed shapefiles. A partition with a run
+            that failed exits non-zero and is run again next time.
+    step03  one partition: merges the qf summary table step02 appends to into the results.
+
+    python run_pipeline.py [-j <parallel partitions>] [--config <cfg>] [--stages step02,step03]
+                           [--years 2007] [--models snow17] [--shards <N>] [--cores <N>] [--force] [-n]
+"""
+
+from __future__ import print_function
+
+import getopt
+import os
+import sys
+
+from supporting_scripts import execution_plan
+from supporting_scripts import pipeline
+from supporting_scripts import pipeline_config
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ['step01', 'step02', 'step03']
+# the basins are split into this many step02 partitions. Changing it changes every partition
+STEP02_SHARDS = 8
+
+
+def step01_outputs(output_path, year, model=None):
+    # the monthly rasters step01 writes for a year (of one precip model, or all of them)
+    patterns = []
+    for precip_model in (['snow17', 'raw'] if model is None else [model]):
+        patterns.append(output_path + 'precip/' + precip_model + '/{0}/' + precip_model + '_h2o_{0}_{1}.tif')
+    patterns.append(output_path + 'rain_events/{0}/rain_events_{0}_{1}.tif')
+    if model in (None, 'snow17'):
+        patterns.append(output_path + 'below_freezing/{0}/days_below_freezing_{0}_{1}.tif')
+    return [pattern.format(year, month) for pattern in patterns for month in range(1, 13, 1)]
+
+
+def step01_stage(config, env):
+    netcdf_path = config.path_of('netcdf_path')
+    inputs = [os.path.join(src_path, 'step01_cryo_model_runner.py'),
+              os.path.join(src_path, 'supporting_scripts', 'snow17.py'),
+              config.path_of('template_file')]
+    outputs = []
+    for year in config.years:
+        inputs += [netcdf_path + name + '.' + str(year) + '.nc' for name in ('tmin', 'tmax', 'precip')]
+        outputs += step01_outputs(config.path_of('step01_output_path'), year)
+    command = [sys.executable, 'step01_cryo_model_runner.py']
+    return pipeline.Stage('step01', [pipeline.Partition('step01', 'all', inputs, outputs, command,
+                                                        params={'years': config.years}, cwd=src_path, env=env)])
+
+
+def step02_stage(config, env, years, models, shards, cores):
+    share_path = config.share_path
+    inputs = [os.path.join(src_path, 'step02_swym_runner.py'),
+              share_path + 'GRDC_Stations.csv',
+              share_path + 'watershed_shp',
+              share_path + 'dem/DEM_na.tif',
+              share_path + 'dem/DEM_sa.tif',
+              share_path + 'lulc/lulc.tif',
+              share_path + 'soils/soils.tif',
+              share_path + 'biophysical/biophysical.csv']
+    for year in years:
+        for model in models:
+            # where step01 wrote them, which is where step02 reads them
+            inputs += step01_outputs(config.path_of('step01_output_path'), year, model)
+        inputs += [share_path + 'et/{1}/MOD16A2_ET_0.05deg_GEO_{1}M{0:02d}.tif'.format(month, year)
+                   for month in range(1, 13, 1)]
+
+    partitions = []
+    for shard in range(shards):
+        key = 'shard_{0}_of_{1}'.format(shard, shards)
+        command = [sys.executable, 'step02_swym_runner.py', '--shard', '{0}/{1}'.format(shard, shards),
+                   '--years', ','.join(str(year) for year in years), '--models', ','.join(models), '--resume',
+                   '--scratch', share_path + 'scratch/pipeline_' + key + '/']
+        if cores is not None:
+            command += ['--cores', str(cores)]
+        # the runs of a partition only go to the qf summary table and final_tiffs, next to
+        # those of all of the other partitions, so there are no outputs to check
+        partitions.append(pipeline.Partition('step02', key, inputs, [], command, cwd=src_path, env=env))
+    return pipeline.Stage('step02', partitions)
+
+
+def step03_stage(config, env):
+    summary_table = config.share_path + 'qf_summary.csv'
+    command = [sys.executable, 'step03_raster_sum.py', '--merge', summary_table]
+    for path in config.paths_of('results'):
+        command += ['-o', path]
+    return pipeline.Stage('step03', [pipeline.Partition('step03', 'all', [summary_table], config.paths_of('results'),
+                                                        command, cwd=src_path, env=env)])
+
+
+usage = 'run_pipeline.py [-j <parallel partitions>] [--config <cfg>] [--state <sqlite file>] ' \
+        '[--stages step01,step02,step03] [--years <2000-2014|2003,2007>] [--models <snow17,raw>] ' \
+        '[--shards <N>] [--cores <N>] [--force] [-n|--dry-run]'
+
+if __name__ == '__main__':
+    jobs = 1
+    config_path = None
+    state_path = None
+    stages = list(STAGES)
+    years = None
+    models = None
+    shards = STEP02_SHARDS
+    cores = None
+    force = False
+    dry_run = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:n', ['jobs=', 'config=', 'state=', 'stages=', 'years=',
+                                                         'models=', 'shards=', 'cores=', 'force',
+                                                         'dry-run'])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--config':
+            config_path = os.path.abspath(arg)
+        elif opt == '--state':
+            state_path = arg
+        elif opt == '--stages':
+            stages = arg.replace(',', ' ').split()
+        elif opt == '--years':
+            years = pipeline_config.parse_years(arg)
+        elif opt == '--models':
+            models = arg.replace(',', ' ').split()
+        elif opt == '--shards':
+            shards = int(arg)
+        elif opt == '--cores':
+            cores = int(arg)
+        elif opt == '--force':
+            force = True
+        elif opt in ('-n', '--dry-run'):
+            dry_run = True
+
+    config = pipeline_config.load(config_path)
+    env = dict(os.environ)
+    if config.path is not None:
+        env[pipeline_config.CONFIG_ENV] = os.path.abspath(config.path)
+
+    # the step02 partitions running at the same time share the cores of the node
+    if cores is None and jobs > 1:
+        cores = max(1, execution_plan.node_cores() // jobs)
+
+    selected = []
+    if 'step01' in stages:
+        selected.append(step01_stage(config, env))
+    if 'step02' in stages:
+        selected.append(step02_stage(config, env, years or config.years, models or config.models, shards, cores))
+    if 'step03' in stages:
+        selected.append(step03_stage(config, env))
+
+    state = pipeline.PipelineState(state_path or config.share_path + 'pipeline_state.sqlite')
+    failed = pipeline.run_pipeline(selected, state, jobs=jobs, force=force, dry_run=dry_run,
+                                   log_dir=config.share_path + 'pipeline_logs/')
+    state.close()
+    if failed:
+        print('Failed: ' + ', '.join(failed))
+        sys.exit(1)
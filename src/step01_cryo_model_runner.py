@@ -22,17 +22,20 @@ import numpy.ma as ma
 import pandas as pd
 from osgeo import gdal
 
-from supporting_scripts.arrayToRaster import array_to_raster
+from supporting_scripts import pipeline_config
+from supporting_scripts.arrayToRaster import RasterWriter
 from supporting_scripts.snow17 import snow17
 
 # Set GeoTiff driver
 driver = gdal.GetDriverByName("netCDF")
 driver.Register()
 
-basePath = "/"
-subPath = "clipped/"
-template_file = '/templates/template.tif'
-years = [2000, 2001, 2002, 2003, 2004, 2005, 2006, 2007, 2008, 2009, 2010, 2011, 2012, 2013, 2014]
+# the paths and years come from pipeline.cfg (see supporting_scripts/pipeline_config.py)
+config = pipeline_config.current()
+netcdf_path = config.path_of('netcdf_path')
+template_file = config.path_of('template_file')
+output_path = config.path_of('step01_output_path')
+years = config.years
 
 cols = 0
 rows = 0
@@ -84,9 +87,9 @@ for year in years:
     print "Filenames: " + fileName_minTemp + "\t" + fileName_maxTemp + "\t" + fileName_Precip
 
     # Open raster and read number of rows, columns, bands
-    dataset_minTemp = gdal.Open(basePath + subPath + fileName_minTemp)
-    dataset_maxTemp = gdal.Open(basePath + subPath + fileName_maxTemp)
-    dataset_precip = gdal.Open(basePath + subPath + fileName_Precip)
+    dataset_minTemp = gdal.Open(netcdf_path + fileName_minTemp)
+    dataset_maxTemp = gdal.Open(netcdf_path + fileName_maxTemp)
+    dataset_precip = gdal.Open(netcdf_path + fileName_Precip)
 
     minTemp_cols = dataset_minTemp.RasterXSize
     maxTemp_cols = dataset_maxTemp.RasterXSize
@@ -209,27 +212,29 @@ days_below_zero = pd.Series(np.split(below_zero_days, numberLayers), index=rng)
 
 
 def create_GeoTiff_files(series_to_write, path_str, template_file_and_path):
+    # the template is read once for all of the monthly files
+    writer = RasterWriter(template_file_and_path)
     for (key, v) in series_to_write.iteritems():
         data = ma.filled(v, -99)
         _filename = path_str.format(str(key.year), str(key.month))
         print "Writing file:\t", _filename
-        array_to_raster(data, _filename, template_file_and_path, -99)
+        writer.write(data, _filename, -99)
 
 
 create_GeoTiff_files(total_monthly_runoff,
-                     "/Users/mikelavender/Documents/SAFER_Cryo/precip/snow17/{0}/snow17_h2o_{0}_{1}.tif",
+                     output_path + "precip/snow17/{0}/snow17_h2o_{0}_{1}.tif",
                      template_file)
 
 create_GeoTiff_files(total_monthly_precip,
-                     "/Users/mikelavender/Documents/SAFER_Cryo/precip/raw/{0}/raw_h2o_{0}_{1}.tif",
+                     output_path + "precip/raw/{0}/raw_h2o_{0}_{1}.tif",
                      template_file)
 
 create_GeoTiff_files(monthly_rain_events,
-                     "/Users/mikelavender/Documents/SAFER_Cryo/rain_events/{0}/rain_events_{0}_{1}.tif",
+                     output_path + "rain_events/{0}/rain_events_{0}_{1}.tif",
                      template_file)
 
 create_GeoTiff_files(days_below_zero,
-                     "/Users/mikelavender/Documents/SAFER_Cryo/below_freezing/{0}/days_below_freezing_{0}_{1}.tif",
+                     output_path + "below_freezing/{0}/days_below_freezing_{0}_{1}.tif",
                      template_file)
 
 print("ALL DONE!!!!!")
@@ -1,17 +1,30 @@
 import csv
-import math
 import os
-import signal
+import shutil
+import socket
 import sys
+import time
 import getopt
 
-import natcap.invest.seasonal_water_yield.seasonal_water_yield
-import numpy.ma as ma
 import pandas as pd
 from osgeo import gdal, ogr
 
+from supporting_scripts import basin_index
+from supporting_scripts import cost_model
+from supporting_scripts import execution_plan
+from supporting_scripts import intermediates
+from supporting_scripts import invest_runner
+from supporting_scripts import modis_et
+from supporting_scripts import pipeline_config
+from supporting_scripts import profiling
+from supporting_scripts import raster_output
+from supporting_scripts import run_manifest
+from supporting_scripts import shared_csv
+from supporting_scripts import work_queue
+from supporting_scripts import zonal_stats
+from supporting_scripts.basin_index import get_epsg_number
+
 gdal.UseExceptions()
-gdal.SetCacheMax(1024)
 
 # these are the args required(??) by invest. They point to the files and set some of the parameters. This file can
 # be generated from the settings window of the invest model itself. We used this as a template and modified the
@@ -38,422 +51,790 @@ args = {
 }
 
 # share_path is the path to all of the data files required by the invest model.
-# the layout is essentially the same as for Invest
-share_path = '/InVEST_Data/'
+# the layout is essentially the same as for Invest. It is set in pipeline.cfg
+share_path = pipeline_config.current().share_path
+# the monthly precip, rain events and days below freezing rasters step01 writes
+step01_path = pipeline_config.current().path_of('step01_output_path')
+
+# timing of the stages of every basin run. Only written when step02 is started with --profile
+profiler = profiling.Profiler()
+
+# the GeoPackage of all basins with their UTM geometries (see supporting_scripts/basin_index.py).
+# Only used when step02 is started with --basin-index, otherwise the shapefiles are re-projected
+basins = None
+
+# where this worker puts the clipped base layers, working shapefile and runs. Only set when
+# step02 is a --queue worker or is given --scratch, so several workers can share a node;
+# otherwise the layers go next to their sources like they always did
+scratch_path = None
+
+
+# the path of a scratch file: default, or name in the scratch folder of the worker
+def scratch_file(default, name):
+    if scratch_path is None:
+        return default
+    return scratch_path + name
+
+
+# the runs (<grdc_no>_<model>_<year>) and basins of this step02 that did not finish ok. step02
+# exits non-zero if there are any, so run_pipeline.py doesn't take the partition as done
+failed_runs = []
+
+
+# how often a --queue worker renews the leases of its claimed runs (see work_queue.py)
+HEARTBEAT_SECONDS = 60
+last_heartbeat = 0.0
+
+# the columns of the shared days below zero table
+DAYS_BELOW_ZERO_HEADER = ['watershed', 'year', 'month', 'days.below.zero']
 
 
 # creat the rain events table for the current watershed and year
-def build_rain_events_table(year, shapefile):
-    myfile = open(share_path + 'rain_events/rain_events.csv', 'w')
+def build_rain_events_table(year, shapefile, table_path):
+    myfile = open(table_path, 'w')
     wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
     wr.writerow(['month', 'events'])
 
     for events_month in range(1, 13, 1):
-        # clip it
         layer_name = shapefile.split('/')[-1].split('.')[0]
-        file_path = share_path + 'rain_events/' + str(year) + '/rain_events_' + str(
+        file_path = step01_path + 'rain_events/' + str(year) + '/rain_events_' + str(
             year) + '_' + str(events_month) + '.tif'
         if os.path.exists(file_path):
 
-            ds = gdal.Warp('', file_path,
-                           warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                           format='MEM',
-                           cutlineDSName=shapefile,
-                           cutlineLayer=layer_name)
-
-            ds_band = ds.GetRasterBand(1)
-            ds_band.ComputeStatistics(False)
-
-            stats = ds_band.GetStatistics(True, True)
-            if stats is None:
+            # the mask is only rasterized for the first month, the rest reuse it
+            zone = zonal_stats.zone_mask(shapefile, file_path)
+            stats = zonal_stats.zonal_stats(file_path, zone)
+            if stats['mean'] is None:
                 sys.exit('No stats available for layer: ' + layer_name)
 
-            wr.writerow([str(events_month), str(int(stats[2]))])
+            wr.writerow([str(events_month), str(int(stats['mean']))])
 
         else:
             print('File does not exist:\t' +  file_path)
 
-        ds = None
-
     myfile.close()
 
 
-# calculate the number of days below zero
-def get_days_below_zero(year, shapefile, ws_flag, ws):
-    if ws_flag:
-        myfile = open(share_path + 'day_below_zero.csv', 'w+')
-        wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-        wr.writerow(['watershed', 'year', 'month', 'days.below.zero'])
-    else:
-        myfile = open(share_path + 'day_below_zero.csv', 'a+')
-        wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-
+# calculate the number of days below zero. All of the workers (and partitions) of a batch
+# append to the same table, so it is never truncated here; the rows of runs done more than once
+# are dropped when step02 is done (see shared_csv.dedupe)
+def get_days_below_zero(year, shapefile, ws):
+    rows = []
     month_list = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
 
     for _month in month_list:
-        # clip it
-        layer_name = shapefile.split('/')[-1].split('.')[0]
-
-        file_path = share_path + 'below_freezing/' + str(year) + '/days_below_freezing_' \
+        file_path = step01_path + 'below_freezing/' + str(year) + '/days_below_freezing_' \
                     + str(year) + '_' + str(_month) + '.tif'
         if os.path.exists(file_path):
 
-            ds = gdal.Warp('', file_path,
-                           warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                           format='MEM',
-                           cutlineDSName=shapefile,
-                           cutlineLayer=layer_name,
-                           cropToCutline=True,
-                           cutlineBlend=2,
-                           multithread=False)
-
-            ds_band = ds.GetRasterBand(1)
-            ds_band.ComputeStatistics(False)
+            zone = zonal_stats.zone_mask(shapefile, file_path)
+            stats = zonal_stats.zonal_stats(file_path, zone)
+            if stats['mean'] is None:
+                sys.exit('No stats available for layer: ' + str(ws))
 
-            stats = ds_band.GetStatistics(True, True)
-            if stats is None:
-                sys.exit('No stats available for layer: ' + ws)
-
-            wr.writerow([str(ws), str(year), str(_month), str(int(stats[2]))])
+            rows.append([str(ws), str(year), str(_month), str(int(stats['mean']))])
 
         else:
             print 'File does not exist:\t', file_path
 
-        ds = None
-
-    myfile.close()
+    shared_csv.append_rows(share_path + 'day_below_zero.csv', DAYS_BELOW_ZERO_HEADER, rows)
 
 
-# clip the raster (global) and re-project it to a valid/correct SRS
-def clip_and_reproject(lat, lng, shapefile, rastToCut, outfile):
+# clip the raster (global) and re-project it to a valid/correct SRS. Returns the path of
+# the clipped raster, which depends on the intermediates mode (see supporting_scripts/intermediates.py)
+def clip_and_reproject(lat, lng, shapefile, rastToCut, outfile, listable=False):
     layer_name = shapefile.split('/')[-1].split('.')[0]
     epsg = get_epsg_number(float(lat), float(lng))
     ds1 = gdal.Open(rastToCut)
     ds1_band = ds1.GetRasterBand(1)
     noData = ds1_band.GetNoDataValue()
+    data_type = ds1_band.DataType
     print 'Clipping ' + rastToCut
     if noData is None:
         if 'lulc.tif' in rastToCut:
             noData = 255
         else:
             noData = -99
+    ds1 = None
 
-    ds = gdal.Warp(outfile, rastToCut,
-                   warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                   creationOptions=["TILED=YES"],
-                   dstSRS=epsg,
-                   format='GTiff',
-                   cutlineDSName=shapefile,
-                   xRes=90,
-                   yRes=90,
-                   cutlineLayer=layer_name,
-                   cropToCutline=True,
-                   cutlineBlend=2,
-                   multithread=False,
-                   srcNodata=noData,
-                   dstNodata=noData)
-
-    ds = None
-
-
-# clip and reproject the MODIS raster to match the current WS
-def clip_and_reproject_MODIS(lat, lng, shapefile, rastToCut, outfile):
+    return intermediates.warp_intermediate(outfile, rastToCut,
+                                           creation_options=raster_output.creation_options(["TILED=YES"], data_type),
+                                           listable=listable,
+                                           warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'] + execution_plan.warp_options(),
+                                           dstSRS=epsg,
+                                           cutlineDSName=shapefile,
+                                           xRes=90,
+                                           yRes=90,
+                                           cutlineLayer=layer_name,
+                                           cropToCutline=True,
+                                           cutlineBlend=2,
+                                           multithread=execution_plan.warp_multithread(),
+                                           srcNodata=noData,
+                                           dstNodata=noData)
+
+
+# clip and reproject the MODIS raster to match the current WS. The raster is read from its
+# clean copy (fill values set to nodata), which is made once if it doesn't exist yet
+def clip_and_reproject_MODIS(lat, lng, shapefile, rastToCut, outfile, listable=False):
     layer_name = shapefile.split('/')[-1].split('.')[0]
     epsg = get_epsg_number(float(lat), float(lng))
-    ds1 = gdal.Open(rastToCut, gdal.GA_Update)
-    ds1_band = ds1.GetRasterBand(1)
-    noData = ds1_band.GetNoDataValue()
     print 'Clipping ' + rastToCut
-
-    if noData is None:
-        noData = -32767
-        ds1.GetRasterBand(1).SetNoDataValue(noData)
-
-    data = ds1.ReadAsArray()
-    masked_data = ma.masked_where((data >= 32761) | (data < 0), data).filled(noData)
-    ds1.GetRasterBand(1).WriteArray(masked_data)
-
+    rastToCut = modis_et.ensure_clean_et(rastToCut)
+    noData = modis_et.NODATA
+    ds1 = gdal.Open(rastToCut)
+    data_type = ds1.GetRasterBand(1).DataType
     ds1 = None
-    ds = gdal.Warp(outfile, rastToCut,
-                   warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'],
-                   creationOptions=["TILED=YES", "COMPRESS=DEFLATE"],
-                   dstSRS=epsg,
-                   format='GTiff',
-                   cutlineDSName=shapefile,
-                   cutlineLayer=layer_name,
-                   cropToCutline=True,
-                   cutlineBlend=2,
-                   multithread=False,
-                   srcNodata=noData,
-                   dstNodata=noData)
-
-    ds = None
-
-
-# Get the correct epsg number to re-project to local UTM
-def get_epsg_number(lat, lng):
-    zone_number = int(math.floor((lng + 180) / 6) + 1)
-
-    if 56.0 <= lat < 64.0 and 3.0 <= lng < 12.0:
-        zone_number = 32
-
-    # Special zones for Svalbard
-    if 72.0 <= lat < 84.0:
-        if 0.0 <= lng < 9.0:
-            zone_number = 31;
-        elif 9.0 <= lng < 21.0:
-            zone_number = 33;
-        elif 21.0 <= lng < 33.0:
-            zone_number = 35
-        elif 33.0 <= lng < 42.0:
-            zone_number = 37
-
-    if lat > 0:
-        return "EPSG:" + str(32600 + zone_number)
-    else:
-        return "EPSG:" + str(32700 + zone_number)
+
+    return intermediates.warp_intermediate(outfile, rastToCut,
+                                           creation_options=raster_output.creation_options(
+                                               ["TILED=YES", "COMPRESS=DEFLATE"], data_type) +
+                                                            execution_plan.compress_options(),
+                                           listable=listable,
+                                           warpOptions=['CUTLINE_ALL_TOUCHED=TRUE'] + execution_plan.warp_options(),
+                                           dstSRS=epsg,
+                                           cutlineDSName=shapefile,
+                                           cutlineLayer=layer_name,
+                                           cropToCutline=True,
+                                           cutlineBlend=2,
+                                           multithread=execution_plan.warp_multithread(),
+                                           srcNodata=noData,
+                                           dstNodata=noData)
+
+
+# the DEM covering the WMO region of the watershed
+def dem_for_row(row):
+    if getattr(row, "wmo_reg") == 4:
+        return root_path + 'dem/DEM_na.tif'
+    elif getattr(row, "wmo_reg") == 3:
+        return root_path + 'dem/DEM_sa.tif'
 
 
 # This clips all of the rasters to match the current WS shapefile
 def clip_base_rasters(lat, lng):
     global cutline_and_ws_shapefile, dest
     # make sure the shapefile exists - if not log it and skip
-    if os.path.exists(cutline_and_ws_shapefile):
+    if basins is not None or os.path.exists(cutline_and_ws_shapefile):
 
         # reproject shapefile
+        working_shp = scratch_file(ws_base_path + '~working_shp.shp', '~working_shp.shp')
         driver = ogr.GetDriverByName('ESRI Shapefile')
-        if os.path.exists(ws_base_path + '~working_shp.shp'):
-            driver.DeleteDataSource(ws_base_path + '~working_shp.shp')
-
-        srcDS = gdal.OpenEx(cutline_and_ws_shapefile)
-        ds = gdal.VectorTranslate(ws_base_path + '~working_shp.shp',
-                                  srcDS=srcDS,
-                                  format='ESRI Shapefile',
-                                  reproject=True,
-                                  dstSRS=get_epsg_number(lat, lng))
-
-        # Dereference and close dataset, then reopen.
-        del ds
-
-        cutline_and_ws_shapefile = ws_base_path + '~working_shp.shp'
+        if os.path.exists(working_shp):
+            driver.DeleteDataSource(working_shp)
+
+        with profiler.span('reproject_shapefile', grdc_no=grdc_no):
+            if basins is not None:
+                # the basin index already has the geometry in its UTM zone
+                basins.write_aoi(grdc_no, working_shp)
+            else:
+                srcDS = gdal.OpenEx(cutline_and_ws_shapefile)
+                ds = gdal.VectorTranslate(working_shp,
+                                          srcDS=srcDS,
+                                          format='ESRI Shapefile',
+                                          reproject=True,
+                                          dstSRS=get_epsg_number(lat, lng))
+
+                # Dereference and close dataset, then reopen.
+                del ds
+
+        cutline_and_ws_shapefile = working_shp
         args['aoi_path'] = cutline_and_ws_shapefile
 
         # dem
         # get the correct DEM and clip it
-        if getattr(row, "wmo_reg") == 4:
-            dem = root_path + 'dem/DEM_na.tif'
-        elif getattr(row, "wmo_reg") == 3:
-            dem = root_path + 'dem/DEM_sa.tif'
-
-        dest = root_path + 'dem/dem_clipped.tif'
-        clip_and_reproject(lat, lng,
-                           shapefile=cutline_and_ws_shapefile,
-                           rastToCut=dem,
-                           outfile=dest)
-        args['dem_raster_path'] = dest
+        dem = dem_for_row(row)
+
+        dest = scratch_file(root_path + 'dem/dem_clipped.tif', 'dem_clipped.tif')
+        args['dem_raster_path'] = clip_and_reproject(lat, lng,
+                                                     shapefile=cutline_and_ws_shapefile,
+                                                     rastToCut=dem,
+                                                     outfile=dest)
 
         # lulc
-        dest = root_path + 'lulc/lulc_clipped.tif'
-        clip_and_reproject(lat, lng,
-                           shapefile=cutline_and_ws_shapefile,
-                           rastToCut=root_path + 'lulc/lulc.tif',
-                           outfile=dest)
-        args['lulc_raster_path'] = dest
+        dest = scratch_file(root_path + 'lulc/lulc_clipped.tif', 'lulc_clipped.tif')
+        args['lulc_raster_path'] = clip_and_reproject(lat, lng,
+                                                      shapefile=cutline_and_ws_shapefile,
+                                                      rastToCut=root_path + 'lulc/lulc.tif',
+                                                      outfile=dest)
 
         # soils
-        dest = root_path + 'soils/soils_clipped.tif'
-        clip_and_reproject(lat, lng,
-                           shapefile=cutline_and_ws_shapefile,
-                           rastToCut=root_path + 'soils/soils.tif',
-                           outfile=dest)
-        args['soil_group_path'] = dest
+        dest = scratch_file(root_path + 'soils/soils_clipped.tif', 'soils_clipped.tif')
+        args['soil_group_path'] = clip_and_reproject(lat, lng,
+                                                     shapefile=cutline_and_ws_shapefile,
+                                                     rastToCut=root_path + 'soils/soils.tif',
+                                                     outfile=dest)
     else:
         raise ValueError('###### Missing shape file')
 
 
-def clip_et_layer(lat, lng):
+# clips the 12 monthly ET layers of the year into et_dir. Returns the paths written
+def clip_et_layer(lat, lng, et_dir, year):
     global month, dest, src
+    written = []
     # et
     for month in range(1, 13, 1):
-        dest = root_path + 'et/working_dir/et_{0}.tif'.format(str(month))
+        dest = et_dir + 'et_{0}.tif'.format(str(month))
         src = root_path + 'et/{1}/MOD16A2_ET_0.05deg_GEO_{1}M{0:02d}.tif'.format(
             month, year)
-        clip_and_reproject_MODIS(lat, lng,
-                                 shapefile=cutline_and_ws_shapefile,
-                                 rastToCut=src,
-                                 outfile=dest)
+        written.append(clip_and_reproject_MODIS(lat, lng,
+                                                shapefile=cutline_and_ws_shapefile,
+                                                rastToCut=src,
+                                                outfile=dest,
+                                                listable=True))
+    return written
 
 
-def clip_precip_layer(lat, lng):
+# clips the 12 monthly precip layers of the year and model into precip_dir. Returns the paths written
+def clip_precip_layer(lat, lng, precip_dir, year, model):
     global month, dest, src
+    written = []
     # precip
     for month in range(1, 13, 1):
-        dest = root_path + 'precip/working_dir/precip_{0}.tif'.format(str(month))
-        src = root_path + 'precip/{2}/{1}/{2}_h2o_{1}_{0}.tif'.format(month, year, model)
-        clip_and_reproject(lat, lng,
-                           shapefile=cutline_and_ws_shapefile,
-                           rastToCut=src,
-                           outfile=dest)
+        dest = precip_dir + 'precip_{0}.tif'.format(str(month))
+        src = step01_path + 'precip/{2}/{1}/{2}_h2o_{1}_{0}.tif'.format(month, year, model)
+        written.append(clip_and_reproject(lat, lng,
+                                          shapefile=cutline_and_ws_shapefile,
+                                          rastToCut=src,
+                                          outfile=dest,
+                                          listable=True))
+    return written
+
+
+# every InVEST run gets its own folder for its monthly ET/precip layers, rain events table
+# and workspace, so several runs can go on at the same time without stepping on each other
+def job_dir_for(grdc_no, model, year):
+    return scratch_file(root_path, '') + 'jobs/{0}_{1}_{2}/'.format(str(grdc_no), model, str(year))
+
+
+# the fingerprint of everything a run reads. If it is unchanged and the run finished ok
+# before, a resumed batch skips it
+def job_fingerprint(row, shapefile, model, year, job_args):
+    paths = [shapefile, dem_for_row(row) or '',
+             root_path + 'lulc/lulc.tif',
+             root_path + 'soils/soils.tif',
+             job_args['biophysical_table_path']]
+    for _month in range(1, 13, 1):
+        paths.append(root_path + 'et/{1}/MOD16A2_ET_0.05deg_GEO_{1}M{0:02d}.tif'.format(_month, year))
+        paths.append(step01_path + 'precip/{2}/{1}/{2}_h2o_{1}_{0}.tif'.format(_month, year, model))
+        paths.append(step01_path + 'rain_events/{0}/rain_events_{0}_{1}.tif'.format(year, _month))
+
+    params = dict((key, job_args[key]) for key in ['alpha_m', 'beta_i', 'gamma', 'threshold_flow_accumulation'])
+    return run_manifest.fingerprint(paths, params)
+
+
+# the routing outputs that only depend on the DEM are shared by all runs of a basin
+def routing_cache_dir_for(grdc_no):
+    return scratch_file(root_path, '') + 'routing_cache/{0}/'.format(str(grdc_no))
+
+
+# the shapefile of a watershed
+def ws_shapefile_for(grdc_no):
+    # return ws_base_path + 'grdc_basins_smoothed_md_no_' + str(getattr(row, "Watershed")) + '.shp'
+    return ws_base_path + 'grdc_basins_smoothed_md_no_' + str(grdc_no) + '.shp'
+
+
+# the settings shared by all of the runs of a basin
+def basin_settings():
+    basin_args = dict(args)
+    basin_args['biophysical_table_path'] = root_path + 'biophysical/biophysical.csv'
+    # set to 125 pixels (dem is about 90m pixel size)
+    basin_args['threshold_flow_accumulation'] = 125
+    return basin_args
+
+
+# make the watershed of basin_row the current one and clip the base layers for it. Returns
+# the size of the clipped DEM (if profiling)
+def start_basin(basin_row, basin_args):
+    global row, grdc_no, cutline_and_ws_shapefile
+    row = basin_row
+    grdc_no = getattr(row, 'grdc_no')
+
+    # get the shapefile for the watershed
+    cutline_and_ws_shapefile = ws_shapefile_for(grdc_no)
+    print cutline_and_ws_shapefile
+
+    with profiler.span('clip_base', grdc_no=grdc_no) as span:
+        clip_base_rasters(getattr(row, 'lat'), getattr(row, 'long'))
+        # the size of the DEM is what drives the InVEST run time
+        basin_size = profiling.raster_size(args['dem_raster_path']) if profiler.enabled else {}
+        span.update(basin_size)
+    for key in ['aoi_path', 'dem_raster_path', 'lulc_raster_path', 'soil_group_path']:
+        basin_args[key] = args[key]
+    return basin_size
+
+
+# the clipped base layers and watershed masks are shared by all years of a basin, so all of
+# its runs have to be done before they are released
+def end_basin(basin_grdc_no):
+    pool.wait()
+    intermediates.release()
+    zonal_stats.clear_cache()
+    shutil.rmtree(routing_cache_dir_for(basin_grdc_no), ignore_errors=True)
+
+
+# clip the ET and precip layers of one run of the current basin and build its tables. Returns
+# the job for the InVEST pool
+def stage_job(basin_args, basin_size, year, model, fingerprint):
+    lat_ = getattr(row, 'lat')
+    lng_ = getattr(row, 'long')
+
+    job_dir = job_dir_for(grdc_no, model, year)
+    for sub_dir in ['et/', 'precip/', 'workspace/']:
+        if not os.path.isdir(job_dir + sub_dir):
+            os.makedirs(job_dir + sub_dir)
 
+    # et
+    with profiler.span('clip_et', grdc_no=grdc_no, year=year, model=model) as span:
+        written = clip_et_layer(lat_, lng_, job_dir + 'et/', year)
+        if profiler.enabled:
+            span.update(profiling.raster_size(written[0]))
 
-# this is a HUGE HACK to deal with the fact the InVEST hangs sometimes.
-# we just kill the process if things take too long. The main reason for InVEST
-# hanging seems to be that it can't figure out the flow for a DEM or the WS shapefile
-# has bad data in it.
-def timeout_handler(num, stack):
-    print("Received SIGALRM")
-    raise Exception("InVEST too slow... infinite loop")
+    # precip
+    with profiler.span('clip_precip', grdc_no=grdc_no, year=year, model=model) as span:
+        written = clip_precip_layer(lat_, lng_, job_dir + 'precip/', year, model)
+        if profiler.enabled:
+            span.update(profiling.raster_size(written[0]))
+
+    with profiler.span('zonal_stats', grdc_no=grdc_no, year=year, model=model):
+        # build the rain_events.csv file for this run
+        build_rain_events_table(year, cutline_and_ws_shapefile, job_dir + 'rain_events.csv')
+
+        # days below zero
+        if model == 'snow17':
+            get_days_below_zero(year, cutline_and_ws_shapefile, grdc_no)
+
+    # update natcap settings to reflect correct paths
+    job_args = dict(basin_args)
+    job_args['precip_dir'] = job_dir + 'precip/'
+    job_args['et0_dir'] = job_dir + 'et/'
+    job_args['rain_events_table_path'] = job_dir + 'rain_events.csv'
+    job_args['results_suffix'] = '_{0}_{1}_{2}'.format(str(grdc_no), model, str(year))
+    job_args['workspace_dir'] = job_dir + 'workspace'
+
+    print(job_args)
+
+    job = {'grdc_no': grdc_no, 'model': model, 'year': year, 'fingerprint': fingerprint,
+           'job_dir': job_dir, 'args': job_args, 'pixels': basin_size.get('pixels'),
+           'timeout': costs.timeout(getattr(row, 'area'), timeout_factor, invest_timeout)}
+    if use_routing_cache:
+        job['routing_cache_dir'] = routing_cache_dir_for(grdc_no)
+    if cprofile_dir is not None:
+        job['cprofile_path'] = os.path.join(cprofile_dir, job_args['results_suffix'][1:] + '.prof')
+    if summary_table is not None:
+        job['summary_table'] = summary_table
+    return job
+
+
+# called when an InVEST run is done (ok or not). Keep the qf rasters, get rid of the rest
+# and record the outcome in the run manifest
+def finish_job(outcome):
+    folder = outcome.job['args']['workspace_dir'] + '/intermediate_outputs'
+    dst = root_path + 'final_tiffs'
+    outputs = []
+    if os.path.isdir(folder):
+        for fname in os.listdir(folder):
+            if os.path.isfile(os.path.join(folder, fname)) and fname.startswith('qf'):
+                # the scratch folder may be on another file system than final_tiffs
+                shutil.move(os.path.join(folder, fname), os.path.join(dst, fname))
+                outputs.append(fname)
+
+    shutil.rmtree(outcome.job['job_dir'], ignore_errors=True)
+
+    manifest.record(outcome.job['grdc_no'], outcome.job['model'], outcome.job['year'],
+                    outcome.status, outcome.job['fingerprint'], sorted(outputs))
+    if outcome.status != 'ok':
+        failed_runs.append(outcome.job['args']['results_suffix'][1:])
+
+    profiler.record('invest', outcome.duration, status=outcome.status, attempts=outcome.attempts,
+                    grdc_no=outcome.job['grdc_no'], model=outcome.job['model'], year=outcome.job['year'],
+                    pixels=outcome.job.get('pixels'))
+
+
+# in --queue mode the outcome also goes back to the work queue: done, or up for another try
+def finish_queue_job(outcome):
+    finish_job(outcome)
+    if outcome.status == 'ok':
+        queue.complete(outcome.job['queue_job'], worker_id)
+    else:
+        queue.release(outcome.job['queue_job'], worker_id)
+
+
+# keep the leases of the claimed jobs of this worker alive while they wait and run
+def send_heartbeats(jobs):
+    global last_heartbeat
+    if time.time() - last_heartbeat < HEARTBEAT_SECONDS:
+        return
+    last_heartbeat = time.time()
+    for job in jobs:
+        if not queue.heartbeat(job['queue_job'], worker_id):
+            print 'Lost the lease of ' + job['args']['results_suffix'][1:]
+
+
+# fill the work queue with every run of the basins, biggest (predicted) runs first
+def populate_queue(basin_rows):
+    jobs = []
+    for basin_row in basin_rows.itertuples(index=True, name='Pandas'):
+        basin_grdc_no = getattr(basin_row, 'grdc_no')
+        basin_args = basin_settings()
+        for year in year_list:
+            for model in precip_model:
+                if resume:
+                    fingerprint = job_fingerprint(basin_row, ws_shapefile_for(basin_grdc_no), model, year, basin_args)
+                    if manifest.is_complete(basin_grdc_no, model, year, fingerprint, root_path + 'final_tiffs'):
+                        continue
+                jobs.append((basin_grdc_no, model, year, costs.predict(getattr(basin_row, 'area'))))
+    queue.populate(jobs)
+    print 'Queued ' + str(len(jobs)) + ' runs in ' + queue.path
+
+
+# the main loop of a --queue worker. Claims runs until the queue is empty, staying on the same
+# basin for as long as it has runs left so its clipped base layers are re-used
+def run_queue_worker(stations):
+    current = None
+    basin_args = None
+    basin_size = {}
+    while True:
+        claimed = queue.claim(worker_id, prefer_grdc_no=current)
+        if claimed is None:
+            break
 
+        try:
+            # waiting on the runs of the last basin and clipping can take much longer than the
+            # lease, and the pool only sends the heartbeats of the jobs it was handed
+            with work_queue.LeaseKeeper(queue.path, worker_id, [claimed], HEARTBEAT_SECONDS):
+                basin_row = stations[claimed['grdc_no']]
+                if claimed['grdc_no'] != current:
+                    if current is not None:
+                        end_basin(grdc_no)
+                    current = None
+                    basin_args = basin_settings()
+                    basin_size = start_basin(basin_row, basin_args)
+                    current = claimed['grdc_no']
+
+                fingerprint = job_fingerprint(row, ws_shapefile_for(grdc_no), claimed['model'], claimed['year'],
+                                              basin_args)
+                job = stage_job(basin_args, basin_size, claimed['year'], claimed['model'], fingerprint)
+                job['queue_job'] = claimed
+
+            manifest.record(grdc_no, claimed['model'], claimed['year'], 'running', fingerprint)
+            pool.submit(job)
+
+        except (RuntimeError, ValueError, KeyError) as e:
+            print("#### Houston, we have a problem!!")
+            print e
+            queue.release(claimed, worker_id)
+            failed_runs.append('{0}_{1}_{2}'.format(claimed['grdc_no'], claimed['model'], claimed['year']))
+
+    if current is not None:
+        end_basin(grdc_no)
+    pool.wait()
+    print 'Queue ' + queue.path + ' is empty: ' + str(queue.counts())
+
+
+# the main loop of a -b/-e (or --shard) batch: all of the runs of the basins, one basin after
+# the other
+def run_batch(basin_rows):
+    # loop through each of the randomly selected watersheds
+    # doing raw runoff and snow17 modelled runoff for each year
+    for basin_row in basin_rows.itertuples(index=True, name='Pandas'):
 
+        basin_grdc_no = getattr(basin_row, 'grdc_no')
+        basin_args = basin_settings()
+
+        # work out which runs are still to do before clipping anything
+        jobs = []
+        for year in year_list:
+            for model in precip_model:
+                fingerprint = job_fingerprint(basin_row, ws_shapefile_for(basin_grdc_no), model, year, basin_args)
+                if resume and manifest.is_complete(basin_grdc_no, model, year, fingerprint, root_path + 'final_tiffs'):
+                    print 'Already done, skipping: ' + str(basin_grdc_no) + ' ' + model + ' ' + str(year)
+                    continue
+                jobs.append((year, model, fingerprint))
+
+        if not jobs:
+            continue
+
+        try:
+            try:
+                basin_size = start_basin(basin_row, basin_args)
+
+                for year, model, fingerprint in jobs:
+
+                    try:
+                        job = stage_job(basin_args, basin_size, year, model, fingerprint)
+                        manifest.record(grdc_no, model, year, 'running', fingerprint)
+                        pool.submit(job)
+
+                    except RuntimeError as re:
+                        print("#### Houston, we have a problem!!")
+                        print re
+                        failed_runs.append('{0}_{1}_{2}'.format(str(basin_grdc_no), model, str(year)))
+
+                end_basin(grdc_no)
+
+            except ValueError as ve:
+                # sys.exit(ve)
+                print ve
+                failed_runs.append(str(basin_grdc_no))
+
+        except RuntimeError as re:
+            # sys.exit(re)
+            print re
+            failed_runs.append(str(basin_grdc_no))
+
+
+usage = 'test.py -b <beginRow> -e <endRow> [--intermediates gtiff|vrt|vsimem] [--spill-mb <MB>] ' \
+        '[--invest-workers <N>] [--invest-timeout <seconds>] [--invest-retries <N>] ' \
+        '[-r|--resume] [--manifest <sqlite file>] [--profile <jsonl file>] [--cprofile-dir <dir>] ' \
+        '[--no-routing-cache] [--cores <N>] [--memory-mb <MB>] [--workers <N>] [--gdal-cache-mb <MB>] ' \
+        '[--warp-threads <N>] [--compress-threads <N>] [--basin-index <gpkg>] ' \
+        '[--shard <k>/<n> (k is 0 to n-1)] [--cost-model <json file>] [--timeout-factor <x>] [--queue <sqlite file> [--populate] [--worker-id <id>]] ' \
+        '[--summary-table <csv> | --no-summary] [--raster-profile gtiff|cog] [--raster-codec <codec>] ' \
+        '[--raster-level <level>] [--years <2000-2014|2003,2007>] [--models <snow17,raw>] [--scratch <dir>]'
 
 # this is the main runner. It loops through each combination of
 # WS, YEAR, & MODEL, clipping the rasters as needed, updating file locations
-# in the args list and running the InVEST model for each one.
+# in the args list and handing the InVEST run over to the worker pool.
+#
+# With --queue it is one worker of a (multi node) batch instead: it takes its runs from a work
+# queue on shared storage (see supporting_scripts/work_queue.py) until there are none left.
+# Fill the queue once with --populate (the -b/-e/--shard basins, or all of them), then start
+# as many workers as you like, on as many nodes as you like, also in the middle of the batch:
+#
+#   python step02_swym_runner.py --queue /InVEST_Data/work_queue.sqlite --populate
+#   python step02_swym_runner.py --queue /InVEST_Data/work_queue.sqlite
 if __name__ == '__main__':
     argv = sys.argv[1:]
 
     df_start = -1
     df_stop = -1
+    # the node resources we may use. Anything not set is detected (see execution_plan.py)
+    plan_cores = None
+    plan_memory_mb = None
+    plan_gdal_cache_mb = None
+    plan_warp_threads = None
+    plan_compress_threads = None
+    invest_workers = None
+    # InVEST hangs sometimes (mostly when it can't figure out the flow for a DEM or the WS
+    # shapefile has bad data in it). Runs taking longer than this are killed
+    invest_timeout = 5 * 60
+    # runs get timeout_factor times their predicted run time (see cost_model.py), but at
+    # least invest_timeout
+    timeout_factor = 3.0
+    invest_retries = 0
+    # instead of -b/-e rows, take shard k of n shards of (predicted) equal run time. k counts
+    # from 0, so the shards of --shard x/4 are 0/4, 1/4, 2/4 and 3/4
+    shard = None
+    # the cost model the shards are made with. Every node of a sharded batch has to make the
+    # same shards, so the model can't be refitted to invest_runs.csv (which grows while the
+    # batch runs) by every node: it is fitted and saved to this file if it doesn't exist yet,
+    # and loaded from it otherwise. Without it, the shards are made on the basin area alone
+    cost_model_path = None
+    # skip the runs the manifest says are already done
+    resume = False
+    manifest_path = share_path + 'run_manifest.sqlite'
+    # cProfile stats of every InVEST run are dumped here (if set)
+    cprofile_dir = None
+    # re-use the DEM-only routing outputs (flow direction, accumulation, streams, slope) across
+    # the years and models of a basin
+    use_routing_cache = True
+    # the worker appends the qf sums of every run here (the rows step03 makes from the archives)
+    summary_table = share_path + 'qf_summary.csv'
+    # work queue shared by all workers of a batch (if set)
+    queue_path = None
+    populate = False
+    worker_id = socket.gethostname() + ':' + str(os.getpid())
+    # the years and models of the runs; pipeline.cfg unless given (run_pipeline.py gives the
+    # ones it was asked to run)
+    year_list = pipeline_config.current().years
+    precip_model = pipeline_config.current().models
     try:
-        opts, args2 = getopt.getopt(argv, "b:e:", ["begin=", "end="])
+        opts, args2 = getopt.getopt(argv, "b:e:r", ["begin=", "end=", "intermediates=", "spill-mb=",
+                                                    "invest-workers=", "invest-timeout=", "invest-retries=",
+                                                    "resume", "manifest=", "profile=", "cprofile-dir=",
+                                                    "no-routing-cache", "cores=", "memory-mb=", "workers=",
+                                                    "gdal-cache-mb=", "warp-threads=", "compress-threads=",
+                                                    "basin-index=", "shard=", "cost-model=", "timeout-factor=",
+                                                    "queue=", "populate", "worker-id=",
+                                                    "summary-table=", "no-summary", "raster-profile=",
+                                                    "raster-codec=", "raster-level=", "years=", "models=",
+                                                    "scratch="])
     except getopt.GetoptError:
-        print 'test.py -b <beginRow> -e <endRow>'
+        print usage
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print 'test.py -b <beginRow> -e <endRow>'
+            print usage
             sys.exit()
         elif opt in ("-b", "--beginRow"):
             df_start = int(arg)
         elif opt in ("-e", "--endRow"):
             df_stop = int(arg)
+        elif opt == '--intermediates':
+            # where the clipped layers go: on disk (gtiff), lazily warped (vrt) or in memory (vsimem)
+            intermediates.configure(new_mode=arg)
+        elif opt == '--spill-mb':
+            # anything bigger than this is always written to disk as a GTiff
+            intermediates.configure(spill_mb=arg)
+        elif opt in ('--invest-workers', '--workers'):
+            invest_workers = int(arg)
+        elif opt == '--cores':
+            plan_cores = int(arg)
+        elif opt == '--memory-mb':
+            plan_memory_mb = int(arg)
+        elif opt == '--gdal-cache-mb':
+            plan_gdal_cache_mb = int(arg)
+        elif opt == '--warp-threads':
+            plan_warp_threads = int(arg)
+        elif opt == '--compress-threads':
+            plan_compress_threads = int(arg)
+        elif opt == '--basin-index':
+            basins = basin_index.BasinIndex(arg)
+        elif opt == '--shard':
+            try:
+                shard = [int(part) for part in arg.split('/')]
+            except ValueError:
+                shard = None
+            if shard is None or len(shard) != 2 or shard[1] < 1 or not 0 <= shard[0] < shard[1]:
+                print '--shard takes k/n with 0 <= k < n (k counts from 0), not ' + arg
+                print usage
+                sys.exit(2)
+        elif opt == '--cost-model':
+            cost_model_path = arg
+        elif opt == '--timeout-factor':
+            timeout_factor = float(arg)
+        elif opt == '--invest-timeout':
+            invest_timeout = float(arg)
+        elif opt == '--invest-retries':
+            invest_retries = int(arg)
+        elif opt in ("-r", "--resume"):
+            resume = True
+        elif opt == '--manifest':
+            manifest_path = arg
+        elif opt == '--profile':
+            profiler = profiling.Profiler(arg)
+        elif opt == '--cprofile-dir':
+            cprofile_dir = arg
+            if not os.path.isdir(cprofile_dir):
+                os.makedirs(cprofile_dir)
+        elif opt == '--no-routing-cache':
+            use_routing_cache = False
+        elif opt == '--queue':
+            queue_path = arg
+        elif opt == '--populate':
+            populate = True
+        elif opt == '--worker-id':
+            worker_id = arg
+        elif opt == '--summary-table':
+            summary_table = arg
+        elif opt == '--no-summary':
+            summary_table = None
+        elif opt == '--raster-profile':
+            # how the clipped layers are compressed: gtiff (as always) or cog (see raster_output.py)
+            raster_output.configure(profile=arg)
+        elif opt == '--raster-codec':
+            raster_output.configure(codec=arg)
+        elif opt == '--raster-level':
+            raster_output.configure(level=arg)
+        elif opt == '--years':
+            year_list = pipeline_config.parse_years(arg)
+        elif opt == '--models':
+            precip_model = arg.replace(',', ' ').split()
+        elif opt == '--scratch':
+            # a folder of its own for the clipped layers and runs, so several step02 can run at once
+            scratch_path = os.path.join(arg, '')
+    # sets the GDAL cache and threads of this process; the InVEST workers inherit them
+    plan = execution_plan.configure(cores=plan_cores, memory_mb=plan_memory_mb, workers=invest_workers,
+                                    gdal_cache_mb=plan_gdal_cache_mb, warp_threads=plan_warp_threads,
+                                    compress_threads=plan_compress_threads)
+    print plan
+
     print 'First row to process is:"', df_start
     print 'Lat row to process is:"', df_stop
 
-    ws_flag = True
     df = pd.read_csv(share_path + 'GRDC_Stations.csv').sort_values('area').query('area >= 10')
     df_len = len(df)
 
+    ws_base_path = share_path + 'watershed_shp/'
+    root_path = share_path + ''
+
+    # predicted run times, fitted to the runs done so far (or the saved model, the same on
+    # every node)
+    if cost_model_path is not None:
+        costs = cost_model.shared_model(cost_model_path, share_path + 'invest_runs.csv',
+                                        share_path + 'GRDC_Stations.csv')
+    elif os.path.exists(share_path + 'invest_runs.csv'):
+        costs = cost_model.fit_from_runs(share_path + 'invest_runs.csv', share_path + 'GRDC_Stations.csv')
+    else:
+        costs = cost_model.CostModel()
+    print 'Cost model (fitted to ' + str(costs.runs) + ' runs): seconds = exp(' + str(costs.intercept) + \
+          ') * area ** ' + str(costs.slope)
+    basin_cost = dict((index, costs.predict(area) * len(year_list) * len(precip_model))
+                      for index, area in zip(df.index, df['area']))
+
     rand_sample = pd.DataFrame()
 
-    if df_stop >= df_len:
+    if shard is not None:
+        # every shard gets about the same total predicted run time. The costs have to be the
+        # same on every node: those of the saved model, or else the basin areas
+        if cost_model_path is not None:
+            shard_cost = basin_cost
+        else:
+            shard_cost = dict(zip(df.index, df['area']))
+        rand_sample = df.loc[cost_model.lpt_schedule(shard_cost, shard[1])[shard[0]]]
+    elif queue_path is not None and df_start < 0 and df_stop < 0:
+        # the whole table goes into the queue
+        rand_sample = df
+    elif df_stop >= df_len:
         rand_sample = df[df_start:]
     else:
         rand_sample = df[df_start:df_stop]
 
-    print rand_sample
-
-    ws_base_path = share_path + 'watershed_shp/'
-    root_path = share_path + ''
-    year_list = range(2000, 2014 + 1, 1)
-
-    # year_list = [2007]
-    precip_model = ['snow17', 'raw']
-
-    # loop through each of the randomly selected watersheds
-    # doing raw runoff and snow17 modelled runoff for each year
-    for row in rand_sample.itertuples(index=True, name='Pandas'):
+    # longest basins first, so the batch doesn't end waiting on one big basin
+    rand_sample = rand_sample.loc[sorted(rand_sample.index, key=lambda index: -basin_cost[index])]
 
-        grdc_no = getattr(row, 'grdc_no')
-        # grdc_no = getattr(row, 'Watershed')
-        lat_ = getattr(row, 'lat')
-        lng_ = getattr(row, 'long')
+    print rand_sample
 
-        # get the shapefile for the watershed
-        # cutline_and_ws_shapefile = ws_base_path + 'grdc_basins_smoothed_md_no_' + str(
-        #     getattr(row, "Watershed")) + '.shp'
-        cutline_and_ws_shapefile = ws_base_path + 'grdc_basins_smoothed_md_no_' + str(
-            getattr(row, "grdc_no")) + '.shp'
+    manifest = run_manifest.RunManifest(manifest_path)
+
+    if queue_path is not None:
+        queue = work_queue.WorkQueue(queue_path)
+        if populate:
+            populate_queue(rand_sample)
+
+        # workers sharing a node (and the shared storage) must not overwrite each others layers
+        if scratch_path is None:
+            scratch_path = root_path + 'scratch/' + worker_id.replace(':', '_').replace('/', '_') + '/'
+    if scratch_path is not None and not os.path.isdir(scratch_path):
+        os.makedirs(scratch_path)
+
+    # the outcome (ok/timeout/error and duration) of every run ends up in invest_runs.csv
+    pool = invest_runner.InvestPool(max_workers=plan.workers,
+                                    timeout=invest_timeout,
+                                    retries=invest_retries,
+                                    log_path=share_path + 'invest_runs.csv',
+                                    on_done=finish_job if queue_path is None else finish_queue_job,
+                                    on_tick=None if queue_path is None else send_heartbeats)
+
+    if queue_path is not None:
+        stations = dict((str(getattr(station, 'grdc_no')), station)
+                        for station in df.itertuples(index=True, name='Pandas'))
+        run_queue_worker(stations)
+        shutil.rmtree(scratch_path, ignore_errors=True)
+        queue.close()
+    else:
+        run_batch(rand_sample)
 
-        print cutline_and_ws_shapefile
+    pool.wait()
+    manifest.close()
 
-        try:
-            try:
-                clip_base_rasters(lat_, lng_)
-
-                for year in year_list:
-
-                    for model in precip_model:
-
-                        try:
-                            # et
-                            clip_et_layer(lat_, lng_)
-
-                            # precip
-                            clip_precip_layer(lat_, lng_)
-
-                            # build the rain_events.csv file for this run
-                            build_rain_events_table(year, cutline_and_ws_shapefile)
-
-                            # days below zero
-                            if model == 'snow17':
-                                get_days_below_zero(year, cutline_and_ws_shapefile, ws_flag, grdc_no)
-
-                            ws_flag = False
-
-                            # update natcap settings to reflect correct paths
-                            args['precip_dir'] = root_path + 'precip/working_dir/'
-                            args['et0_dir'] = root_path + 'et/working_dir/'
-                            args['rain_events_table_path'] = root_path + 'rain_events/rain_events.csv'
-                            args['biophysical_table_path'] = root_path + 'biophysical/biophysical.csv'
-                            # set to 125 pixels (dem is about 90m pixel size)
-                            args['threshold_flow_accumulation'] = 125
-                            args['results_suffix'] = '_{0}_{1}_{2}'.format(str(grdc_no), model, str(year))
-                            args['workspace_dir'] = root_path + 'workspace'
-
-                            print(args)
-
-                            signal.signal(signal.SIGALRM, timeout_handler)
-                            signal.alarm(5 * 60)  # give it ten minutes then time it out
-
-                            try:
-                                natcap.invest.seasonal_water_yield.seasonal_water_yield.execute(args)
-                            except Exception as ex:
-                                if "InVEST too slow... infinite loop" in ex:
-                                    print(ex)
-                                    pass
-                                else:
-                                    print(ex)
-                            finally:
-                                print "do nothing"
-                                signal.alarm(0)
-
-                        except RuntimeError as re:
-                            print("#### Houston, we have a problem!!")
-                            print re
-                            pass
-
-                    # do some cleanup
-                    print "Cleaning things up a bit..."
-
-                    folder = root_path + 'workspace'
-                    for the_file in os.listdir(folder):
-                        file_path = os.path.join(folder, the_file)
-                        try:
-                            if os.path.isfile(file_path):
-                                os.remove(file_path)
-                        except Exception as e:
-                            print(e)
-
-                    folder = root_path + 'workspace/intermediate_outputs'
-                    for the_file in os.listdir(folder):
-                        if not the_file.startswith('qf'):
-                            file_path = os.path.join(folder, the_file)
-                            try:
-                                if os.path.isfile(file_path):
-                                    os.remove(file_path)
-                            except Exception as e:
-                                print(e)
-
-                    dst = root_path + 'final_tiffs'
-                    for fname in os.listdir(folder):
-                        if os.path.isfile(os.path.join(folder, fname)) and fname.startswith('qf'):
-                            os.rename(os.path.join(folder, fname), os.path.join(dst, fname))
+    # one row per watershed, year and month, also for runs that were done again
+    dropped = shared_csv.dedupe(share_path + 'day_below_zero.csv', DAYS_BELOW_ZERO_HEADER[:3])
+    if dropped:
+        print 'Dropped ' + str(dropped) + ' repeated rows from ' + share_path + 'day_below_zero.csv'
 
-            except ValueError as ve:
-                # sys.exit(ve)
-                pass
+    if profiler.enabled:
+        profiling.summarize(profiler.path)
 
-        except RuntimeError as re:
-            # sys.exit(re)
-            pass
+    if failed_runs:
+        print str(len(failed_runs)) + ' runs or basins failed: ' + ' '.join(failed_runs)
+        sys.exit(1)
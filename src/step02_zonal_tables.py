@@ -0,0 +1,85 @@
+"""
+Rain events and days below zero for all of the GRDC basins in one pass.
+
+step02 builds these tables one basin at a time. This rasterizes all of the basins into a
+stack of label rasters on the forcing grid once and then reads every monthly raster a single
+time, reducing it for all of the basins with np.bincount. The output is a tidy table with
+one row per (basin, variable, year, month, stat).
+"""
+
+import getopt
+import os
+import sys
+
+import pandas as pd
+
+from supporting_scripts import pipeline_config
+from supporting_scripts import zonal_stats
+
+share_path = pipeline_config.current().share_path
+ws_base_path = share_path + 'watershed_shp/'
+year_list = pipeline_config.current().years
+# the monthly rasters step01 writes
+step01_path = pipeline_config.current().path_of('step01_output_path')
+
+# variable name -> monthly raster path pattern ({0} is the year, {1} the month)
+variables = {
+    'rain_events': step01_path + 'rain_events/{0}/rain_events_{0}_{1}.tif',
+    'days_below_zero': step01_path + 'below_freezing/{0}/days_below_freezing_{0}_{1}.tif',
+}
+
+
+def build_zonal_table(basins, years):
+    rows = []
+    labels = None
+
+    for variable in sorted(variables):
+        for year in years:
+            for month in range(1, 13, 1):
+                file_path = variables[variable].format(year, month)
+                if not os.path.exists(file_path):
+                    print('File does not exist:\t' + file_path)
+                    continue
+
+                # all of the monthly rasters should be on the same grid, so the labels are
+                # normally built only once
+                if labels is None or zonal_stats.grid_signature(file_path) != labels.signature:
+                    print('Rasterizing ' + str(len(basins)) + ' basins onto the grid of ' + file_path)
+                    labels = zonal_stats.basin_labels(basins, file_path)
+                    print('Basins are spread over ' + str(len(labels.layers)) + ' label layers')
+
+                stats = zonal_stats.multi_basin_stats(labels, file_path)
+                for basin_id in labels.basin_ids:
+                    for stat_name in ('mean', 'sum', 'count'):
+                        rows.append([basin_id, variable, year, month, stat_name, stats[basin_id][stat_name]])
+
+    return pd.DataFrame(rows, columns=['basin', 'variable', 'year', 'month', 'stat', 'value'])
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+
+    out_file = share_path + 'zonal_tables.csv'
+    try:
+        opts, args2 = getopt.getopt(argv, "o:", ["out="])
+    except getopt.GetoptError:
+        print('step02_zonal_tables.py -o <output csv>')
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-o", "--out"):
+            out_file = arg
+
+    df = pd.read_csv(share_path + 'GRDC_Stations.csv').sort_values('area').query('area >= 10')
+
+    basins = []
+    for row in df.itertuples(index=True, name='Pandas'):
+        grdc_no = getattr(row, 'grdc_no')
+        shapefile = ws_base_path + 'grdc_basins_smoothed_md_no_' + str(grdc_no) + '.shp'
+        if os.path.exists(shapefile):
+            basins.append((grdc_no, shapefile))
+        else:
+            print('###### Missing shape file ' + shapefile)
+
+    table = build_zonal_table(basins, year_list)
+    table.to_csv(out_file, index=False)
+    print('Wrote ' + str(len(table)) + ' rows to ' + out_file)
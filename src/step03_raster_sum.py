@@ -1,106 +1,277 @@
-import csv
+import getopt
+import os
 import sys
+import tarfile
+import threading
+import Queue
+from multiprocessing import Pool
 
-import numpy.ma as np
 from osgeo import gdal
 
+from supporting_scripts import archive_index
+from supporting_scripts import pipeline_config
+from supporting_scripts import qf_summary
+from supporting_scripts import results_table
+
 # https://major.io/2007/07/05/bintar-argument-list-too-long/
 # super useful link!!!
 
 driver = gdal.GetDriverByName('GTiff')
 
-# print the header
-print 'year\tmonth\tws\tmodel\tqf.sum\tpx.count\tulx\txres\txskew\tuly\tyskew\tyres\tcubic.m\tfile'
+# the results go to every one of these: CSV, or typed Parquet for .parquet files (see
+# supporting_scripts/results_table.py). Both lists are set in pipeline.cfg
+out_files = pipeline_config.current().paths_of('results')
 
-myfile = open('/Users/mikelavender/Google Drive/Work/Projects/Cryosphere paper/Model Outputs/WaterSI_Model.csv', 'w')
-wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-wr.writerow(['year', 'month', 'ws', 'model', 'qf.sum', 'px.count', 'ulx', 'xres', 'xskew', 'uly', 'yskew', 'yres',
-             'cubic.m', 'file'])
+fileName = pipeline_config.current().paths_of('archives')
 
-import tarfile
+# the most qf rasters read from the archives but not summed yet (bounds the memory used by
+# the payloads waiting for a worker)
+max_in_flight = 64
+
+
+# only the qf rasters of the archives are summed
+def is_qf_member(member):
+    return member.isfile() and qf_summary.is_qf_name(member.name)
 
-fileName = ["/Users/mikelavender/Desktop/clusterDataStagging/final_tiffs_01.tar.gz",
-            "/Users/mikelavender/Desktop/clusterDataStagging/final_tiffs_02.tar.gz",
-            "/Users/mikelavender/Desktop/clusterDataStagging/final_tiffs_03.tar.gz"
-            ]
 
-for fName in fileName:
+# the output row of one qf raster. Runs in the worker processes, so every call gets its own
+# /vsimem file
+def summarize_member(name, payload):
+    mem_path = '/vsimem/tiffinmem_{0}.tif'.format(os.getpid())
+    gdal.FileFromMemBuffer(mem_path, payload)
+    # dst_ds = driver.CreateCopy(full_path, src_ds, 0, options=["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=9", "PREDICTOR=3"])
+    # the following line will use all cpus/threads available on a node. Use the above line for clustered computing
+    # dst_ds = driver.CreateCopy(full_path, src_ds, 0, options=["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=9", "PREDICTOR=3", "NUM_THREADS=ALL_CPUS"])
+    # dst_ds = None
 
-    tfile = tarfile.open(fName, 'r|gz')
+    try:
+        # the same row step02 writes right after the InVEST run (see supporting_scripts/qf_summary.py)
+        return qf_summary.summarize_raster(mem_path, name)
+    finally:
+        gdal.Unlink(mem_path)
+
+
+# the qf members of a tar.gz archive, in archive order, as (seq, member, payload, row). With
+# the results known from the index, members that didn't change aren't read: their payload is
+# None and row is the known result
+def iter_qf_members(archive, known=None):
+    if known is None:
+        tfile, igz = tarfile.open(archive, 'r|gz'), None
+    else:
+        tfile, igz = archive_index.open_archive_stream(archive)
+
+    seq = 0
     for cfile in tfile:
-        if cfile.name[-4:] == ".tif" and "qf_" in cfile.name:
-            print cfile.name.split("/")[-1:][0]
-            file_ = tfile.extractfile(cfile)
-
-        # for file_ in files:
-        # if file_.endswith(".tif") & file_.startswith("qf_"):
-            parts = cfile.name.split("/")[-1:][0].split("_")
-
-            model = 'non-snow' if parts[3] == 'raw' else 'snow'
-            year = parts[-1].rstrip('.tif')
-            month = parts[1]
-            ws = parts[2]
-
-            # full_path = os.path.join(root, file_)
-
-            gdal.FileFromMemBuffer("/vsimem/tiffinmem", file_.read())
-            src_ds = gdal.Open("/vsimem/tiffinmem")
-            # dst_ds = driver.CreateCopy(full_path, src_ds, 0, options=["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=9", "PREDICTOR=3"])
-            # the following line will use all cpus/threads available on a node. Use the above line for clustered computing
-            # dst_ds = driver.CreateCopy(full_path, src_ds, 0, options=["TILED=YES", "COMPRESS=DEFLATE", "ZLEVEL=9", "PREDICTOR=3", "NUM_THREADS=ALL_CPUS"])
-            # dst_ds = None
-
-            if src_ds is None:
-                print 'Unable to open INPUT.tif'
-                gdal.Unlink('/vsimem/tiffinmem')
-                sys.exit(1)
-
-            ulx, xres, xskew, uly, yskew, yres = src_ds.GetGeoTransform()
-
-            srcband = src_ds.GetRasterBand(1)
-            srcband.ComputeStatistics(False)
-            array = srcband.ReadAsArray()
-            no_data_value = srcband.GetNoDataValue()
-            stats = srcband.GetStatistics(True, True)
-            # print "mean:\t", stats[2]
-
-            mx = np.masked_equal(array, no_data_value)
-
-            wr.writerow(
-                [year,
-                 month,
-                 ws,
-                 model,
-                 str(mx.sum()),
-                 str(mx.count()),
-                 str(ulx),
-                 str(xres),
-                 str(xskew),
-                 str(uly),
-                 str(yskew),
-                 str(abs(yres)),
-                 str((abs(xres * yres) * (mx.sum() * 0.001))),
-                 file_]
-            )
-
-            # print(
-            #         year + '\t' +
-            #         month + '\t' +
-            #         ws + '\t' +
-            #         model + '\t' +
-            #         str(mx.sum()) + '\t' +
-            #         str(mx.count()) + '\t' +
-            #         str(ulx) + '\t' +
-            #         str(xres) + '\t' +
-            #         str(xskew) + '\t' +
-            #         str(uly) + '\t' +
-            #         str(yskew) + '\t' +
-            #         str(abs(yres)) + '\t' +
-            #         str((abs(xres * yres) * (mx.sum() * 0.001))) + '\t' +
-            #         file_
-            # )
-
-            src_ds = None
-            gdal.Unlink('/vsimem/tiffinmem')
-
-myfile.close()
+        if is_qf_member(cfile):
+            old = known.get(cfile.name) if known else None
+            if old is not None and old[0] == cfile.size and old[1] == cfile.mtime:
+                yield seq, cfile, None, old[2]
+            else:
+                yield seq, cfile, tfile.extractfile(cfile).read(), None
+            seq += 1
+    tfile.close()
+
+    if known is not None:
+        archive_index.export_gzip_index(igz, archive)
+
+
+# write the row of a member that was just summed and keep it in the index. Rows of members
+# that didn't change are only re-recorded (their place in the archive may have moved).
+# Returns 1 if the row replaces an older result of the member, 0 otherwise
+def store_result(wr, index, known, archive, seq, member, row, new):
+    if new:
+        print member.name.split("/")[-1]
+        wr.writerow(row)
+    if index is None:
+        return 0
+    index.record_member(archive, member, seq, row)
+    return 1 if new and member.name in known else 0
+
+
+# one process, one archive after the other (the way it always ran). Returns the number of
+# results that replaced (or dropped) older ones in the index
+def sum_archives_sequential(archives, wr, index=None):
+    replaced = 0
+    for archive in archives:
+        if index is not None and index.is_current(archive):
+            print 'Already aggregated: ' + archive
+            continue
+        known = index.known_results(archive) if index is not None else None
+
+        count = 0
+        for seq, member, payload, row in iter_qf_members(archive, known):
+            if payload is not None:
+                row = summarize_member(member.name, payload)
+            replaced += store_result(wr, index, known, archive, seq, member, row, payload is not None)
+            count += 1
+
+        if index is not None:
+            # members gone from a changed archive lose their rows, so the tables are rewritten
+            replaced += index.record_archive(archive, count)
+    return replaced
+
+
+# reads one archive in its own thread (gzip and tar do most of their work without the GIL)
+# and hands every qf raster over to the pool. The pending results go into results in archive
+# order, followed by None once the archive is done
+def read_archive(archive, known, pool, results, in_flight):
+    try:
+        for seq, member, payload, row in iter_qf_members(archive, known):
+            if payload is None:
+                results.put((seq, member, None, row))
+                continue
+            in_flight.acquire()
+            results.put((seq, member, pool.apply_async(summarize_member, (member.name, payload),
+                                                       callback=lambda summed: in_flight.release()), None))
+    except Exception as e:
+        results.put((None, archive, e, None))
+    finally:
+        results.put(None)
+
+
+# all of the archives at the same time, the rasters summed by jobs worker processes. The rows
+# are written in the same order as the sequential run would write them. Returns the number of
+# results that replaced (or dropped) older ones in the index
+def sum_archives_parallel(archives, wr, jobs, index=None):
+    pool = Pool(processes=jobs)
+    in_flight = threading.BoundedSemaphore(max(max_in_flight, jobs))
+
+    readers = []
+    for archive in archives:
+        if index is not None and index.is_current(archive):
+            print 'Already aggregated: ' + archive
+            continue
+        # the index is only used from this thread
+        known = index.known_results(archive) if index is not None else None
+
+        results = Queue.Queue()
+        reader = threading.Thread(target=read_archive, args=(archive, known, pool, results, in_flight))
+        reader.daemon = True
+        reader.start()
+        readers.append((archive, known, reader, results))
+
+    replaced = 0
+    try:
+        for archive, known, reader, results in readers:
+            count = 0
+            while True:
+                item = results.get()
+                if item is None:
+                    break
+                seq, member, result, row = item
+                if isinstance(result, Exception):
+                    raise result
+                if result is not None:
+                    try:
+                        row = result.get()
+                    except Exception:
+                        # the callback only runs on success
+                        in_flight.release()
+                        raise
+                replaced += store_result(wr, index, known, archive, seq, member, row, result is not None)
+                count += 1
+            reader.join()
+
+            if index is not None:
+                replaced += index.record_archive(archive, count)
+    finally:
+        pool.terminate()
+        pool.join()
+    return replaced
+
+
+# the rows of the qf summary tables, one per raster (the last table wins), in table order
+def merge_tables(tables):
+    rows = []
+    position = {}
+    for table in tables:
+        for row in results_table.read_rows(table):
+            file_name = row[-1]
+            if file_name in position:
+                rows[position[file_name]] = row
+            else:
+                position[file_name] = len(rows)
+                rows.append(row)
+    return rows
+
+
+usage = 'step03_raster_sum.py [-j <worker processes>] [-o <out .csv|.parquet> ...] [--index <sqlite file>] ' \
+        '[<final_tiffs archive> ...] | [-o <out .csv|.parquet> ...] --merge <qf summary csv> ...'
+
+# With --index only the archives (and members) that are new or changed since the last run are
+# aggregated, and their rows are appended to the CSV tables (a new index writes them from
+# scratch). Parquet tables are written again from the index (all of the archives ever indexed),
+# as are the CSV tables if a changed member replaced an older row or was removed from its archive
+# (see supporting_scripts/archive_index.py)
+#
+# step02 already writes the rows of every run to a qf summary table (see
+# supporting_scripts/qf_summary.py), so the archives are only needed for rasters we want to
+# keep. With --merge the summary tables (of several share paths or clusters) are merged into
+# the output tables instead, without reading any archive. A raster that is in more than one
+# table keeps its row of the last table.
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+
+    # 1 runs the archives one after the other in this process
+    jobs = 1
+    outputs = []
+    index = None
+    merge = []
+    try:
+        opts, archives = getopt.getopt(argv, "hj:o:", ["jobs=", "out=", "max-in-flight=", "index=", "merge="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt in ('-o', '--out'):
+            outputs.append(arg)
+        elif opt == '--max-in-flight':
+            max_in_flight = int(arg)
+        elif opt == '--index':
+            index = archive_index.ArchiveIndex(arg)
+        elif opt == '--merge':
+            merge.append(arg)
+    if archives:
+        fileName = archives
+    if outputs:
+        out_files = outputs
+
+    # print the header
+    print '\t'.join(results_table.HEADER)
+
+    if merge:
+        merged = merge_tables(merge)
+        for path in out_files:
+            print 'Writing ' + str(len(merged)) + ' rows to ' + path
+            results_table.write_table(path, merged)
+        sys.exit()
+
+    if index is None:
+        streamed = out_files
+    else:
+        streamed = [path for path in out_files if not results_table.is_parquet(path)]
+    # the CSV tables only hold the rows of the archives in the index if it has any; a new index
+    # starts them over, rows of an earlier run without the index would be written twice
+    append = index is not None and not index.is_empty()
+    wr = results_table.MultiWriter([results_table.open_writer(path, append=append) for path in streamed])
+
+    if jobs > 1:
+        replaced = sum_archives_parallel(fileName, wr, jobs, index)
+    else:
+        replaced = sum_archives_sequential(fileName, wr, index)
+
+    wr.close()
+
+    if index is not None:
+        for path in out_files:
+            if results_table.is_parquet(path) or replaced:
+                print 'Writing ' + path + ' from ' + index.path
+                # all of the archives in the index, not only the ones of this run
+                results_table.write_table(path, index.results())
+        index.close()
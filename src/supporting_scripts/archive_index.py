@@ -0,0 +1,143 @@
+"""
+What step03 already aggregated, so a new final_tiffs_NN.tar.gz only costs its own members.
+
+The index is a SQLite file with
+
+    archives  - path, size and mtime of every archive that was read to the end
+    members   - archive, member name, size, mtime, the offset of the member data in the
+                uncompressed tar stream and the result row of the member (JSON)
+
+An archive whose size and mtime are unchanged is not decompressed again at all. In an
+archive that changed, only members that are new or whose size/mtime changed are summed.
+
+gzip can't be seeked, but with the offsets a single member can still be read without
+untarring the archive (read_member). If indexed_gzip is installed the archives are read
+through it on the first pass and its seek points are kept next to the archive (<archive>.gzidx),
+which makes those reads real random access; otherwise the stream is decompressed up to the
+member.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import tarfile
+import time
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# distance between indexed_gzip seek points in the uncompressed stream
+SEEK_POINT_SPACING = 16 * 1024 * 1024
+
+
+def gzip_index_path(archive):
+    return archive + '.gzidx'
+
+
+def open_archive_stream(archive):
+    """Open a tar.gz for streaming. Returns (tarfile, the indexed_gzip file or None)."""
+    if indexed_gzip is None:
+        return tarfile.open(archive, 'r|gz'), None
+    igz = indexed_gzip.IndexedGzipFile(archive, spacing=SEEK_POINT_SPACING)
+    return tarfile.open(fileobj=igz, mode='r|'), igz
+
+
+def export_gzip_index(igz, archive):
+    """Keep the seek points of an archive that was read to the end through indexed_gzip."""
+    if igz is not None:
+        igz.export_index(gzip_index_path(archive))
+
+
+def _open_for_seek(archive):
+    if indexed_gzip is not None:
+        igz = indexed_gzip.IndexedGzipFile(archive, spacing=SEEK_POINT_SPACING)
+        if os.path.exists(gzip_index_path(archive)):
+            igz.import_index(gzip_index_path(archive))
+        return igz
+    return gzip.open(archive, 'rb')
+
+
+class ArchiveIndex(object):
+    """The SQLite index of the archives and members step03 has aggregated."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS archives ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, members INTEGER, indexed REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS members ('
+                          'archive TEXT, name TEXT, size INTEGER, mtime REAL, offset_data INTEGER, '
+                          'seq INTEGER, result TEXT, PRIMARY KEY (archive, name))')
+        self.conn.commit()
+        # archive -> names of the members recorded in this pass over it
+        self._seen = {}
+
+    def is_empty(self):
+        """True if no archive was read to the end yet (a new index)."""
+        return self.conn.execute('SELECT COUNT(*) FROM archives').fetchone()[0] == 0
+
+    def is_current(self, archive):
+        """True if the archive was read to the end before and hasn't changed since."""
+        archive = os.path.abspath(archive)
+        found = self.conn.execute('SELECT size, mtime FROM archives WHERE path = ?', (archive,)).fetchone()
+        return found is not None and found[0] == os.path.getsize(archive) and \
+            found[1] == os.path.getmtime(archive)
+
+    def known_results(self, archive):
+        """The members summed before, as name -> (size, mtime, result row)."""
+        return dict((found[0], (found[1], found[2], json.loads(found[3])))
+                    for found in self.conn.execute('SELECT name, size, mtime, result FROM members '
+                                                   'WHERE archive = ? AND result IS NOT NULL',
+                                                   (os.path.abspath(archive),)))
+
+    def record_member(self, archive, member, seq, result):
+        self._seen.setdefault(os.path.abspath(archive), set()).add(member.name)
+        self.conn.execute('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (os.path.abspath(archive), member.name, member.size, member.mtime,
+                           member.offset_data, seq, json.dumps(result)))
+
+    def record_archive(self, archive, members):
+        """
+        Mark the archive as read to the end (commits everything recorded for it). Members of an
+        earlier pass that are no longer in the archive are dropped; returns how many.
+        """
+        seen = self._seen.pop(os.path.abspath(archive), set())
+        removed = [found[0] for found in self.conn.execute('SELECT name FROM members WHERE archive = ?',
+                                                           (os.path.abspath(archive),))
+                   if found[0] not in seen]
+        self.conn.executemany('DELETE FROM members WHERE archive = ? AND name = ?',
+                              [(os.path.abspath(archive), name) for name in removed])
+        self.conn.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)',
+                          (os.path.abspath(archive), os.path.getsize(archive), os.path.getmtime(archive),
+                           members, time.time()))
+        self.conn.commit()
+        return len(removed)
+
+    def results(self, archives=None):
+        """All result rows, in archive order (as given, or by path) and member order."""
+        if archives is None:
+            archives = [found[0] for found in self.conn.execute('SELECT path FROM archives ORDER BY path')]
+        for archive in archives:
+            for found in self.conn.execute('SELECT result FROM members WHERE archive = ? ORDER BY seq',
+                                           (os.path.abspath(archive),)):
+                yield json.loads(found[0])
+
+    def read_member(self, archive, name):
+        """The bytes of one member, read at its offset instead of untarring the archive."""
+        found = self.conn.execute('SELECT offset_data, size FROM members WHERE archive = ? AND name = ?',
+                                  (os.path.abspath(archive), name)).fetchone()
+        if found is None:
+            raise KeyError(name + ' is not in the index of ' + archive)
+        stream = _open_for_seek(archive)
+        try:
+            stream.seek(found[0])
+            return stream.read(found[1])
+        finally:
+            stream.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
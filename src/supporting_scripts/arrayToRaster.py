@@ -5,23 +5,62 @@ Converts a numpy array to a raster file and compresses it to save space
 from osgeo import osr, gdal
 import numpy
 
+from supporting_scripts import raster_output
 
-def array_to_raster(array, dst_filename, src_filename, noDataValue):
+CREATION_OPTIONS = ["TILED=YES", "COMPRESS=DEFLATE", "BLOCKXSIZE=512", "BLOCKYSIZE=512"]
+
+# one writer per template, so the template is only opened once however many files are written
+_writers = {}
+
+
+class RasterWriter(object):
+    """
+    Writes arrays to GeoTIFFs on the grid of a template raster.
+
+    The size, geotransform, projection and data type of the template are read
+    once. Every output is made with Create and written in one pass, instead of CreateCopy of
+    the template, which copied (and compressed) all of its pixels just to overwrite them.
+    The outputs have one band, with the data type of the first band of the template unless
+    data_type is given.
+    """
 
-    driver = gdal.GetDriverByName('GTiff')
+    def __init__(self, template_filename, data_type=None, options=None):
+        src_ds = gdal.Open(template_filename)
+        if src_ds is None:
+            raise ValueError('Unable to open template ' + template_filename)
+        band = src_ds.GetRasterBand(1)
 
-    src_ds = gdal.Open(src_filename)
-    dst_ds = driver.CreateCopy(dst_filename, src_ds, 0,
-                               options=["TILED=YES", "COMPRESS=DEFLATE", "NUM_THREADS=ALL_CPUS", "BLOCKXSIZE=512", "BLOCKYSIZE=512"])
+        self.template_filename = template_filename
+        self.xsize = src_ds.RasterXSize
+        self.ysize = src_ds.RasterYSize
+        self.geotransform = src_ds.GetGeoTransform()
+        self.projection = src_ds.GetProjection()
+        self.data_type = band.DataType if data_type is None else data_type
+        self.options = list(CREATION_OPTIONS if options is None else options)
+        src_ds = None
 
-    dst_ds.SetDescription('No Description')
-    dst_ds.SetMetadata('')
-    dst_ds.GetRasterBand(1).SetMetadata('')
-    dst_ds.GetRasterBand(1).SetNoDataValue(noDataValue)
-    dst_ds.GetRasterBand(1).WriteArray(array)
-    dst_ds.FlushCache()  # Write to disk.
+    def write(self, array, dst_filename, noDataValue):
+        if array.shape != (self.ysize, self.xsize):
+            raise ValueError('Array of shape {0} does not match the template {1} ({2} x {3})'.format(
+                array.shape, self.template_filename, self.ysize, self.xsize))
 
-    # Once we're done, close the dataset
-    src_ds = None
-    dst_ds = None
+        def fill(dst_ds):
+            dst_ds.SetGeoTransform(self.geotransform)
+            dst_ds.SetProjection(self.projection)
+            dst_band = dst_ds.GetRasterBand(1)
+            dst_band.SetNoDataValue(noDataValue)
+            dst_band.WriteArray(array)
 
+        # a plain tiled GeoTIFF, or a COG (see raster_output.py)
+        raster_output.write_raster(dst_filename, self.xsize, self.ysize, 1, self.data_type, self.options, fill)
+
+
+def raster_writer(template_filename):
+    """The (cached) writer for a template."""
+    if template_filename not in _writers:
+        _writers[template_filename] = RasterWriter(template_filename)
+    return _writers[template_filename]
+
+
+def array_to_raster(array, dst_filename, src_filename, noDataValue):
+    raster_writer(src_filename).write(array, dst_filename, noDataValue)
@@ -0,0 +1,225 @@
+"""
+A single GeoPackage with all of the GRDC basins.
+
+step02 used to open grdc_basins_smoothed_md_no_<id>.shp for every basin and re-project it
+with VectorTranslate on every run. The index is built once from all of those shapefiles and
+holds, per basin:
+
+    geometry          - the basin in EPSG:4326 (with the GeoPackage R-tree index on it)
+    grdc_no           - GRDC station number
+    utm_epsg          - EPSG code of the UTM zone of the station (see get_epsg_number)
+    area_km2          - basin area, measured in the UTM zone
+    minx .. maxy      - bounding box in EPSG:4326
+    utm_wkb           - the basin re-projected to its UTM zone, as WKB
+
+Build it with:
+
+    python -m supporting_scripts.basin_index /InVEST_Data/GRDC_Stations.csv /InVEST_Data/watershed_shp/ basins.gpkg
+"""
+
+from __future__ import print_function
+
+import binascii
+import csv
+import math
+import os
+import sys
+
+from osgeo import ogr, osr
+
+LAYER_NAME = 'basins'
+
+
+# Get the correct epsg number to re-project to local UTM
+def get_epsg_number(lat, lng):
+    zone_number = int(math.floor((lng + 180) / 6) + 1)
+
+    if 56.0 <= lat < 64.0 and 3.0 <= lng < 12.0:
+        zone_number = 32
+
+    # Special zones for Svalbard
+    if 72.0 <= lat < 84.0:
+        if 0.0 <= lng < 9.0:
+            zone_number = 31;
+        elif 9.0 <= lng < 21.0:
+            zone_number = 33;
+        elif 21.0 <= lng < 33.0:
+            zone_number = 35
+        elif 33.0 <= lng < 42.0:
+            zone_number = 37
+
+    if lat > 0:
+        return "EPSG:" + str(32600 + zone_number)
+    else:
+        return "EPSG:" + str(32700 + zone_number)
+
+
+def _srs_from_epsg(code):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(code))
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def basin_shapefile(ws_base_path, grdc_no):
+    return os.path.join(ws_base_path, 'grdc_basins_smoothed_md_no_' + str(grdc_no) + '.shp')
+
+
+def _read_basin(shapefile, wgs84):
+    # the union of all of the features of a basin shapefile, in EPSG:4326
+    ds = ogr.Open(shapefile)
+    layer = ds.GetLayer()
+    srs = layer.GetSpatialRef()
+    transform = None
+    if srs is not None:
+        srs = srs.Clone()
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not srs.IsSame(wgs84):
+            transform = osr.CoordinateTransformation(srs, wgs84)
+
+    union = None
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        union = geometry if union is None else union.Union(geometry)
+
+    ds = None
+    return union
+
+
+def build_basin_index(stations_csv, ws_base_path, gpkg_path):
+    """Build the GeoPackage from the stations table and the basin shapefiles. Returns the basin count."""
+    wgs84 = _srs_from_epsg(4326)
+
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(gpkg_path):
+        driver.DeleteDataSource(gpkg_path)
+    ds = driver.CreateDataSource(gpkg_path)
+    layer = ds.CreateLayer(LAYER_NAME, srs=wgs84, geom_type=ogr.wkbMultiPolygon,
+                           options=['SPATIAL_INDEX=YES'])
+
+    layer.CreateField(ogr.FieldDefn('grdc_no', ogr.OFTInteger64))
+    layer.CreateField(ogr.FieldDefn('utm_epsg', ogr.OFTInteger))
+    for name in ['area_km2', 'minx', 'miny', 'maxx', 'maxy', 'lat', 'long']:
+        layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn('utm_wkb', ogr.OFTBinary))
+
+    count = 0
+    layer.StartTransaction()
+    with open(stations_csv) as myfile:
+        for station in csv.DictReader(myfile):
+            grdc_no = int(float(station['grdc_no']))
+            shapefile = basin_shapefile(ws_base_path, grdc_no)
+            if not os.path.exists(shapefile):
+                print('###### Missing shape file ' + shapefile)
+                continue
+
+            geometry = _read_basin(shapefile, wgs84)
+            if geometry is None:
+                print('###### No geometry in ' + shapefile)
+                continue
+            geometry = ogr.ForceToMultiPolygon(geometry)
+
+            lat = float(station['lat'])
+            lng = float(station['long'])
+            utm_epsg = int(get_epsg_number(lat, lng).split(':')[1])
+            utm_geometry = geometry.Clone()
+            utm_geometry.Transform(osr.CoordinateTransformation(wgs84, _srs_from_epsg(utm_epsg)))
+            min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('grdc_no', grdc_no)
+            feature.SetField('utm_epsg', utm_epsg)
+            feature.SetField('area_km2', utm_geometry.GetArea() / 1e6)
+            feature.SetField('minx', min_x)
+            feature.SetField('miny', min_y)
+            feature.SetField('maxx', max_x)
+            feature.SetField('maxy', max_y)
+            feature.SetField('lat', lat)
+            feature.SetField('long', lng)
+            feature.SetFieldBinaryFromHexString('utm_wkb', binascii.hexlify(utm_geometry.ExportToWkb()).decode('ascii'))
+            feature.SetGeometry(geometry)
+            layer.CreateFeature(feature)
+            feature = None
+            count += 1
+
+    layer.CommitTransaction()
+    # the basins are looked up by station number
+    ds.ExecuteSQL('CREATE INDEX IF NOT EXISTS idx_basins_grdc_no ON ' + LAYER_NAME + ' (grdc_no)')
+    ds = None
+    return count
+
+
+class BasinIndex(object):
+    """Read access to the basin GeoPackage. The file is opened once and kept open."""
+
+    def __init__(self, gpkg_path):
+        self.path = gpkg_path
+        self.ds = ogr.Open(gpkg_path)
+        if self.ds is None:
+            raise ValueError('Unable to open basin index ' + gpkg_path)
+        self.layer = self.ds.GetLayerByName(LAYER_NAME)
+
+    def _record(self, feature):
+        record = dict((name, feature.GetField(name))
+                      for name in ['grdc_no', 'utm_epsg', 'area_km2', 'minx', 'miny', 'maxx', 'maxy', 'lat', 'long'])
+        record['geometry'] = feature.GetGeometryRef().Clone()
+        utm_geometry = ogr.CreateGeometryFromWkb(feature.GetFieldAsBinary('utm_wkb'))
+        utm_geometry.AssignSpatialReference(_srs_from_epsg(record['utm_epsg']))
+        record['utm_geometry'] = utm_geometry
+        return record
+
+    def record(self, grdc_no):
+        """Everything stored for a basin as a dict, or None if it is not in the index."""
+        self.layer.SetSpatialFilter(None)
+        self.layer.SetAttributeFilter('grdc_no = ' + str(int(grdc_no)))
+        feature = self.layer.GetNextFeature()
+        self.layer.SetAttributeFilter(None)
+        self.layer.ResetReading()
+        if feature is None:
+            return None
+        return self._record(feature)
+
+    def basins_in_bbox(self, min_x, min_y, max_x, max_y):
+        """Records of all basins whose bounding box overlaps the box (EPSG:4326), via the R-tree."""
+        self.layer.SetAttributeFilter(None)
+        self.layer.SetSpatialFilterRect(min_x, min_y, max_x, max_y)
+        records = [self._record(feature) for feature in self.layer]
+        self.layer.SetSpatialFilter(None)
+        return records
+
+    def write_aoi(self, grdc_no, out_path):
+        """Write the basin, in its UTM zone, to a shapefile (for InVEST and the cutlines)."""
+        record = self.record(grdc_no)
+        if record is None:
+            raise ValueError('###### Basin not in index: ' + str(grdc_no))
+
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        if os.path.exists(out_path):
+            driver.DeleteDataSource(out_path)
+        ds = driver.CreateDataSource(out_path)
+        layer_name = os.path.splitext(os.path.basename(out_path))[0]
+        layer = ds.CreateLayer(layer_name, srs=_srs_from_epsg(record['utm_epsg']), geom_type=ogr.wkbMultiPolygon)
+        layer.CreateField(ogr.FieldDefn('grdc_no', ogr.OFTInteger64))
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('grdc_no', int(grdc_no))
+        feature.SetGeometry(record['utm_geometry'])
+        layer.CreateFeature(feature)
+        feature = None
+        ds = None
+        return record
+
+    def close(self):
+        self.layer = None
+        self.ds = None
+
+
+if __name__ == '__main__':
+    n = build_basin_index(sys.argv[1], sys.argv[2], sys.argv[3])
+    print('Indexed ' + str(n) + ' basins in ' + sys.argv[3])
@@ -0,0 +1,104 @@
+"""
+Thread-parallel, block by block processing of a raster band into another.
+
+The preprocessing of the global rasters (reclassifying the soils, cleaning the MODIS ET) is
+read block, compute, write block, and most of the time goes to decoding and DEFLATE, not
+Python. Here the blocks are read and computed by a pool of threads (GDAL and numpy release
+the GIL for the heavy parts), each with its own handle on the input because a GDAL dataset
+can't be shared between threads. The results are written by the calling thread, in block
+order (ordered=True) or as soon as they are ready; the compression of the output is spread
+over threads by GDAL (NUM_THREADS, see execution_plan.compress_options).
+
+    def func(data, window):
+        return data * 2
+
+    run_blocks(in_file, dst_band, func)
+
+A window is (xoff, yoff, cols, rows). chunk_blocks makes every window that many native
+blocks (cols, rows) big, to cut the per-window overhead on rasters with small blocks.
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from osgeo import gdal
+
+from supporting_scripts import execution_plan
+
+# windows handed to the pool at a time, per thread
+WINDOWS_PER_THREAD = 8
+
+
+def windows(xsize, ysize, x_block_size, y_block_size, chunk_blocks=(1, 1)):
+    """The windows covering the raster, in row major order."""
+    cols = x_block_size * chunk_blocks[0]
+    rows = y_block_size * chunk_blocks[1]
+    result = []
+    for i in range(0, ysize, rows):
+        for j in range(0, xsize, cols):
+            result.append((j, i, min(cols, xsize - j), min(rows, ysize - i)))
+    return result
+
+
+class _BlockReader(object):
+    # every pool thread opens the input once and keeps it
+
+    def __init__(self, in_file, band_number, func):
+        self.in_file = in_file
+        self.band_number = band_number
+        self.func = func
+        self.local = threading.local()
+
+    def __call__(self, window):
+        if getattr(self.local, 'band', None) is None:
+            self.local.ds = gdal.Open(self.in_file)
+            self.local.band = self.local.ds.GetRasterBand(self.band_number)
+        data = self.local.band.ReadAsArray(*window)
+        return window, self.func(data, window)
+
+
+def run_blocks(in_file, dst_band, func, workers=None, chunk_blocks=(1, 1), ordered=True, band_number=1,
+               progress=False):
+    """
+    Write func(data, window) of every window of band band_number of in_file to dst_band (same
+    size), with workers threads (default: from the execution plan). progress prints the row of
+    every first window of a row as it is written. Returns the number of windows.
+    """
+    ds = gdal.Open(in_file)
+    band = ds.GetRasterBand(band_number)
+    x_block_size, y_block_size = band.GetBlockSize()
+    todo = windows(band.XSize, band.YSize, x_block_size, y_block_size, chunk_blocks)
+    ysize = band.YSize
+    ds = None
+
+    if workers is None:
+        # the cores not taken by InVEST workers (all of them when run on its own)
+        workers = execution_plan.current().compress_threads
+    reader = _BlockReader(in_file, band_number, func)
+
+    def results():
+        if workers <= 1:
+            for window in todo:
+                yield reader(window)
+            return
+        # handed to the pool a slice at a time so finished blocks don't pile up in memory when
+        # the writes (compression) can't keep up
+        pool = ThreadPool(workers)
+        try:
+            step = workers * WINDOWS_PER_THREAD
+            for start in range(0, len(todo), step):
+                batch = todo[start:start + step]
+                for result in (pool.imap(reader, batch) if ordered else pool.imap_unordered(reader, batch)):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    last_row = -1
+    for (xoff, yoff, cols, rows), out in results():
+        if progress and yoff != last_row and xoff == 0:
+            print(str(yoff) + " of " + str(ysize))
+            last_row = yoff
+        dst_band.WriteArray(out, xoff, yoff)
+
+    return len(todo)
@@ -0,0 +1,131 @@
+"""
+Predicted InVEST run times and longest-first scheduling of basins.
+
+The run time of a basin grows with its size. The model is a straight line fitted to
+log(run time) against log(basin area) from the runs recorded in invest_runs.csv (see
+invest_runner.py). It is used to
+
+    - hand basins out to shards/nodes so they all finish at about the same time (LPT:
+      longest job first, each to the least loaded shard)
+    - run the longest basins first
+    - give every run a timeout in proportion to its predicted run time, instead of one
+      fixed timeout that kills legitimately large basins
+"""
+
+import csv
+import errno
+import heapq
+import json
+import math
+import os
+import socket
+
+import numpy as np
+
+# used as long as there aren't enough recorded runs to fit the model
+DEFAULT_SECONDS_PER_KM2 = 0.02
+MIN_RUNS_TO_FIT = 5
+
+
+class CostModel(object):
+    """seconds = exp(intercept) * area_km2 ** slope"""
+
+    def __init__(self, intercept=None, slope=1.0, residual_sd=0.0, runs=0):
+        if intercept is None:
+            intercept = math.log(DEFAULT_SECONDS_PER_KM2)
+        self.intercept = intercept
+        self.slope = slope
+        self.residual_sd = residual_sd
+        self.runs = runs
+
+    @classmethod
+    def fit(cls, areas, durations):
+        """Fit the model to the areas (km2) and run times (s) of finished runs."""
+        points = [(a, d) for a, d in zip(areas, durations) if a > 0 and d > 0]
+        if len(points) < MIN_RUNS_TO_FIT:
+            return cls(runs=len(points))
+
+        x = np.log([p[0] for p in points])
+        y = np.log([p[1] for p in points])
+        slope, intercept = np.polyfit(x, y, 1)
+        residual_sd = float(np.std(y - (intercept + slope * x)))
+        return cls(float(intercept), float(slope), residual_sd, len(points))
+
+    def predict(self, area_km2):
+        """Predicted run time (s) of one InVEST run of a basin."""
+        return math.exp(self.intercept + self.slope * math.log(max(float(area_km2), 1e-3)))
+
+    def timeout(self, area_km2, factor=3.0, minimum=5 * 60):
+        """Timeout (s) for a run: factor times the pessimistic (+2 sd) prediction, at least minimum."""
+        return max(minimum, factor * self.predict(area_km2) * math.exp(2 * self.residual_sd))
+
+    def save(self, path):
+        with open(path, 'w') as myfile:
+            json.dump(self.__dict__, myfile, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as myfile:
+            return cls(**json.load(myfile))
+
+
+def fit_from_runs(runs_csv, stations_csv):
+    """Fit the model to the ok runs in invest_runs.csv, with the basin areas of GRDC_Stations.csv."""
+    areas = {}
+    with open(stations_csv) as myfile:
+        for station in csv.DictReader(myfile):
+            areas[str(int(float(station['grdc_no'])))] = float(station['area'])
+
+    x = []
+    y = []
+    with open(runs_csv) as myfile:
+        for run in csv.DictReader(myfile):
+            grdc_no = str(int(float(run['grdc_no'])))
+            if run['status'] == 'ok' and grdc_no in areas:
+                # duration_s covers all attempts; use the time of one
+                x.append(areas[grdc_no])
+                y.append(float(run['duration_s']) / max(1, int(run['attempts'])))
+
+    return CostModel.fit(x, y)
+
+
+def shared_model(path, runs_csv, stations_csv):
+    """
+    The model saved at path, the same for every node of a batch. The first node to get there
+    fits it (to runs_csv, if there is one) and claims path with a hard link, which fails if
+    another node was first; every node then loads the file that won.
+    """
+    if not os.path.exists(path):
+        if os.path.exists(runs_csv):
+            model = fit_from_runs(runs_csv, stations_csv)
+        else:
+            model = CostModel()
+        tmp_path = '{0}.{1}.{2}'.format(path, socket.gethostname(), os.getpid())
+        model.save(tmp_path)
+        try:
+            os.link(tmp_path, path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        finally:
+            os.remove(tmp_path)
+    return CostModel.load(path)
+
+
+def lpt_schedule(costs, n_shards):
+    """
+    Spread jobs over n_shards with longest processing time first scheduling.
+
+    costs is a dict of job -> predicted cost. Returns a list with one list of jobs per shard,
+    each ordered longest first.
+    """
+    shards = [[] for _ in range(n_shards)]
+    loads = [(0.0, i) for i in range(n_shards)]
+    heapq.heapify(loads)
+
+    for job in sorted(costs, key=lambda j: -costs[j]):
+        load, i = heapq.heappop(loads)
+        shards[i].append(job)
+        heapq.heappush(loads, (load + costs[job], i))
+
+    return shards
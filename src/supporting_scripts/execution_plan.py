@@ -0,0 +1,179 @@
+"""
+One place that decides how the cores and memory of a node are shared out.
+
+Several InVEST worker processes plus the GDAL warps and compression of the parent all run on
+the same node. The plan takes the cores and memory we are allowed to use and works out:
+
+    workers           - number of InVEST worker processes
+    gdal_cache_mb     - GDAL block cache of every process (the parent and each worker)
+    warp_threads      - threads used by gdal.Warp
+    compress_threads  - threads used to compress GTiff output
+
+Cores and memory are detected: the cores of the CPU affinity of the process, the cgroup CPU
+quota or the allocation of the batch scheduler (SLURM_CPUS_PER_TASK, NSLOTS), whichever is
+smallest, and the physical memory or the cgroup memory limit. Every setting can be set, in
+order of precedence, on the command line of the step scripts (--cores, --memory-mb, --workers,
+--gdal-cache-mb, --warp-threads, --compress-threads), with the environment variables
+INVEST_SNOW17_CORES, INVEST_SNOW17_MEMORY_MB, INVEST_SNOW17_WORKERS,
+INVEST_SNOW17_GDAL_CACHE_MB, INVEST_SNOW17_WARP_THREADS and INVEST_SNOW17_COMPRESS_THREADS, or
+in the [plan] section of pipeline.cfg (see pipeline_config.py).
+"""
+
+import multiprocessing
+import os
+from collections import namedtuple
+
+from osgeo import gdal
+
+from supporting_scripts import pipeline_config
+
+ExecutionPlan = namedtuple('ExecutionPlan', ['cores', 'memory_mb', 'workers', 'gdal_cache_mb',
+                                             'warp_threads', 'compress_threads'])
+
+# what an InVEST run on a large basin needs, on top of the GDAL cache
+WORKER_MEMORY_MB = 2048
+# share of the memory handed to the GDAL caches, the rest is left for numpy and InVEST
+GDAL_CACHE_SHARE = 0.4
+MIN_GDAL_CACHE_MB = 64
+
+_plan = None
+
+
+# the settings of a plan that can be set, with the environment variable that sets them
+SETTINGS = [('cores', 'INVEST_SNOW17_CORES'), ('memory_mb', 'INVEST_SNOW17_MEMORY_MB'),
+            ('workers', 'INVEST_SNOW17_WORKERS'), ('gdal_cache_mb', 'INVEST_SNOW17_GDAL_CACHE_MB'),
+            ('warp_threads', 'INVEST_SNOW17_WARP_THREADS'), ('compress_threads', 'INVEST_SNOW17_COMPRESS_THREADS')]
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as myfile:
+            return myfile.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_cpu_quota():
+    # cores allowed by the cgroup CPU quota (v2 cpu.max, or v1 cfs quota/period), or None
+    found = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if found:
+        quota, period = (found.split() + ['100000'])[:2]
+        if quota != 'max':
+            return max(1, int(int(quota) // int(period)))
+        return None
+    quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return max(1, int(quota) // int(period))
+    return None
+
+
+def node_cores():
+    """The cores this process may use: CPU affinity, cgroup quota and scheduler allocation."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = multiprocessing.cpu_count()
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cores = min(cores, quota)
+    for name in ('SLURM_CPUS_PER_TASK', 'NSLOTS'):
+        if os.environ.get(name, '').isdigit():
+            cores = min(cores, int(os.environ[name]))
+    return max(1, cores)
+
+
+def node_memory_mb():
+    """Physical memory of the node, or the cgroup memory limit, in MB (1024 if it can't be found out)."""
+    try:
+        memory_mb = int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        memory_mb = 1024
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        found = _read_first_line(path)
+        if found and found.isdigit():
+            memory_mb = min(memory_mb, int(found) // (1024 * 1024))
+    return memory_mb
+
+
+def _setting(name, value):
+    # the value given, the environment variable or the [plan] section of the config, in that order
+    if value is not None:
+        return int(value)
+    env = dict(SETTINGS)[name]
+    if os.environ.get(env):
+        return int(os.environ[env])
+    configured = pipeline_config.current().plan_setting(name)
+    return None if configured is None else int(configured)
+
+
+def make_plan(cores=None, memory_mb=None, workers=None, gdal_cache_mb=None, warp_threads=None,
+              compress_threads=None):
+    """
+    Work out a plan. Anything not given comes from the environment, the config or the node
+    itself.
+    """
+    cores = _setting('cores', cores)
+    memory_mb = _setting('memory_mb', memory_mb)
+    workers = _setting('workers', workers)
+    gdal_cache_mb = _setting('gdal_cache_mb', gdal_cache_mb)
+    warp_threads = _setting('warp_threads', warp_threads)
+    compress_threads = _setting('compress_threads', compress_threads)
+    if cores is None:
+        cores = node_cores()
+    if memory_mb is None:
+        memory_mb = node_memory_mb()
+
+    cores = max(1, int(cores))
+    memory_mb = max(256, int(memory_mb))
+    if workers is None:
+        # one InVEST run per core, as long as there is memory for it
+        workers = min(cores, max(1, memory_mb // WORKER_MEMORY_MB))
+    workers = max(1, int(workers))
+
+    # the parent (clipping) and every worker get their own cache
+    if gdal_cache_mb is None:
+        gdal_cache_mb = max(MIN_GDAL_CACHE_MB, int(memory_mb * GDAL_CACHE_SHARE / (workers + 1)))
+    # cores not busy with InVEST runs go to warping and compression
+    threads = max(1, cores // workers)
+    warp_threads = threads if warp_threads is None else max(1, warp_threads)
+    compress_threads = threads if compress_threads is None else max(1, compress_threads)
+
+    return ExecutionPlan(cores, memory_mb, workers, gdal_cache_mb, warp_threads, compress_threads)
+
+
+def configure(cores=None, memory_mb=None, workers=None, gdal_cache_mb=None, warp_threads=None,
+              compress_threads=None):
+    """Make and apply a new plan. Returns it."""
+    global _plan
+    _plan = make_plan(cores, memory_mb, workers, gdal_cache_mb, warp_threads, compress_threads)
+    apply(_plan)
+    return _plan
+
+
+def current():
+    """The plan in use (a default plan is made and applied the first time)."""
+    if _plan is None:
+        return configure()
+    return _plan
+
+
+def apply(plan):
+    """Set the GDAL cache and thread settings of this process."""
+    gdal.SetCacheMax(plan.gdal_cache_mb * 1024 * 1024)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(plan.warp_threads))
+
+
+def warp_options():
+    """Extra entries for the warpOptions of gdal.Warp."""
+    return ['NUM_THREADS=' + str(current().warp_threads)]
+
+
+def warp_multithread():
+    """Value for the multithread argument of gdal.Warp."""
+    return current().warp_threads > 1
+
+
+def compress_options():
+    """Extra GTiff creation options for compressed output."""
+    return ['NUM_THREADS=' + str(current().compress_threads)]
@@ -0,0 +1,107 @@
+"""
+Controls where the clipped and re-projected intermediate rasters of a basin run end up.
+
+Every basin run clips the DEM, LULC, soils, ET and precip layers only for InVEST to read
+them back a few seconds later. Instead of always writing a tiled GTiff to disk we can:
+
+    gtiff   - write a tiled GTiff to the requested output path (the original behaviour)
+    vrt     - write a warped VRT next to the requested output. GDAL only does the warp
+              when InVEST actually reads the pixels
+    vsimem  - write the GTiff into GDAL's in-memory file system (/vsimem)
+
+Anything whose estimated (uncompressed) size is larger than the spill threshold is always
+materialized on disk as a GTiff.
+"""
+
+import os
+
+from osgeo import gdal
+
+MODES = ('gtiff', 'vrt', 'vsimem')
+
+mode = 'gtiff'
+spill_to_disk_bytes = 512 * 1024 * 1024
+
+# /vsimem files handed out by warp_intermediate that have not been released yet
+_vsimem_files = []
+
+
+def configure(new_mode=None, spill_mb=None):
+    """Set the intermediate mode and/or the spill-to-disk threshold (in MB)."""
+    global mode, spill_to_disk_bytes
+
+    if new_mode is not None:
+        if new_mode not in MODES:
+            raise ValueError('Unknown intermediate mode: ' + str(new_mode))
+        mode = new_mode
+
+    if spill_mb is not None:
+        spill_to_disk_bytes = int(float(spill_mb) * 1024 * 1024)
+
+
+def estimated_bytes(ds):
+    """Uncompressed size of all bands of a dataset."""
+    band = ds.GetRasterBand(1)
+    pixel_bytes = gdal.GetDataTypeSize(band.DataType) // 8
+    return ds.RasterXSize * ds.RasterYSize * ds.RasterCount * pixel_bytes
+
+
+def _remove_siblings(outfile):
+    # make sure we never leave e.g. et_1.tif and et_1.vrt in the same folder. InVEST
+    # picks up the monthly layers by file name and would see both of them
+    base = os.path.splitext(outfile)[0]
+    for ext in ('.tif', '.vrt'):
+        if os.path.isfile(base + ext):
+            os.remove(base + ext)
+
+
+def warp_intermediate(outfile, src, creation_options, listable=False, **warp_options):
+    """
+    Warp src using warp_options and store the result according to the current mode.
+
+    listable must be True for layers that InVEST finds by listing a folder (ET, precip).
+    Those can't live in /vsimem so they fall back to a VRT on disk.
+
+    Returns the path that was actually written, which may differ from outfile.
+    """
+    _remove_siblings(outfile)
+
+    if mode == 'gtiff':
+        ds = gdal.Warp(outfile, src, format='GTiff', creationOptions=creation_options, **warp_options)
+        ds = None
+        return outfile
+
+    # set up the warp lazily first so we know how big the output would be
+    vrt_path = os.path.splitext(outfile)[0] + '.vrt'
+    if mode == 'vsimem' and not listable:
+        vrt_path = '/vsimem' + vrt_path
+
+    vrt_ds = gdal.Warp(vrt_path, src, format='VRT', **warp_options)
+    size = estimated_bytes(vrt_ds)
+
+    if size > spill_to_disk_bytes:
+        ds = gdal.Translate(outfile, vrt_ds, format='GTiff', creationOptions=creation_options)
+        ds = None
+        path = outfile
+    elif vrt_path.startswith('/vsimem'):
+        path = '/vsimem' + outfile
+        ds = gdal.Translate(path, vrt_ds, format='GTiff', creationOptions=creation_options)
+        ds = None
+        if path not in _vsimem_files:
+            _vsimem_files.append(path)
+    else:
+        path = vrt_path
+
+    vrt_ds = None
+    if path != vrt_path and vrt_path.startswith('/vsimem'):
+        gdal.Unlink(vrt_path)
+    elif path != vrt_path and os.path.isfile(vrt_path):
+        os.remove(vrt_path)
+
+    return path
+
+
+def release():
+    """Free all /vsimem intermediates handed out so far."""
+    while _vsimem_files:
+        gdal.Unlink(_vsimem_files.pop())
@@ -0,0 +1,192 @@
+"""
+Runs the InVEST seasonal water yield model in worker processes.
+
+InVEST sometimes hangs (usually when it can't work out the flow for a DEM or the watershed
+shapefile has bad data in it). A SIGALRM can't interrupt it while it is inside of C code, so
+every run gets its own child process instead. A run that takes longer than the timeout has
+its whole process group killed, and failed or timed out runs can be retried.
+
+The outcome of every job (ok / timeout / error, attempts and duration) is appended to a CSV
+file so we know which basin-model-years have to be looked at again. Every worker of a batch
+appends to the same file, under its lock (see shared_csv.py).
+"""
+
+import cProfile
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from collections import namedtuple
+
+from supporting_scripts import qf_summary
+from supporting_scripts import routing_cache
+from supporting_scripts import shared_csv
+
+OUTCOME_FIELDS = ['grdc_no', 'model', 'year', 'status', 'attempts', 'duration_s', 'error']
+
+JobOutcome = namedtuple('JobOutcome', ['job', 'status', 'attempts', 'duration', 'error'])
+
+
+def _execute(args, result_queue, cprofile_path=None, routing_cache_dir=None, summary_table=None):
+    # runs in the child. Put it in its own process group so a timeout also takes down any
+    # processes InVEST started itself
+    os.setsid()
+    try:
+        if routing_cache_dir is not None:
+            routing_cache.install(routing_cache_dir)
+
+        import natcap.invest.seasonal_water_yield.seasonal_water_yield as swy
+        if cprofile_path is None:
+            swy.execute(args)
+        else:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(swy.execute, args)
+            finally:
+                profile.dump_stats(cprofile_path)
+    except Exception:
+        result_queue.put(('error', traceback.format_exc()))
+        return
+
+    if summary_table is None:
+        result_queue.put(('ok', ''))
+        return
+    try:
+        # the qf rasters are still in the page cache
+        qf_summary.append_rows(summary_table,
+                               qf_summary.summarize_folder(os.path.join(args['workspace_dir'], 'intermediate_outputs')))
+        result_queue.put(('ok', ''))
+    except Exception:
+        # the run itself is fine, step03 can still sum its rasters
+        result_queue.put(('ok', 'qf summary failed: ' + traceback.format_exc()))
+
+
+def _kill(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # the child didn't get to setsid() yet
+        process.terminate()
+    process.join()
+
+
+def append_outcome(log_path, outcome):
+    """Append one job outcome to the CSV file at log_path (header written for new files)."""
+    error = outcome.error.strip().split('\n')[-1] if outcome.error else ''
+    shared_csv.append_rows(log_path, OUTCOME_FIELDS,
+                           [[str(outcome.job.get('grdc_no', '')),
+                             str(outcome.job.get('model', '')),
+                             str(outcome.job.get('year', '')),
+                             outcome.status,
+                             str(outcome.attempts),
+                             '{0:.1f}'.format(outcome.duration),
+                             error]])
+
+
+class InvestPool(object):
+    """
+    Runs up to max_workers InVEST jobs at the same time, each in a fresh child process.
+
+    A job is a dict with at least an 'args' entry (the InVEST args). grdc_no, model and year
+    are used for the outcome log, a 'cprofile_path' entry makes the child dump cProfile
+    stats there, a 'routing_cache_dir' entry makes it re-use the DEM-only routing outputs
+    cached there (see routing_cache.py), a 'summary_table' entry makes it append the summary
+    rows of its qf rasters to that table (see qf_summary.py) and anything else is passed back
+    untouched. on_done is called in the parent with the JobOutcome of every finished job,
+    on_tick with the list of pending and running jobs every time the pool is polled (about
+    every half second while it is waited on).
+    """
+
+    def __init__(self, max_workers=1, timeout=5 * 60, retries=0, log_path=None, on_done=None, on_tick=None):
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self.retries = retries
+        self.log_path = log_path
+        self.on_done = on_done
+        self.on_tick = on_tick
+        self.outcomes = []
+        self._pending = []
+        self._running = []
+
+    def submit(self, job):
+        """Queue a job. Blocks while the pool already has a backlog of max_workers jobs."""
+        job.setdefault('attempts', 0)
+        job.setdefault('duration', 0.0)
+        self._pending.append(job)
+        while len(self._pending) > self.max_workers:
+            self._poll()
+            time.sleep(0.5)
+        self._poll()
+
+    def wait(self):
+        """Block until all submitted jobs are finished. Returns the outcomes so far."""
+        while self._pending or self._running:
+            self._poll()
+            if self._pending or self._running:
+                time.sleep(0.5)
+        return self.outcomes
+
+    def _start(self, job):
+        job['attempts'] += 1
+        result_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_execute,
+                                          args=(job['args'], result_queue, job.get('cprofile_path'),
+                                                job.get('routing_cache_dir'), job.get('summary_table')))
+        process.start()
+        self._running.append((job, process, result_queue, time.time()))
+
+    def _poll(self):
+        still_running = []
+        for job, process, result_queue, started in self._running:
+            elapsed = time.time() - started
+            timeout = job.get('timeout', self.timeout)
+
+            # the result is read before the child is joined: a child can't exit before the
+            # parent has read what it put on the queue (a long traceback doesn't fit in the pipe)
+            try:
+                result = result_queue.get_nowait()
+            except Exception:
+                result = None
+
+            if result is None and process.is_alive() and elapsed < timeout:
+                still_running.append((job, process, result_queue, started))
+                continue
+
+            if result is not None:
+                status, error = result
+                process.join()
+            elif process.is_alive():
+                _kill(process)
+                status, error = 'timeout', 'InVEST too slow... killed after {0:.0f}s'.format(elapsed)
+            else:
+                try:
+                    status, error = result_queue.get(timeout=1)
+                except Exception:
+                    status, error = 'error', 'worker exited with code ' + str(process.exitcode)
+                process.join()
+
+            job['duration'] += elapsed
+            if status != 'ok' and job['attempts'] <= self.retries:
+                print('Retrying ' + job['args'].get('results_suffix', '') + ' after ' + status)
+                self._pending.insert(0, job)
+            else:
+                self._finish(job, status, error)
+
+        self._running = still_running
+
+        while self._pending and len(self._running) < self.max_workers:
+            self._start(self._pending.pop(0))
+
+        if self.on_tick is not None:
+            self.on_tick(self._pending + [running[0] for running in self._running])
+
+    def _finish(self, job, status, error):
+        outcome = JobOutcome(job, status, job['attempts'], job['duration'], error)
+        self.outcomes.append(outcome)
+        if status != 'ok':
+            print(error)
+        if self.log_path is not None:
+            append_outcome(self.log_path, outcome)
+        if self.on_done is not None:
+            self.on_done(outcome)
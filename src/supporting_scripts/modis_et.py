@@ -0,0 +1,107 @@
+"""
+One-time clean up of the monthly MOD16A2 ET rasters.
+
+The MODIS files flag fill values (water, urban, barren, ...) with 32761 - 32767 and don't have
+a nodata value set. This writes a clean copy of every monthly file, with all of those (and
+negative values) set to nodata, tiled, compressed and with overviews, so the basin runs only
+ever do read-only windowed reads of it.
+
+The clean copies go to et/clean/<year>/ next to the et/<year>/ folders. Run this once for all
+of the years before step02:
+
+    python -m supporting_scripts.modis_et /InVEST_Data/et/ 2000 2014
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal
+
+from supporting_scripts import block_processing
+from supporting_scripts import execution_plan
+from supporting_scripts import raster_output
+
+NODATA = -32767
+FILL_VALUE_MIN = 32761
+
+
+def clean_et_path(src):
+    """et/<year>/<file>.tif -> et/clean/<year>/<file>.tif"""
+    year_dir, name = os.path.split(os.path.abspath(src))
+    et_dir, year = os.path.split(year_dir)
+    return os.path.join(et_dir, 'clean', year, name)
+
+
+def clean_et(src, dst):
+    """Write the clean copy of src to dst, block by block (see block_processing)."""
+    src_ds = gdal.Open(src)
+    band = src_ds.GetRasterBand(1)
+    xsize = band.XSize
+    ysize = band.YSize
+
+    # the fill values are only used by the unsigned files; valid ET always fits in an Int16
+    data_type = band.DataType
+    if data_type in (gdal.GDT_Byte, gdal.GDT_UInt16):
+        data_type = gdal.GDT_Int16
+
+    dst_dir = os.path.dirname(dst)
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir)
+        except OSError:
+            # another worker made it in the meantime
+            pass
+
+    # write to a temporary file first so a concurrent run never reads a half written file
+    tmp = dst + '.{0}.tmp.tif'.format(os.getpid())
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(tmp, xsize, ysize, 1, data_type,
+                           options=raster_output.creation_options(
+                               ["TILED=YES", "COMPRESS=DEFLATE", "BLOCKXSIZE=256", "BLOCKYSIZE=256"], data_type) +
+                                   execution_plan.compress_options())
+    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    dst_ds.SetProjection(src_ds.GetProjection())
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue(NODATA)
+
+    old_nodata = band.GetNoDataValue()
+
+    def clean(data, window):
+        invalid = (data >= FILL_VALUE_MIN) | (data < 0)
+        if old_nodata is not None:
+            invalid |= data == old_nodata
+        return np.where(invalid, NODATA, data)
+
+    block_processing.run_blocks(src, dst_band, clean)
+
+    dst_ds.BuildOverviews('AVERAGE', [2, 4, 8, 16])
+    dst_ds = None
+    src_ds = None
+
+    os.rename(tmp, dst)
+
+
+def ensure_clean_et(src):
+    """Path of the clean copy of src. It is made first if it is missing or older than src."""
+    dst = clean_et_path(src)
+    if not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+        print('Cleaning ' + src)
+        clean_et(src, dst)
+    return dst
+
+
+if __name__ == '__main__':
+    et_root = sys.argv[1]
+    first_year = int(sys.argv[2])
+    last_year = int(sys.argv[3])
+
+    for year in range(first_year, last_year + 1):
+        for month in range(1, 13):
+            src = os.path.join(et_root, str(year), 'MOD16A2_ET_0.05deg_GEO_{1}M{0:02d}.tif'.format(month, year))
+            if os.path.exists(src):
+                ensure_clean_et(src)
+            else:
+                print('File does not exist:\t' + src)
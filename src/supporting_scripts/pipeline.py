@@ -0,0 +1,179 @@
+"""
+Runs only the stale parts of a pipeline of scripts (see run_pipeline.py for our steps).
+
+A pipeline is a list of stages in dependency order, and a stage is a list of partitions (all
+of it, a shard of the basins, ...). Every partition declares the files it reads, the files it
+writes and the command that makes them. Its fingerprint is the content hash of its inputs plus
+its command and parameters; a partition is stale if that fingerprint differs from the one of
+its last successful run, or if one of its outputs is missing. The stale partitions of a stage
+run in parallel (they don't depend on each other), then the next stage is looked at, so a
+stage whose inputs were just rewritten by the one before is seen as stale.
+
+The content hashes are kept in the state file (SQLite) with the size and mtime of the file, so
+a file is only read again when it changed. Directories (e.g. the thousands of watershed
+shapefiles) are fingerprinted by the names, sizes and mtimes of their files instead.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class Partition(object):
+    """One unit of work of a stage: key names it within the stage (e.g. 'shard_0_of_8')."""
+
+    def __init__(self, stage, key, inputs, outputs, command, params=None, cwd=None, env=None):
+        self.stage = stage
+        self.key = key
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.command = list(command)
+        self.params = params or {}
+        self.cwd = cwd
+        self.env = env
+
+    @property
+    def name(self):
+        return self.stage + ':' + self.key
+
+
+class Stage(object):
+
+    def __init__(self, name, partitions):
+        self.name = name
+        self.partitions = list(partitions)
+
+
+class PipelineState(object):
+    """The file hashes and the fingerprints of the last successful run of every partition."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                          'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS partitions ('
+                          'stage TEXT, key TEXT, fingerprint TEXT, seconds REAL, updated REAL, '
+                          'PRIMARY KEY (stage, key))')
+        self.conn.commit()
+
+    def file_hash(self, path):
+        """sha1 of the content of a file, only read again when its size or mtime changed."""
+        stat = os.stat(path)
+        found = self.conn.execute('SELECT size, mtime, sha1 FROM files WHERE path = ?', (path,)).fetchone()
+        if found is not None and found[0] == stat.st_size and found[1] == stat.st_mtime:
+            return found[2]
+
+        sha = hashlib.sha1()
+        with open(path, 'rb') as myfile:
+            block = myfile.read(HASH_BLOCK_SIZE)
+            while block:
+                sha.update(block)
+                block = myfile.read(HASH_BLOCK_SIZE)
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                          (path, stat.st_size, stat.st_mtime, sha.hexdigest()))
+        self.conn.commit()
+        return sha.hexdigest()
+
+    def fingerprint(self, partition):
+        """Content hash of the inputs, command and parameters of partition."""
+        sha = hashlib.sha1()
+        for path in sorted(set(partition.inputs)):
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    stat = os.stat(os.path.join(path, name))
+                    sha.update('{0}/{1}|{2}|{3}\n'.format(path, name, stat.st_size, stat.st_mtime).encode('utf-8'))
+            elif os.path.exists(path):
+                sha.update('{0}|{1}\n'.format(path, self.file_hash(path)).encode('utf-8'))
+            else:
+                # a missing input is part of the fingerprint too, so it showing up later changes it
+                sha.update('{0}|missing\n'.format(path).encode('utf-8'))
+        sha.update(json.dumps([partition.command, partition.params], sort_keys=True, default=str).encode('utf-8'))
+        return sha.hexdigest()
+
+    def last_fingerprint(self, partition):
+        found = self.conn.execute('SELECT fingerprint FROM partitions WHERE stage = ? AND key = ?',
+                                  (partition.stage, partition.key)).fetchone()
+        return None if found is None else found[0]
+
+    def record(self, partition, fingerprint, seconds):
+        self.conn.execute('INSERT OR REPLACE INTO partitions VALUES (?, ?, ?, ?, ?)',
+                          (partition.stage, partition.key, fingerprint, seconds, time.time()))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def is_stale(partition, fingerprint, state):
+    if state.last_fingerprint(partition) != fingerprint:
+        return True
+    return not all(os.path.exists(path) for path in partition.outputs)
+
+
+def _log_path(log_dir, partition):
+    return os.path.join(log_dir, '{0}_{1}.log'.format(partition.stage, partition.key))
+
+
+def run_partition(partition, log_dir=None):
+    """Run the command of partition (output to its log file). Returns (partition, return code, seconds)."""
+    start = time.time()
+    if log_dir is None:
+        code = subprocess.call(partition.command, cwd=partition.cwd, env=partition.env)
+    else:
+        with open(_log_path(log_dir, partition), 'w') as log:
+            code = subprocess.call(partition.command, cwd=partition.cwd, env=partition.env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+    return partition, code, time.time() - start
+
+
+def run_pipeline(stages, state, jobs=1, force=False, dry_run=False, log_dir=None):
+    """
+    Run the stale partitions of every stage, jobs of them at the same time, a stage after the
+    other. A stage with a failed partition stops the pipeline. Returns the names of the
+    partitions that failed.
+    """
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    for stage in stages:
+        todo = []
+        for partition in stage.partitions:
+            fingerprint = state.fingerprint(partition)
+            if force or is_stale(partition, fingerprint, state):
+                todo.append((partition, fingerprint))
+        print(stage.name + ': ' + str(len(todo)) + ' of ' + str(len(stage.partitions)) + ' partitions to run')
+        if dry_run:
+            for partition, _ in todo:
+                print('  ' + partition.name + ': ' + ' '.join(partition.command))
+            continue
+        if not todo:
+            continue
+
+        fingerprints = dict((partition.name, fingerprint) for partition, fingerprint in todo)
+        failed = []
+        pool = ThreadPool(max(1, min(jobs, len(todo))))
+        try:
+            for partition, code, seconds in pool.imap_unordered(lambda pf: run_partition(pf[0], log_dir), todo):
+                if code == 0:
+                    state.record(partition, fingerprints[partition.name], seconds)
+                    print('  ' + partition.name + ' done in ' + str(int(seconds)) + ' s')
+                else:
+                    failed.append(partition.name)
+                    print('  ' + partition.name + ' FAILED (exit code ' + str(code) + ')' +
+                          ('' if log_dir is None else ', see ' + _log_path(log_dir, partition)))
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            return failed
+    return []
@@ -0,0 +1,138 @@
+"""
+The paths and run settings of the step01 -> step02 -> step03 pipeline, from one config file.
+
+The steps used to have their paths as constants at the top of each script. They are now read
+from an INI file, pipeline.cfg next to the step scripts by default, or the file named by the
+INVEST_SNOW17_CONFIG environment variable (run_pipeline.py sets it for the steps it starts).
+Anything the file doesn't set keeps the value in DEFAULTS, so the steps work without one.
+
+    [paths]
+    share_path = /InVEST_Data/
+    netcdf_path = /clipped/
+    template_file = /templates/template.tif
+    # step01 writes the monthly rasters here, in the layout step02 reads
+    step01_output_path = %(share_path)s
+    # the final_tiffs archives and the tables step03 writes (whitespace separated)
+    archives = %(share_path)sfinal_tiffs_01.tar.gz
+    results = %(share_path)sWaterSI_Model.csv
+
+    [run]
+    years = 2000-2014
+    models = snow17 raw
+
+    # how the node is shared out (see execution_plan.py); empty means worked out from the node
+    [plan]
+    cores =
+    memory_mb =
+    workers =
+    gdal_cache_mb =
+    warp_threads =
+    compress_threads =
+"""
+
+import os
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+CONFIG_ENV = 'INVEST_SNOW17_CONFIG'
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipeline.cfg')
+
+DEFAULTS = {
+    'paths': {
+        'share_path': '/InVEST_Data/',
+        'netcdf_path': '/clipped/',
+        'template_file': '/templates/template.tif',
+        'step01_output_path': '%(share_path)s',
+        'archives': '%(share_path)sfinal_tiffs_01.tar.gz %(share_path)sfinal_tiffs_02.tar.gz '
+                    '%(share_path)sfinal_tiffs_03.tar.gz',
+        'results': '%(share_path)sWaterSI_Model.csv',
+    },
+    'run': {
+        'years': '2000-2014',
+        'models': 'snow17 raw',
+    },
+    'plan': {
+        'cores': '',
+        'memory_mb': '',
+        'workers': '',
+        'gdal_cache_mb': '',
+        'warp_threads': '',
+        'compress_threads': '',
+    },
+}
+
+_config = None
+
+
+def parse_years(value):
+    """'2000-2014' or '2000 2003 2007' (or both mixed, comma or space separated) -> a list of years."""
+    years = []
+    for part in value.replace(',', ' ').split():
+        if '-' in part:
+            first, last = part.split('-')
+            years.extend(range(int(first), int(last) + 1))
+        else:
+            years.append(int(part))
+    return years
+
+
+class PipelineConfig(object):
+
+    def __init__(self, path=None):
+        self.path = path
+        self.parser = configparser.ConfigParser()
+        for section in sorted(DEFAULTS):
+            self.parser.add_section(section)
+            for key in sorted(DEFAULTS[section]):
+                self.parser.set(section, key, DEFAULTS[section][key])
+        if path is not None:
+            if not self.parser.read(path):
+                raise ValueError('Unable to read the config file ' + path)
+
+    def get(self, section, key):
+        return self.parser.get(section, key)
+
+    def path_of(self, key):
+        return self.get('paths', key)
+
+    def paths_of(self, key):
+        """A whitespace separated list of paths."""
+        return self.get('paths', key).split()
+
+    def plan_setting(self, key):
+        """A setting of the [plan] section, None if it is empty."""
+        value = self.get('plan', key).strip()
+        return value or None
+
+    @property
+    def share_path(self):
+        return self.path_of('share_path')
+
+    @property
+    def years(self):
+        return parse_years(self.get('run', 'years'))
+
+    @property
+    def models(self):
+        return self.get('run', 'models').replace(',', ' ').split()
+
+
+def load(path=None):
+    """Read the config (path, the environment variable or pipeline.cfg) and make it the current one."""
+    global _config
+    if path is None:
+        path = os.environ.get(CONFIG_ENV)
+    if path is None and os.path.exists(DEFAULT_CONFIG):
+        path = DEFAULT_CONFIG
+    _config = PipelineConfig(path)
+    return _config
+
+
+def current():
+    """The config of this process, loaded on first use."""
+    if _config is None:
+        load()
+    return _config
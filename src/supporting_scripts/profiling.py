@@ -0,0 +1,133 @@
+"""
+Timing of the stages of a step02 batch.
+
+Every timed stage is written as one JSON object per line (stage, start, duration_s, status,
+depth and whatever attributes the caller adds, e.g. basin id, year, model, raster size). depth
+is 1 for a span inside another span of the main process (it is part of the time of its
+parent), and spans timed in the worker processes are marked worker (they overlap each other
+and the main process). The summary gives the share of the wall time of the batch per stage:
+
+    python -m supporting_scripts.profiling /InVEST_Data/profile.jsonl
+"""
+
+from __future__ import print_function, division
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """Writes timing spans to a JSON lines file. With no path it does nothing."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = path is not None
+        # spans of the main process open right now
+        self.depth = 0
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        """
+        Time the with-block as stage. The yielded dict can be used to add attributes that
+        are only known at the end (e.g. the size of the raster that was written).
+        """
+        record = dict(attrs)
+        start = time.time()
+        status = 'ok'
+        depth = self.depth
+        self.depth += 1
+        try:
+            yield record
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            self.depth -= 1
+            if self.enabled:
+                self._write(stage, time.time() - start, start, status, depth, False, record)
+
+    def record(self, stage, duration, start=None, status='ok', **attrs):
+        """Write a span that was timed somewhere else (in a worker process, so it is marked worker)."""
+        if not self.enabled:
+            return
+        self._write(stage, duration, time.time() - duration if start is None else start, status, 0, True, attrs)
+
+    def _write(self, stage, duration, start, status, depth, worker, attrs):
+        record = dict(attrs)
+        record.update({'stage': stage,
+                       'start': start,
+                       'duration_s': round(duration, 4),
+                       'status': status,
+                       'depth': depth,
+                       'worker': worker})
+        with open(self.path, 'a') as myfile:
+            myfile.write(json.dumps(record, sort_keys=True, default=str) + '\n')
+
+
+def raster_size(path):
+    """xsize, ysize and pixel count of a raster, for span attributes."""
+    from osgeo import gdal
+
+    ds = gdal.Open(path)
+    size = {'xsize': ds.RasterXSize, 'ysize': ds.RasterYSize, 'pixels': ds.RasterXSize * ds.RasterYSize}
+    ds = None
+    return size
+
+
+def read_profile(path):
+    records = []
+    with open(path) as myfile:
+        for line in myfile:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def summarize(path, top=10, out=sys.stdout):
+    """
+    Print the time per stage and the slowest basins of a profile file. share is the time of a
+    stage over the wall time of the batch. The top level stages of the main process add up to
+    at most 100% (the rest is the main process waiting on the workers); nested stages (indented)
+    are part of their parent's share; worker stages overlap, so 300% means three workers were
+    busy with it on average.
+    """
+    records = read_profile(path)
+    if not records:
+        return
+    wall = (max(r['start'] + r['duration_s'] for r in records) - min(r['start'] for r in records)) or 1.0
+    main_total = sum(r['duration_s'] for r in records if not r.get('worker') and not r.get('depth'))
+
+    stages = {}
+    basins = {}
+    for r in records:
+        stage = stages.setdefault(r['stage'], {'count': 0, 'total': 0.0, 'max': 0.0, 'errors': 0,
+                                               'nested': bool(r.get('depth')), 'worker': bool(r.get('worker'))})
+        stage['count'] += 1
+        stage['total'] += r['duration_s']
+        stage['max'] = max(stage['max'], r['duration_s'])
+        if r.get('status') != 'ok':
+            stage['errors'] += 1
+        # nested spans are already in the time of their parent
+        if 'grdc_no' in r and not r.get('depth'):
+            basins[r['grdc_no']] = basins.get(r['grdc_no'], 0.0) + r['duration_s']
+
+    print('wall time {0:.1f} s, main process busy {1:.1%} of it'.format(wall, main_total / wall), file=out)
+    print('stage\tcount\ttotal_s\tmean_s\tmax_s\tshare\terrors', file=out)
+    for name, stage in sorted(stages.items(), key=lambda item: (item[1]['worker'], -item[1]['total'])):
+        label = ('  ' if stage['nested'] else '') + name + (' (workers)' if stage['worker'] else '')
+        print('{0}\t{1}\t{2:.1f}\t{3:.2f}\t{4:.2f}\t{5:.1%}\t{6}'.format(
+            label, stage['count'], stage['total'], stage['total'] / stage['count'], stage['max'],
+            stage['total'] / wall, stage['errors']), file=out)
+
+    if basins:
+        print('', file=out)
+        print('slowest basins', file=out)
+        for grdc_no, seconds in sorted(basins.items(), key=lambda item: -item[1])[:top]:
+            print('{0}\t{1:.1f}'.format(grdc_no, seconds), file=out)
+
+
+if __name__ == '__main__':
+    summarize(sys.argv[1])
@@ -0,0 +1,66 @@
+"""
+The summary row of a qf raster: qf sum, pixel count, geotransform and cubic meters.
+
+step03 makes these rows from the qf rasters in the final_tiffs archives. step02 makes the
+same rows right after every InVEST run, in the worker, while the rasters are still in the
+page cache, and appends them to a shared table. Many workers (and nodes) append to the same
+table, so the appends take the lock of the table (see shared_csv.py).
+
+The rows are the rows of results_table.py.
+"""
+
+import os
+
+from osgeo import gdal
+
+from supporting_scripts import raster_stats
+from supporting_scripts import results_table
+from supporting_scripts import shared_csv
+
+
+def parse_qf_name(name):
+    """qf_<month>_<ws>_<model>_<year>.tif -> year, month, ws, model"""
+    parts = name.split("/")[-1:][0].split("_")
+
+    model = 'non-snow' if parts[3] == 'raw' else 'snow'
+    year = parts[-1].rstrip('.tif')
+    month = parts[1]
+    ws = parts[2]
+    return year, month, ws, model
+
+
+def is_qf_name(name):
+    return name[-4:] == ".tif" and "qf_" in name
+
+
+def summarize_raster(source, name):
+    """The row of one qf raster. source is a path or an open dataset, name its file name."""
+    year, month, ws, model = parse_qf_name(name)
+
+    ds = source if isinstance(source, gdal.Dataset) else gdal.Open(source)
+    if ds is None:
+        raise ValueError('Unable to open ' + name)
+
+    # sum and count of the valid pixels, in one pass block by block
+    stats = raster_stats.reduce_band(ds)
+    geotransform = ds.GetGeoTransform()
+    ds = None
+
+    return results_table.make_row(year, month, ws, model, stats.sum, stats.count, geotransform,
+                                  name.split("/")[-1])
+
+
+def summarize_folder(folder):
+    """The rows of all of the qf rasters in a folder (e.g. the InVEST intermediate_outputs)."""
+    names = sorted(fname for fname in os.listdir(folder)
+                   if is_qf_name(fname) and os.path.isfile(os.path.join(folder, fname)))
+    return [summarize_raster(os.path.join(folder, fname), fname) for fname in names]
+
+
+def append_rows(table_path, rows):
+    """Append rows to the shared CSV table, holding the lock of the table while writing."""
+    with shared_csv.locked(table_path):
+        writer = results_table.CsvWriter(table_path, append=True)
+        for row in rows:
+            writer.writerow(row)
+        writer.close()
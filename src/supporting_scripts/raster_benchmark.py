@@ -0,0 +1,103 @@
+"""
+Size and write/read speed of the raster output options on our own rasters.
+
+Every raster given is read once and written with each of the options below (through
+raster_output.write_raster, so the same way the step scripts write). For each option the
+table shows the file size, the write time, the time to read the full resolution and the time
+of a coarse (1/8) read, which can use the overviews of a COG. The files are read right after
+they are written, so the reads come from the OS cache: they show decompression cost, not disk.
+
+    python -m supporting_scripts.raster_benchmark /InVEST_Data/precip/snow17/2007/snow17_h2o_2007_1.tif ...
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+
+from supporting_scripts import raster_output
+
+# (label, profile, codec, level)
+OPTIONS = [('gtiff deflate (current)', 'gtiff', None, None),
+           ('gtiff deflate+predictor', 'gtiff', 'DEFLATE', None),
+           ('gtiff deflate+predictor l9', 'gtiff', 'DEFLATE', 9),
+           ('gtiff lzw+predictor', 'gtiff', 'LZW', None),
+           ('gtiff zstd+predictor', 'gtiff', 'ZSTD', None),
+           ('cog deflate', 'cog', 'DEFLATE', None),
+           ('cog zstd', 'cog', 'ZSTD', None),
+           ('cog zstd l9', 'cog', 'ZSTD', 9)]
+
+BASE_OPTIONS = ["TILED=YES", "COMPRESS=DEFLATE", "BLOCKXSIZE=512", "BLOCKYSIZE=512"]
+
+
+def _read_seconds(path, factor=1):
+    start = time.time()
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    band.ReadAsArray(buf_xsize=max(1, ds.RasterXSize // factor), buf_ysize=max(1, ds.RasterYSize // factor))
+    ds = None
+    return time.time() - start
+
+
+def benchmark(raster, out_dir):
+    """One dict per option: label, size_mb, write_s, read_s, coarse_read_s."""
+    src_ds = gdal.Open(raster)
+    band = src_ds.GetRasterBand(1)
+    array = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    geotransform = src_ds.GetGeoTransform()
+    projection = src_ds.GetProjection()
+    data_type = band.DataType
+    xsize, ysize = src_ds.RasterXSize, src_ds.RasterYSize
+    src_ds = None
+
+    def fill(ds):
+        ds.SetGeoTransform(geotransform)
+        ds.SetProjection(projection)
+        if nodata is not None:
+            ds.GetRasterBand(1).SetNoDataValue(nodata)
+        ds.GetRasterBand(1).WriteArray(array)
+
+    results = []
+    for i, (label, profile, codec, level) in enumerate(OPTIONS):
+        path = os.path.join(out_dir, 'option_{0}.tif'.format(i))
+        if codec is not None and gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST').find(codec) < 0:
+            print('Skipping ' + label + ': GDAL was built without ' + codec)
+            continue
+
+        start = time.time()
+        raster_output.write_raster(path, xsize, ysize, 1, data_type, BASE_OPTIONS, fill,
+                                   profile=profile, codec=codec, level=level)
+        write_s = time.time() - start
+
+        results.append({'label': label,
+                        'size_mb': os.path.getsize(path) / (1024.0 * 1024.0),
+                        'write_s': write_s,
+                        'read_s': _read_seconds(path),
+                        'coarse_read_s': _read_seconds(path, 8)})
+        os.remove(path)
+    return results
+
+
+def print_results(raster, results, out=sys.stdout):
+    print(raster, file=out)
+    print('{0:<30} {1:>10} {2:>9} {3:>9} {4:>10}'.format('option', 'size MB', 'write s', 'read s', 'read 1/8 s'),
+          file=out)
+    for result in results:
+        print('{label:<30} {size_mb:>10.2f} {write_s:>9.3f} {read_s:>9.3f} {coarse_read_s:>10.3f}'.format(**result),
+              file=out)
+    print('', file=out)
+
+
+if __name__ == '__main__':
+    out_dir = tempfile.mkdtemp(prefix='raster_benchmark_')
+    try:
+        for raster in sys.argv[1:]:
+            print_results(raster, benchmark(raster, out_dir))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
@@ -0,0 +1,177 @@
+"""
+How the rasters we write are laid out and compressed.
+
+Two profiles:
+
+    gtiff   - a plain GeoTIFF, with the options every writer always used (the default)
+    cog     - a cloud optimized GeoTIFF: 512 x 512 tiles, a predictor (floating point for
+              float rasters, horizontal differencing for integers) and internal overviews, so
+              visual checks and coarse reads don't have to scan the full resolution
+
+The codec (DEFLATE, ZSTD, LZW, ...) and its level can be set for either profile; setting them
+on the gtiff profile also turns on the predictor. The profile is picked with configure() or
+the environment variables INVEST_SNOW17_RASTER_PROFILE, INVEST_SNOW17_RASTER_CODEC and
+INVEST_SNOW17_RASTER_LEVEL (step01 has no command line).
+
+Writers that Create their output use write_raster(); a COG is first written to /vsimem
+and then copied out in COG layout (with the COG driver if GDAL has it, otherwise as a GeoTIFF
+with COPY_SRC_OVERVIEWS). /vsimem holds the full uncompressed raster plus its overviews, so a
+raster bigger than MAX_VSIMEM_MB is staged in a temporary GeoTIFF next to the output instead.
+Warps only take creation_options(): the clipped layers are read by InVEST once, so they get
+the codec and predictor but no overviews.
+
+supporting_scripts/raster_benchmark.py compares the options on our own rasters.
+"""
+
+import os
+import uuid
+
+from osgeo import gdal
+
+from supporting_scripts import execution_plan
+
+PROFILES = ('gtiff', 'cog')
+
+COG_BLOCK_SIZE = 512
+OVERVIEW_RESAMPLING = 'AVERAGE'
+# uncompressed size (with overviews) above which a COG is staged on disk instead of in memory
+MAX_VSIMEM_MB = int(os.environ.get('INVEST_SNOW17_MAX_VSIMEM_MB', 512))
+
+_profile = os.environ.get('INVEST_SNOW17_RASTER_PROFILE', 'gtiff')
+_codec = os.environ.get('INVEST_SNOW17_RASTER_CODEC')
+_level = os.environ.get('INVEST_SNOW17_RASTER_LEVEL')
+
+# the creation options that say how a GeoTIFF is compressed and tiled; a profile replaces them
+_LAYOUT_OPTIONS = ('TILED=', 'BLOCKXSIZE=', 'BLOCKYSIZE=', 'COMPRESS=', 'PREDICTOR=', 'ZLEVEL=',
+                   'ZSTD_LEVEL=', 'LEVEL=')
+
+
+def configure(profile=None, codec=None, level=None):
+    global _profile, _codec, _level
+    if profile is not None:
+        if profile not in PROFILES:
+            raise ValueError('Unknown raster profile ' + str(profile) + ', use one of ' + ', '.join(PROFILES))
+        _profile = profile
+    if codec is not None:
+        _codec = codec.upper()
+    if level is not None:
+        _level = int(level)
+
+
+def current_profile():
+    return _profile
+
+
+def predictor(data_type):
+    """3 (floating point) for float rasters, 2 (horizontal differencing) for the rest."""
+    if data_type in (gdal.GDT_Float32, gdal.GDT_Float64):
+        return 3
+    return 2
+
+
+def _codec_options(data_type, codec, level):
+    options = ['COMPRESS=' + codec]
+    if codec in ('DEFLATE', 'LZW', 'ZSTD', 'LZMA'):
+        options.append('PREDICTOR=' + str(predictor(data_type)))
+    if level is not None:
+        if codec == 'DEFLATE':
+            options.append('ZLEVEL=' + str(level))
+        elif codec == 'ZSTD':
+            options.append('ZSTD_LEVEL=' + str(level))
+    return options
+
+
+def creation_options(base, data_type, profile=None, codec=None, level=None):
+    """
+    GTiff creation options for a raster of data_type. base are the options the writer always
+    used; they are kept as they are for the gtiff profile without a codec set.
+    """
+    profile = _profile if profile is None else profile
+    codec = _codec if codec is None else codec
+    level = _level if level is None else level
+    if profile == 'gtiff' and codec is None:
+        return list(base)
+
+    options = [option for option in base if not option.upper().startswith(_LAYOUT_OPTIONS)]
+    options += ['TILED=YES', 'BLOCKXSIZE=' + str(COG_BLOCK_SIZE), 'BLOCKYSIZE=' + str(COG_BLOCK_SIZE)]
+    return options + _codec_options(data_type, codec or 'DEFLATE', level)
+
+
+def overview_levels(xsize, ysize):
+    """2, 4, 8, ... until the overview fits in one tile."""
+    levels = []
+    factor = 2
+    while max(xsize, ysize) / float(factor) > COG_BLOCK_SIZE / 2.0:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def write_raster(dst_filename, xsize, ysize, bands, data_type, base_options, fill,
+                 profile=None, codec=None, level=None):
+    """
+    Create dst_filename, have fill(ds) write the georeferencing and pixels into it, then close
+    it. For the cog profile the raster is filled in /vsimem (or a temporary GeoTIFF next to
+    dst_filename, see staging_path_for), gets its overviews there and is copied out in COG layout.
+    """
+    profile = _profile if profile is None else profile
+    options = creation_options(base_options, data_type, profile, codec, level) + execution_plan.compress_options()
+    driver = gdal.GetDriverByName('GTiff')
+    if profile != 'cog':
+        ds = driver.Create(dst_filename, xsize, ysize, bands, data_type, options=options)
+        fill(ds)
+        ds.FlushCache()  # Write to disk.
+        ds = None
+        return
+
+    # the temporary copy doesn't need to be compressed
+    staging_path = staging_path_for(dst_filename, xsize, ysize, bands, data_type)
+    staging_options = [option for option in options if not option.upper().startswith(_LAYOUT_OPTIONS)]
+    if not staging_path.startswith('/vsimem/'):
+        staging_options.append('BIGTIFF=IF_SAFER')
+    ds = driver.Create(staging_path, xsize, ysize, bands, data_type, options=staging_options + ['TILED=YES'])
+    try:
+        fill(ds)
+        levels = overview_levels(xsize, ysize)
+        if levels:
+            ds.BuildOverviews(OVERVIEW_RESAMPLING, levels)
+        _copy_as_cog(ds, dst_filename, options)
+    finally:
+        ds = None
+        if staging_path.startswith('/vsimem/'):
+            gdal.Unlink(staging_path)
+        elif os.path.exists(staging_path):
+            os.remove(staging_path)
+
+
+def staging_path_for(dst_filename, xsize, ysize, bands, data_type):
+    """Where a COG is built before it is copied out: /vsimem, or next to it for big rasters."""
+    # the overviews add up to a third of the full resolution
+    size_mb = xsize * ysize * bands * (gdal.GetDataTypeSize(data_type) // 8) * 4 / 3.0 / (1024 * 1024)
+    name = 'cog_{0}.tif'.format(uuid.uuid4().hex)
+    if size_mb <= MAX_VSIMEM_MB:
+        return '/vsimem/' + name
+    return os.path.join(os.path.dirname(os.path.abspath(dst_filename)), '.' + name)
+
+
+def _copy_as_cog(ds, dst_filename, options):
+    cog_driver = gdal.GetDriverByName('COG')
+    if cog_driver is not None:
+        # the COG driver has its own names for the layout options
+        cog_options = ['BLOCKSIZE=' + str(COG_BLOCK_SIZE), 'OVERVIEWS=FORCE_USE_EXISTING']
+        for option in options:
+            key = option.split('=')[0].upper()
+            if key in ('COMPRESS', 'PREDICTOR', 'NUM_THREADS'):
+                cog_options.append(option)
+            elif key in ('ZLEVEL', 'ZSTD_LEVEL'):
+                cog_options.append('LEVEL=' + option.split('=')[1])
+        out = cog_driver.CreateCopy(dst_filename, ds, 0, options=cog_options)
+    else:
+        # a GeoTIFF with the overviews copied in after the full resolution data is laid out the
+        # same way (GDAL < 3.1)
+        compress = [option.split('=')[1] for option in options if option.upper().startswith('COMPRESS=')]
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', compress[0] if compress else None)
+        out = gdal.GetDriverByName('GTiff').CreateCopy(dst_filename, ds, 0,
+                                                         options=options + ['COPY_SRC_OVERVIEWS=YES'])
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+    out = None
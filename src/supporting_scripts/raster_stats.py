@@ -0,0 +1,134 @@
+"""
+One pass, block by block statistics of a raster band.
+
+reduce_band reads a band in chunks that are whole multiples of its native block size and
+keeps running totals, so sum, count, min, max, mean and std come out of a single read of
+the data with bounded memory. Nodata and NaN pixels are skipped. It works on anything GDAL
+opens (files, /vsimem buffers, VRTs), on an open dataset or band, and on a window of the
+band, optionally with a mask of the pixels to include (e.g. a zonal_stats.ZoneMask).
+
+The std is the population std, the same as GDAL's GetStatistics.
+"""
+
+import math
+
+import numpy as np
+from osgeo import gdal
+
+# about the most pixels read at once (32 MB of float64)
+MAX_CHUNK_PIXELS = 4 * 1024 * 1024
+
+
+class RasterStats(object):
+    """Running count, sum, min, max and sum of squared deviations of the values seen so far."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, values):
+        """Add a 1-d array of (valid) values."""
+        n = int(values.size)
+        if n == 0:
+            return
+        values = values.astype(np.float64)
+        chunk_sum = float(values.sum())
+        chunk_mean = chunk_sum / n
+        chunk_m2 = float(np.square(values - chunk_mean).sum())
+        self._combine(n, chunk_sum, chunk_mean, chunk_m2, float(values.min()), float(values.max()))
+
+    def merge(self, other):
+        """Add the values seen by another RasterStats (e.g. of another window)."""
+        if other.count:
+            self._combine(other.count, other.sum, other._mean, other._m2, other.min, other.max)
+
+    def _combine(self, n, chunk_sum, chunk_mean, chunk_m2, chunk_min, chunk_max):
+        # Chan et al. pairwise update of the mean and the squared deviations
+        total = self.count + n
+        delta = chunk_mean - self._mean
+        self._m2 += chunk_m2 + delta * delta * self.count * n / total
+        self._mean += delta * n / total
+        self.count = total
+        self.sum += chunk_sum
+        self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+        self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+
+    @property
+    def mean(self):
+        return self._mean if self.count else None
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count else None
+
+    def as_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.mean, 'std': self.std}
+
+
+def _open_band(source, band_number):
+    # returns the band and whatever has to be kept alive for it
+    if isinstance(source, gdal.Band):
+        return source, None
+    ds = source if isinstance(source, gdal.Dataset) else gdal.Open(source)
+    if ds is None:
+        raise ValueError('Unable to open ' + str(source))
+    return ds.GetRasterBand(band_number), ds
+
+
+def chunks(band, window=None):
+    """(xoff, yoff, xsize, ysize) chunks covering the window, in multiples of the native block size."""
+    if window is None:
+        window = (0, 0, band.XSize, band.YSize)
+    xoff, yoff, xsize, ysize = window
+    x_block, y_block = band.GetBlockSize()
+
+    if xsize * y_block <= MAX_CHUNK_PIXELS:
+        # full width strips of as many block rows as fit
+        cols = xsize
+        rows = y_block * max(1, MAX_CHUNK_PIXELS // (xsize * y_block))
+    else:
+        cols = x_block * max(1, MAX_CHUNK_PIXELS // (x_block * y_block))
+        rows = y_block
+
+    for i in range(0, ysize, rows):
+        for j in range(0, xsize, cols):
+            yield xoff + j, yoff + i, min(cols, xsize - j), min(rows, ysize - i)
+
+
+def reduce_band(source, band_number=1, window=None, mask=None, nodata=None):
+    """
+    Statistics of the valid pixels of a band, read block by block.
+
+    source is a path, a gdal.Dataset or a gdal.Band. window is (xoff, yoff, xsize, ysize) in
+    pixels, the whole band by default. mask, if given, is a boolean array the shape of the
+    window (ysize, xsize); only the pixels where it is True count. nodata overrides the
+    nodata value of the band. Returns a RasterStats.
+    """
+    band, ds = _open_band(source, band_number)
+    if window is None:
+        window = (0, 0, band.XSize, band.YSize)
+    if nodata is None:
+        nodata = band.GetNoDataValue()
+
+    stats = RasterStats()
+    if window[2] <= 0 or window[3] <= 0:
+        return stats
+
+    for x, y, cols, rows in chunks(band, window):
+        data = band.ReadAsArray(x, y, cols, rows)
+
+        valid = ~np.isnan(data) if data.dtype.kind == 'f' else np.ones(data.shape, dtype=bool)
+        if nodata is not None:
+            valid &= data != nodata
+        if mask is not None:
+            valid &= mask[y - window[1]:y - window[1] + rows, x - window[0]:x - window[0] + cols]
+
+        stats.add(data[valid])
+
+    ds = None
+    return stats
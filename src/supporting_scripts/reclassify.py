@@ -0,0 +1,149 @@
+"""
+Reclassify categorical rasters (soils, LULC, ...) to the codes InVEST wants.
+
+A Reclassifier is made from either
+
+    intervals - breaks [b0, b1, ..., bn] and one value per interval: [b0, b1) -> v0, ...,
+                [bn-1, bn) -> vn-1 and >= bn -> vn. Anything below b0 gets `below`
+                (nodata by default). Applied with a single np.digitize per block.
+    a value map - {input value: output value}, anything else gets `default` (nodata by
+                default). Compiled to a lookup table indexed by the input value.
+
+Input nodata (and NaN) pixels always become the output nodata. The output data type is the
+smallest one that holds all of the output values and the nodata value (so 255 is really 255,
+not -1 in an int8).
+
+    soils = Reclassifier.from_intervals([1, 6, 7, 10, 13], [4, 3, 2, 1, 255], nodata=0)
+    reclassify_raster(in_file, out_file, soils)
+"""
+
+import numpy as np
+from osgeo import gdal
+
+from supporting_scripts import block_processing
+from supporting_scripts import raster_output
+
+# value maps with a key range bigger than this are looked up with searchsorted instead of a table
+MAX_LOOKUP_TABLE = 1 << 24
+
+_GDAL_TYPES = [(np.uint8, gdal.GDT_Byte), (np.uint16, gdal.GDT_UInt16), (np.int16, gdal.GDT_Int16),
+               (np.uint32, gdal.GDT_UInt32), (np.int32, gdal.GDT_Int32), (np.float32, gdal.GDT_Float32),
+               (np.float64, gdal.GDT_Float64)]
+
+
+def output_dtype(values):
+    """The smallest numpy dtype (of the ones GDAL can write) that holds all of values."""
+    values = np.asarray(values)
+    for dtype, _ in _GDAL_TYPES:
+        if np.issubdtype(dtype, np.integer):
+            if not np.all(np.mod(values, 1) == 0):
+                continue
+            info = np.iinfo(dtype)
+            if values.min() >= info.min and values.max() <= info.max:
+                return np.dtype(dtype)
+        else:
+            return np.dtype(dtype)
+    return np.dtype(np.float64)
+
+
+def gdal_type(dtype):
+    for numpy_type, data_type in _GDAL_TYPES:
+        if np.dtype(numpy_type) == np.dtype(dtype):
+            return data_type
+    raise ValueError('No GDAL data type for ' + str(dtype))
+
+
+class Reclassifier(object):
+
+    def __init__(self, nodata, dtype, breaks=None, interval_values=None, keys=None, key_values=None,
+                 default=None):
+        self.nodata = nodata
+        self.dtype = dtype
+        self.data_type = gdal_type(dtype)
+        self._breaks = breaks
+        self._interval_table = interval_values
+        self._keys = keys
+        self._key_values = key_values
+        self._default = default
+        self._table = None
+        self._offset = 0
+        if keys is not None and keys.size and int(keys[-1]) - int(keys[0]) < MAX_LOOKUP_TABLE \
+                and np.all(np.mod(keys, 1) == 0):
+            # value -> output as a plain table indexed by value - offset
+            self._offset = int(keys[0])
+            self._table = np.full(int(keys[-1]) - self._offset + 1, default, dtype=dtype)
+            self._table[keys.astype(np.int64) - self._offset] = key_values
+
+    @classmethod
+    def from_intervals(cls, breaks, values, nodata=0, below=None):
+        """[breaks[i], breaks[i + 1]) -> values[i]; >= breaks[-1] -> values[-1]; < breaks[0] -> below."""
+        if len(values) != len(breaks):
+            raise ValueError('Need one value per interval (one per break)')
+        if list(breaks) != sorted(breaks):
+            raise ValueError('The breaks have to be increasing')
+        below = nodata if below is None else below
+        dtype = output_dtype(list(values) + [nodata, below])
+        # np.digitize gives 0 below the first break, i for [breaks[i-1], breaks[i])
+        table = np.array([below] + list(values), dtype=dtype)
+        return cls(nodata, dtype, breaks=np.asarray(breaks, dtype=np.float64), interval_values=table)
+
+    @classmethod
+    def from_values(cls, mapping, nodata=0, default=None):
+        """{input value: output value}; any other input value -> default."""
+        default = nodata if default is None else default
+        dtype = output_dtype(list(mapping.values()) + [nodata, default])
+        keys = np.array(sorted(mapping), dtype=np.float64)
+        key_values = np.array([mapping[key] for key in sorted(mapping)], dtype=dtype)
+        return cls(nodata, dtype, keys=keys, key_values=key_values, default=default)
+
+    def apply(self, data, src_nodata=None):
+        """The reclassified block."""
+        if self._breaks is not None:
+            out = self._interval_table[np.digitize(data, self._breaks)]
+        elif self._table is not None:
+            index = data.astype(np.int64) - self._offset
+            inside = (index >= 0) & (index < self._table.size)
+            if data.dtype.kind == 'f':
+                inside &= np.mod(data, 1) == 0
+            out = np.full(data.shape, self._default, dtype=self.dtype)
+            out[inside] = self._table[index[inside]]
+        else:
+            position = np.clip(np.searchsorted(self._keys, data), 0, self._keys.size - 1)
+            found = self._keys[position] == data
+            out = np.where(found, self._key_values[position], self._default).astype(self.dtype)
+
+        invalid = np.isnan(data) if data.dtype.kind == 'f' else None
+        if src_nodata is not None:
+            invalid = (data == src_nodata) if invalid is None else invalid | (data == src_nodata)
+        if invalid is not None:
+            out[invalid] = self.nodata
+        return out
+
+
+def reclassify_raster(in_file, out_file, reclassifier, options=None, band_number=1, workers=None,
+                      chunk_blocks=(1, 1)):
+    """
+    Write the reclassified band of in_file to out_file (same grid), block by block on workers
+    threads (see block_processing).
+    """
+    ds = gdal.Open(in_file)
+    band = ds.GetRasterBand(band_number)
+    src_nodata = band.GetNoDataValue()
+    xsize = band.XSize
+    ysize = band.YSize
+
+    base_options = ["TILED=YES", "COMPRESS=DEFLATE"] if options is None else options
+
+    def reclassify(data, window):
+        return reclassifier.apply(data, src_nodata)
+
+    def fill(dst_ds):
+        dst_ds.SetGeoTransform(ds.GetGeoTransform())
+        dst_ds.SetProjection(ds.GetProjection())
+        dst_band = dst_ds.GetRasterBand(1)
+        dst_band.SetNoDataValue(reclassifier.nodata)
+        block_processing.run_blocks(in_file, dst_band, reclassify, workers=workers, chunk_blocks=chunk_blocks,
+                                    band_number=band_number, progress=True)
+
+    raster_output.write_raster(out_file, xsize, ysize, 1, reclassifier.data_type, base_options, fill)
+    ds = None
@@ -1,11 +1,16 @@
 """
 This re-codes the soils raster to values that work with the
 InVEST model
+
+    python -m supporting_scripts.reclassify_soils [-j threads] [--chunk-blocks n]
+
+The blocks are reclassified on a pool of threads (all of the cores by default); with
+--chunk-blocks every thread takes n x n native blocks at a time.
 """
-import numpy
-from numpy import zeros
-from numpy import logical_and
-from osgeo import gdal
+import getopt
+import sys
+
+from supporting_scripts.reclassify import Reclassifier, reclassify_raster
 
 # http://geoexamples.blogspot.ca/2013/06/gdal-performance-raster-classification.html
 
@@ -15,53 +20,16 @@ classification_output_values = [4, 3, 2, 1, 255]  # The value assigned to each i
 in_file = "/Users/mikelavender/Documents/SAFER_Cryo/soils/TEXMHT_M_sl4_250m.tif"
 out_file = "/Users/mikelavender/Documents/SAFER_Cryo/soils/soils.tif"
 
-ds = gdal.Open(in_file)
-band = ds.GetRasterBand(1)
-
-block_sizes = band.GetBlockSize()
-x_block_size = block_sizes[0]
-y_block_size = block_sizes[1]
-
-xsize = band.XSize
-ysize = band.YSize
-
-max_value = band.GetMaximum()
-min_value = band.GetMinimum()
-
-if max_value == None or min_value == None:
-    stats = band.GetStatistics(0, 1)
-    max_value = stats[1]
-    min_value = stats[0]
-
-format = "GTiff"
-driver = gdal.GetDriverByName(format)
-dst_ds = driver.Create(out_file, xsize, ysize, 1, gdal.GDT_Byte, options=["TILED=YES", "COMPRESS=DEFLATE"])
-dst_ds.SetGeoTransform(ds.GetGeoTransform())
-dst_ds.SetProjection(ds.GetProjection())
-
-for i in range(0, ysize, y_block_size):
-    print i, " of ", ysize
-    if i + y_block_size < ysize:
-        rows = y_block_size
-    else:
-        rows = ysize - i
-    for j in range(0, xsize, x_block_size):
-        if j + x_block_size < xsize:
-            cols = x_block_size
-        else:
-            cols = xsize - j
-
-        data = band.ReadAsArray(j, i, cols, rows)
-        r = zeros((rows, cols), numpy.int8)
-
-        for k in range(len(classification_values) - 1):
-            if classification_values[k] <= max_value and (classification_values[k + 1] > min_value):
-                r = r + classification_output_values[k] * logical_and(data >= classification_values[k],
-                                                                      data < classification_values[k + 1])
-        if classification_values[k + 1] < max_value:
-            r = r + classification_output_values[k + 1] * (data >= classification_values[k + 1])
-
-        dst_ds.GetRasterBand(1).SetNoDataValue(0)
-        dst_ds.GetRasterBand(1).WriteArray(r, j, i)
-
-dst_ds = None
\ No newline at end of file
+# anything below the first interval (and the nodata of the soils raster) is nodata (0)
+soils = Reclassifier.from_intervals(classification_values, classification_output_values, nodata=0)
+
+if __name__ == '__main__':
+    opts, args = getopt.getopt(sys.argv[1:], 'j:', ['jobs=', 'chunk-blocks='])
+    workers = None
+    chunk = 1
+    for opt, value in opts:
+        if opt in ('-j', '--jobs'):
+            workers = int(value)
+        elif opt == '--chunk-blocks':
+            chunk = int(value)
+    reclassify_raster(in_file, out_file, soils, workers=workers, chunk_blocks=(chunk, chunk))
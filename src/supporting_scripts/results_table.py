@@ -0,0 +1,184 @@
+"""
+The table of qf sums written by step03 (WaterSI_Model), as CSV or as typed Parquet.
+
+The CSV is what the analysis always read. The Parquet file has the same columns, with
+proper types (ints for year, month and basin, float64 for the sums and the geotransform,
+model as a category), written in batches of rows so memory stays flat. Loading it back is
+a matter of seconds instead of re-parsing every number of the CSV:
+
+    table = results_table.read_table('WaterSI_Model.parquet')
+
+Parquet needs pyarrow. Without it only the CSV can be written.
+"""
+
+import csv
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# name and type of every column, in output order
+COLUMNS = [('year', 'int16'),
+           ('month', 'int8'),
+           ('ws', 'int64'),
+           ('model', 'category'),
+           ('qf.sum', 'float64'),
+           ('px.count', 'int64'),
+           ('ulx', 'float64'),
+           ('xres', 'float64'),
+           ('xskew', 'float64'),
+           ('uly', 'float64'),
+           ('yskew', 'float64'),
+           ('yres', 'float64'),
+           ('cubic.m', 'float64'),
+           ('file', 'string')]
+
+HEADER = [name for name, _ in COLUMNS]
+
+# rows buffered before a Parquet row group is written
+BATCH_ROWS = 50000
+
+
+def make_row(year, month, ws, model, qf_sum, px_count, geotransform, file_name):
+    """One row of the table. cubic.m is the qf sum (mm) over the pixel area in cubic meters."""
+    ulx, xres, xskew, uly, yskew, yres = geotransform
+    return [int(year), int(month), int(float(ws)), model, float(qf_sum), int(px_count),
+            float(ulx), float(xres), float(xskew), float(uly), float(yskew), abs(float(yres)),
+            abs(xres * yres) * (qf_sum * 0.001), file_name]
+
+
+class CsvWriter(object):
+    """
+    Writes the rows to a CSV file, all values quoted (the way the table always looked). With
+    append the rows go to the end of an existing table (the header is only written to a new one).
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        new_table = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a' if append else 'w')
+        self._writer = csv.writer(self._file, quoting=csv.QUOTE_ALL)
+        if new_table:
+            self._writer.writerow(HEADER)
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+def _arrow_schema():
+    types = {'int8': pa.int8(), 'int16': pa.int16(), 'int64': pa.int64(), 'float64': pa.float64(),
+             'string': pa.string(), 'category': pa.dictionary(pa.int32(), pa.string())}
+    return pa.schema([pa.field(name, types[kind]) for name, kind in COLUMNS])
+
+
+class ParquetWriter(object):
+    """Writes the rows to a Parquet file with typed columns, BATCH_ROWS rows per row group."""
+
+    def __init__(self, path, batch_rows=BATCH_ROWS):
+        if pq is None:
+            raise ImportError('Writing Parquet needs pyarrow (pip install pyarrow)')
+        self.path = path
+        self.batch_rows = batch_rows
+        self._schema = _arrow_schema()
+        self._writer = pq.ParquetWriter(path, self._schema, compression='snappy')
+        self._rows = []
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        arrays = []
+        for i, (name, kind) in enumerate(COLUMNS):
+            values = [row[i] for row in self._rows]
+            if kind == 'category':
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=self._schema.field(name).type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class MultiWriter(object):
+    """Writes the same rows with several writers (e.g. CSV and Parquet side by side)."""
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def writerow(self, row):
+        for writer in self.writers:
+            writer.writerow(row)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+def is_parquet(path):
+    return os.path.splitext(path)[1].lower() in ('.parquet', '.pq')
+
+
+def open_writer(path, append=False):
+    """A writer for path: Parquet for .parquet, CSV otherwise. Parquet files can't be appended to."""
+    if is_parquet(path):
+        if append:
+            raise ValueError('Parquet files can only be written as a whole: ' + path)
+        return ParquetWriter(path)
+    return CsvWriter(path, append)
+
+
+def write_table(path, rows):
+    """Write all of the rows to path (as a new table). Returns the number of rows."""
+    writer = open_writer(path)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    writer.close()
+    return count
+
+
+def _typed(kind, value):
+    if kind.startswith('int'):
+        return int(float(value))
+    if kind == 'float64':
+        return float(value)
+    return value
+
+
+def read_rows(path):
+    """The rows of a CSV table (e.g. a qf summary table written by step02), with typed values."""
+    with open(path) as myfile:
+        reader = csv.reader(myfile)
+        header = next(reader)
+        if header != HEADER:
+            raise ValueError('Not a results table: ' + path)
+        for values in reader:
+            yield [_typed(kind, value) for (name, kind), value in zip(COLUMNS, values)]
+
+
+def read_table(path):
+    """Read the table (CSV or Parquet) into a pandas DataFrame with the column types above."""
+    import pandas as pd
+
+    if is_parquet(path):
+        if pq is None:
+            raise ImportError('Reading Parquet needs pyarrow (pip install pyarrow)')
+        return pq.read_table(path).to_pandas()
+
+    dtypes = dict((name, kind) for name, kind in COLUMNS if kind != 'string')
+    return pd.read_csv(path, dtype=dtypes)
@@ -0,0 +1,133 @@
+"""
+Re-use of the DEM-only routing outputs of InVEST across the runs of a basin.
+
+step02 runs seasonal water yield 30 times per basin (15 years x snow17/raw) with the same DEM,
+LULC, soils and flow threshold, so pit filling, flow direction, flow accumulation, streams
+and slope come out the same every time. install() wraps those pygeoprocessing functions in
+the worker process: the first run of a basin computes them and copies the result into the
+cache folder, the other runs copy the cached raster to the target path instead.
+
+The cache key is the function name, the content hash of every input raster and all of the
+other (non path) parameters, so a changed input is never served from the cache. The target
+path itself is not part of the key, since it contains the per run results suffix.
+"""
+
+import functools
+import hashlib
+import importlib
+import os
+import shutil
+
+# the routing functions (over the pygeoprocessing versions InVEST has used) that only depend
+# on the DEM and the flow threshold
+CACHED_FUNCTIONS = {
+    'pygeoprocessing': ['calculate_slope'],
+    'pygeoprocessing.routing': ['fill_pits', 'flow_direction_d_inf', 'flow_dir_d8', 'flow_dir_mfd',
+                                'flow_accumulation', 'flow_accumulation_d8', 'flow_accumulation_mfd',
+                                'stream_threshold', 'extract_streams_mfd', 'distance_to_stream',
+                                'distance_to_channel_mfd'],
+}
+
+# keyword arguments that don't change the result
+IGNORED_KWARGS = ['working_dir', 'temp_dir_path', 'raster_driver_creation_tuple']
+
+RASTER_EXTENSIONS = ('.tif', '.tiff')
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as myfile:
+        for chunk in iter(lambda: myfile.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _path_of(value):
+    # pygeoprocessing takes rasters either as a path or as a (path, band) tuple
+    if isinstance(value, tuple) and value and isinstance(value[0], string_types):
+        return value[0]
+    if isinstance(value, string_types):
+        return value
+    return None
+
+
+def _target_index(args):
+    # the output is the last positional raster path
+    for i in range(len(args) - 1, -1, -1):
+        path = _path_of(args[i])
+        if path is not None and path.lower().endswith(RASTER_EXTENSIONS):
+            return i
+    return None
+
+
+def _describe(value):
+    path = _path_of(value)
+    if path is not None and os.path.isfile(path):
+        return 'file:' + _file_hash(path) + ':' + repr(value[1:] if isinstance(value, tuple) else ())
+    return repr(value)
+
+
+def _key(name, args, kwargs, target_index):
+    sha = hashlib.sha1(name.encode('utf-8'))
+    for i, value in enumerate(args):
+        if i != target_index:
+            sha.update(_describe(value).encode('utf-8'))
+    for key in sorted(kwargs):
+        if key not in IGNORED_KWARGS:
+            sha.update((key + '=' + _describe(kwargs[key])).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _cached(func, name, cache_dir):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        target_index = _target_index(args)
+        if target_index is None:
+            return func(*args, **kwargs)
+
+        target = _path_of(args[target_index])
+        cached = os.path.join(cache_dir, _key(name, args, kwargs, target_index) + '.tif')
+        if os.path.exists(cached):
+            shutil.copyfile(cached, target)
+            return None
+
+        result = func(*args, **kwargs)
+        if result is None and os.path.isfile(target):
+            # copy under a temporary name first, a parallel run of the same basin may be
+            # reading the cache
+            tmp = cached + '.{0}.tmp'.format(os.getpid())
+            shutil.copyfile(target, tmp)
+            os.rename(tmp, cached)
+        return result
+
+    wrapper._routing_cache = True
+    return wrapper
+
+
+def install(cache_dir):
+    """Wrap the routing functions so they are served from cache_dir. Returns the names wrapped."""
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+
+    wrapped = []
+    for module_name, function_names in CACHED_FUNCTIONS.items():
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        for function_name in function_names:
+            func = getattr(module, function_name, None)
+            if func is None or getattr(func, '_routing_cache', False):
+                continue
+            setattr(module, function_name, _cached(func, module_name + '.' + function_name, cache_dir))
+            wrapped.append(module_name + '.' + function_name)
+
+    return wrapped
@@ -0,0 +1,74 @@
+"""
+Persistent record of the step02 jobs (one per basin, model and year).
+
+Every job is stored with its status, a fingerprint of its inputs and the qf rasters it
+produced. When a batch is restarted with resume on, jobs that finished ok with the same
+inputs fingerprint and whose outputs are still there are skipped.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def fingerprint(paths, params=None):
+    """
+    Cheap fingerprint of a set of input files (path, size and mtime) and parameters.
+
+    Missing files are part of the fingerprint too, so a file showing up later changes it.
+    """
+    sha = hashlib.sha1()
+    for path in sorted(paths):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            sha.update('{0}|{1}|{2}\n'.format(path, stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+        else:
+            sha.update('{0}|missing\n'.format(path).encode('utf-8'))
+    if params:
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class RunManifest(object):
+    """The jobs table in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                          'grdc_no TEXT, model TEXT, year INTEGER, '
+                          'status TEXT, fingerprint TEXT, outputs TEXT, updated REAL, '
+                          'PRIMARY KEY (grdc_no, model, year))')
+        self.conn.commit()
+
+    def record(self, grdc_no, model, year, status, fingerprint, outputs=None):
+        """Insert or update the status of a job."""
+        self.conn.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (str(grdc_no), model, int(year), status, fingerprint,
+                           json.dumps(outputs or []), time.time()))
+        self.conn.commit()
+
+    def get(self, grdc_no, model, year):
+        """The stored job as a dict, or None."""
+        cur = self.conn.execute('SELECT status, fingerprint, outputs, updated FROM jobs '
+                                'WHERE grdc_no = ? AND model = ? AND year = ?',
+                                (str(grdc_no), model, int(year)))
+        found = cur.fetchone()
+        if found is None:
+            return None
+        return {'status': found[0], 'fingerprint': found[1], 'outputs': json.loads(found[2]),
+                'updated': found[3]}
+
+    def is_complete(self, grdc_no, model, year, fingerprint, output_dir):
+        """True if the job finished ok with the same inputs and all of its outputs still exist."""
+        job = self.get(grdc_no, model, year)
+        if job is None or job['status'] != 'ok' or job['fingerprint'] != fingerprint:
+            return False
+        if not job['outputs']:
+            return False
+        return all(os.path.exists(os.path.join(output_dir, name)) for name in job['outputs'])
+
+    def close(self):
+        self.conn.close()
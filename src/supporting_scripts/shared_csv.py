@@ -0,0 +1,81 @@
+"""
+Appending to CSV tables that many step02 workers (and nodes) share.
+
+The workers of a batch, and the step02 partitions run_pipeline.py runs at the same time, all
+append to the same tables on shared storage (invest_runs.csv, day_below_zero.csv, the qf
+summary table). An append takes a POSIX lock on <table>.lock first (lockf works over NFS too),
+so rows of different workers never end up mixed, and the header is only written by whoever
+finds the table missing or empty. Nobody truncates a shared table.
+
+A run that is done again (a retry, a run taken over from another worker, a resumed batch or
+pipeline partition) appends its rows again. dedupe() rewrites a table with only the last row of
+every key, the way step03 merges the qf summary tables; step02 runs it on day_below_zero.csv
+when it is done.
+"""
+
+import csv
+import fcntl
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked(table_path):
+    """Hold the lock of the table at table_path."""
+    with open(table_path + '.lock', 'a') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def append_rows(table_path, header, rows):
+    """Append rows (all values quoted) to the table, with the header if the table is new."""
+    with locked(table_path):
+        new_table = not os.path.exists(table_path) or os.path.getsize(table_path) == 0
+        with open(table_path, 'a') as myfile:
+            wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
+            if new_table:
+                wr.writerow(header)
+            for row in rows:
+                wr.writerow(row)
+
+
+def dedupe(table_path, key_columns):
+    """
+    Rewrite the table with one row per key (the values of key_columns): the last one, at the
+    place of the first. Returns the number of rows dropped.
+    """
+    with locked(table_path):
+        if not os.path.exists(table_path):
+            return 0
+        with open(table_path) as myfile:
+            reader = csv.reader(myfile)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            key_index = [header.index(column) for column in key_columns]
+            rows = []
+            position = {}
+            read = 0
+            for row in reader:
+                read += 1
+                key = tuple(row[i] for i in key_index)
+                if key in position:
+                    rows[position[key]] = row
+                else:
+                    position[key] = len(rows)
+                    rows.append(row)
+        if len(rows) == read:
+            return 0
+
+        # written next to it first, so a reader never sees half a table
+        tmp_path = table_path + '.' + str(os.getpid())
+        with open(tmp_path, 'w') as myfile:
+            wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
+            wr.writerow(header)
+            for row in rows:
+                wr.writerow(row)
+        os.rename(tmp_path, table_path)
+        return read - len(rows)
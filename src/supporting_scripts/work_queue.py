@@ -0,0 +1,152 @@
+"""
+Pull based work queue for step02 in a SQLite file on shared storage.
+
+Every (basin, model, year) run is a row. Any number of step02 workers, on any number of
+nodes, claim the next job, send heartbeats while it runs and mark it done, or release it when
+it failed so someone else can pick it up. A job whose worker stopped sending heartbeats (node
+went down, job preempted) goes back to pending once its lease runs out, so nodes can be added
+or lost in the middle of a batch. A lease running out counts as an attempt, like a release, so
+a job that takes its worker down every time ends up failed instead of going round forever.
+
+A worker that is busy with something else between claiming a job and handing it to its InVEST
+pool (waiting on the runs of its last basin, clipping the layers of the next) keeps the lease of
+the job with a LeaseKeeper.
+
+Workers prefer jobs of the basin they are already working on, so the clipped base layers of a
+basin are re-used, and otherwise take the job with the highest priority (the predicted run
+time, see cost_model.py) first.
+"""
+
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue(object):
+
+    def __init__(self, path, lease_seconds=15 * 60, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # autocommit, the transactions are started by hand with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS queue ('
+                          'grdc_no TEXT, model TEXT, year INTEGER, priority REAL, '
+                          'status TEXT, worker TEXT, heartbeat REAL, attempts INTEGER, '
+                          'PRIMARY KEY (grdc_no, model, year))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_status ON queue (status, priority)')
+
+    def populate(self, jobs):
+        """Add (grdc_no, model, year, priority) jobs. Jobs already in the queue are left alone."""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('INSERT OR IGNORE INTO queue VALUES (?, ?, ?, ?, ?, NULL, NULL, 0)',
+                                  [(str(g), m, int(y), float(p), PENDING) for g, m, y, p in jobs])
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def claim(self, worker, prefer_grdc_no=None):
+        """Claim the next job for worker. Returns a dict (grdc_no, model, year, attempts) or None."""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # jobs of workers that went quiet are up for grabs again, if they have attempts left
+            self.conn.execute('UPDATE queue SET attempts = attempts + 1, worker = NULL, '
+                              'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END '
+                              'WHERE status = ? AND heartbeat < ?',
+                              (self.max_attempts, FAILED, PENDING, CLAIMED, now - self.lease_seconds))
+
+            found = self.conn.execute('SELECT grdc_no, model, year, attempts FROM queue WHERE status = ? '
+                                      'ORDER BY grdc_no = ? DESC, priority DESC, grdc_no, year, model LIMIT 1',
+                                      (PENDING, str(prefer_grdc_no))).fetchone()
+            if found is not None:
+                self.conn.execute('UPDATE queue SET status = ?, worker = ?, heartbeat = ? '
+                                  'WHERE grdc_no = ? AND model = ? AND year = ?',
+                                  (CLAIMED, worker, now, found[0], found[1], found[2]))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        if found is None:
+            return None
+        return {'grdc_no': found[0], 'model': found[1], 'year': found[2], 'attempts': found[3]}
+
+    def _update(self, sql, params, job, worker):
+        # only touch the job if it is still ours (the lease may have run out and someone else
+        # may have it now)
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            cur = self.conn.execute(sql + ' WHERE grdc_no = ? AND model = ? AND year = ? AND worker = ?',
+                                    params + (str(job['grdc_no']), job['model'], int(job['year']), worker))
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return cur.rowcount > 0
+
+    def heartbeat(self, job, worker):
+        """Extend the lease of a claimed job. False if the job isn't ours anymore."""
+        return self._update('UPDATE queue SET heartbeat = ?', (time.time(),), job, worker)
+
+    def complete(self, job, worker):
+        """Mark a job as done."""
+        return self._update('UPDATE queue SET status = ?, heartbeat = ?', (DONE, time.time()), job, worker)
+
+    def release(self, job, worker):
+        """Give a failed job back. It is only tried max_attempts times, then it stays failed."""
+        return self._update('UPDATE queue SET attempts = attempts + 1, worker = NULL, '
+                            'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END',
+                            (self.max_attempts, FAILED, PENDING), job, worker)
+
+    def counts(self):
+        """Number of jobs per status."""
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM queue GROUP BY status').fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+class LeaseKeeper(object):
+    """
+    Sends the heartbeats of claimed jobs from a thread of its own (with its own connection,
+    SQLite connections can't be shared between threads) for as long as it is entered:
+
+        with LeaseKeeper(queue.path, worker, [job]):
+            ...  # long running work that doesn't send heartbeats
+    """
+
+    def __init__(self, path, worker, jobs, interval=60):
+        self.path = path
+        self.worker = worker
+        self.jobs = list(jobs)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        queue = WorkQueue(self.path)
+        try:
+            while not self._stop.wait(self.interval):
+                for job in self.jobs:
+                    queue.heartbeat(job, self.worker)
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        return False
@@ -0,0 +1,287 @@
+"""
+Zonal statistics of a watershed over the (coarse) forcing rasters.
+
+Instead of warping every monthly raster with the watershed as a cutline, the watershed is
+rasterized once onto the raster grid (all touched pixels) and only the bounding window of
+the watershed is read from each monthly raster. The mask is cached, so all the monthly
+rasters on the same grid reuse it.
+"""
+
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from supporting_scripts import raster_stats
+
+# window of the watershed on the raster grid and the rasterized watershed inside of it
+ZoneMask = namedtuple('ZoneMask', ['xoff', 'yoff', 'xsize', 'ysize', 'mask'])
+
+_mask_cache = {}
+
+
+def _spatial_ref(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def _grid_signature(ds):
+    return ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(), ds.GetProjection()
+
+
+def grid_signature(raster_path):
+    """Size, geotransform and projection of a raster; equal signatures mean the same grid."""
+    ds = gdal.Open(raster_path)
+    signature = _grid_signature(ds)
+    ds = None
+    return signature
+
+
+def _transformed_geometries(shapefile, raster_srs):
+    # all of the watershed geometries in the SRS of the raster
+    vector_ds = ogr.Open(shapefile)
+    layer = vector_ds.GetLayer()
+    layer_srs = layer.GetSpatialRef()
+
+    transform = None
+    if layer_srs is not None:
+        layer_srs = _spatial_ref(layer_srs.ExportToWkt())
+        if not layer_srs.IsSame(raster_srs):
+            transform = osr.CoordinateTransformation(layer_srs, raster_srs)
+
+    geometries = []
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        geometries.append(geometry)
+
+    vector_ds = None
+    return geometries
+
+
+def _window(geometries, geotransform, xsize, ysize):
+    # pixel window (xoff, yoff, cols, rows) covering the envelopes of all geometries
+    envelopes = [g.GetEnvelope() for g in geometries]
+    min_x = min(e[0] for e in envelopes)
+    max_x = max(e[1] for e in envelopes)
+    min_y = min(e[2] for e in envelopes)
+    max_y = max(e[3] for e in envelopes)
+
+    ulx, xres, _, uly, _, yres = geotransform
+    cols = sorted([(min_x - ulx) / xres, (max_x - ulx) / xres])
+    rows = sorted([(max_y - uly) / yres, (min_y - uly) / yres])
+
+    # pad one pixel on every side so ALL_TOUCHED never gets cut off by rounding
+    col0 = max(int(math.floor(cols[0])) - 1, 0)
+    col1 = min(int(math.ceil(cols[1])) + 1, xsize)
+    row0 = max(int(math.floor(rows[0])) - 1, 0)
+    row1 = min(int(math.ceil(rows[1])) + 1, ysize)
+
+    return col0, row0, col1 - col0, row1 - row0
+
+
+def rasterize_geometries(geometries, srs, geotransform, xoff, yoff, xsize, ysize):
+    """
+    Burn geometries (already in the SRS of the grid) into a window of the grid.
+
+    Returns the window as a byte array with 1 for every pixel touched by a geometry.
+    """
+    ulx, xres, xskew, uly, yskew, yres = geotransform
+    window_geotransform = (ulx + xoff * xres + yoff * xskew, xres, xskew,
+                           uly + xoff * yskew + yoff * yres, yskew, yres)
+
+    mem_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    mem_ds.SetGeoTransform(window_geotransform)
+    mem_ds.SetProjection(srs.ExportToWkt())
+
+    vector_ds = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = vector_ds.CreateLayer('zones', srs=srs)
+    for geometry in geometries:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+        feature = None
+
+    gdal.RasterizeLayer(mem_ds, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+    burned = mem_ds.GetRasterBand(1).ReadAsArray()
+
+    vector_ds = None
+    mem_ds = None
+    return burned
+
+
+def _zone_from_geometries(geometries, srs, geotransform, xsize, ysize):
+    if not geometries:
+        return ZoneMask(0, 0, 0, 0, np.zeros((0, 0), dtype=bool))
+
+    xoff, yoff, cols, rows = _window(geometries, geotransform, xsize, ysize)
+    if cols <= 0 or rows <= 0:
+        return ZoneMask(0, 0, 0, 0, np.zeros((0, 0), dtype=bool))
+
+    burned = rasterize_geometries(geometries, srs, geotransform, xoff, yoff, cols, rows)
+    return ZoneMask(xoff, yoff, cols, rows, burned > 0)
+
+
+def zone_mask(shapefile, raster_path):
+    """Rasterize the watershed in shapefile onto the grid of raster_path (cached per grid)."""
+    return _zone_mask(shapefile, grid_signature(raster_path))
+
+
+def dataset_zone_mask(shapefile, ds):
+    """zone_mask onto the grid of an already open dataset."""
+    return _zone_mask(shapefile, _grid_signature(ds))
+
+
+def _zone_mask(shapefile, signature):
+    stat = os.stat(shapefile)
+    key = (os.path.abspath(shapefile), stat.st_mtime, stat.st_size, signature)
+    if key in _mask_cache:
+        return _mask_cache[key]
+
+    xsize, ysize, geotransform, projection = signature
+    raster_srs = _spatial_ref(projection)
+    geometries = _transformed_geometries(shapefile, raster_srs)
+    zone = _zone_from_geometries(geometries, raster_srs, geotransform, xsize, ysize)
+
+    _mask_cache[key] = zone
+    return zone
+
+
+def zonal_stats(raster_path, zone, band_number=1):
+    """
+    mean, sum and count of the valid pixels of raster_path inside the zone.
+
+    Returns a dict with the keys 'mean', 'sum' and 'count'. mean is None if there are
+    no valid pixels in the zone.
+    """
+    result = {'mean': None, 'sum': 0.0, 'count': 0}
+    stats = zone_band_stats(raster_path, zone, band_number)
+    if stats.count:
+        result['sum'] = stats.sum
+        result['count'] = stats.count
+        result['mean'] = stats.mean
+
+    return result
+
+
+def zone_band_stats(source, zone, band_number=1, nodata=None):
+    """
+    All of the statistics (a raster_stats.RasterStats) of the valid pixels of a band inside the
+    zone. source is a path, a gdal.Dataset or a gdal.Band. nodata overrides the nodata value of
+    the band.
+    """
+    if zone.xsize == 0 or zone.ysize == 0:
+        return raster_stats.RasterStats()
+    return raster_stats.reduce_band(source, band_number, window=(zone.xoff, zone.yoff, zone.xsize, zone.ysize),
+                                    mask=zone.mask, nodata=nodata)
+
+
+# a set of label rasters covering many basins on one grid. Every basin is burned into exactly
+# one of the layers; basins that share pixels (nested basins, or neighbours touching the same
+# pixel) end up in different layers. labels are 1-based indices into basin_ids, 0 is empty.
+BasinLabels = namedtuple('BasinLabels', ['basin_ids', 'xoff', 'yoff', 'xsize', 'ysize', 'layers',
+                                         'signature'])
+
+
+def basin_labels(basins, raster_path):
+    """
+    Rasterize many basins onto the grid of raster_path as a stack of label rasters.
+
+    basins is a sequence of (basin_id, shapefile) tuples. Basins with no pixels on the grid
+    are left out. The labels only cover the window around all of the basins.
+    """
+    signature = grid_signature(raster_path)
+
+    xsize, ysize, geotransform, projection = signature
+    raster_srs = _spatial_ref(projection)
+
+    zones = []
+    for basin_id, shapefile in basins:
+        geometries = _transformed_geometries(shapefile, raster_srs)
+        zone = _zone_from_geometries(geometries, raster_srs, geotransform, xsize, ysize)
+        if zone.mask.any():
+            zones.append((basin_id, zone))
+
+    if not zones:
+        return BasinLabels([], 0, 0, 0, 0, [], signature)
+
+    xoff = min(z.xoff for _, z in zones)
+    yoff = min(z.yoff for _, z in zones)
+    cols = max(z.xoff + z.xsize for _, z in zones) - xoff
+    rows = max(z.yoff + z.ysize for _, z in zones) - yoff
+
+    # largest basins first so the big outer basins fill the first layer and the nested
+    # ones stack up behind them
+    zones.sort(key=lambda bz: -int(bz[1].mask.sum()))
+
+    basin_ids = []
+    layers = []
+    for basin_id, zone in zones:
+        basin_ids.append(basin_id)
+        label = len(basin_ids)
+        rows_slice = slice(zone.yoff - yoff, zone.yoff - yoff + zone.ysize)
+        cols_slice = slice(zone.xoff - xoff, zone.xoff - xoff + zone.xsize)
+
+        for layer in layers:
+            if not layer[rows_slice, cols_slice][zone.mask].any():
+                break
+        else:
+            layer = np.zeros((rows, cols), dtype=np.int32)
+            layers.append(layer)
+
+        layer[rows_slice, cols_slice][zone.mask] = label
+
+    return BasinLabels(basin_ids, xoff, yoff, cols, rows, layers, signature)
+
+
+def multi_basin_stats(labels, raster_path, band_number=1):
+    """
+    mean, sum and count of the valid pixels of raster_path for every basin in labels.
+
+    The raster is read once and reduced per label layer with np.bincount. Returns a dict of
+    basin_id -> {'mean': ..., 'sum': ..., 'count': ...}.
+    """
+    ds = gdal.Open(raster_path)
+    if _grid_signature(ds) != labels.signature:
+        ds = None
+        raise ValueError('Raster is not on the grid of the basin labels: ' + raster_path)
+
+    band = ds.GetRasterBand(band_number)
+    nodata = band.GetNoDataValue()
+    data = band.ReadAsArray(labels.xoff, labels.yoff, labels.xsize, labels.ysize)
+    ds = None
+
+    valid = ~np.isnan(data) if data.dtype.kind == 'f' else np.ones(data.shape, dtype=bool)
+    if nodata is not None:
+        valid &= data != nodata
+    values = data[valid].astype(np.float64)
+
+    n = len(labels.basin_ids) + 1
+    sums = np.zeros(n, dtype=np.float64)
+    counts = np.zeros(n, dtype=np.int64)
+    for layer in labels.layers:
+        layer_labels = layer[valid]
+        sums += np.bincount(layer_labels, weights=values, minlength=n)
+        counts += np.bincount(layer_labels, minlength=n)
+
+    result = {}
+    for i, basin_id in enumerate(labels.basin_ids):
+        count = int(counts[i + 1])
+        total = float(sums[i + 1])
+        result[basin_id] = {'mean': total / count if count else None, 'sum': total, 'count': count}
+
+    return result
+
+
+def clear_cache():
+    """Forget all cached watershed masks."""
+    _mask_cache.clear()